@@ -0,0 +1,239 @@
+"""
+Libros sintéticos por formato de entrada
+
+Réplicas mínimas de la estructura de cada formato soportado por function_app,
+con n filas aleatorias (semilla fija). Las usan los benchmarks y generan los
+libros de calentamiento embebidos (calentamiento/) que procesa /api/warmup:
+
+    python -m benchmarks.libros_sinteticos      # regenera calentamiento/
+"""
+
+import io
+import os
+import sys
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO_CALENTAMIENTO = os.path.join(RAIZ, 'calentamiento')
+FILAS_CALENTAMIENTO = 5
+
+CAUSAS_SINTETICAS = [
+    'Incendio en bodega', 'Inundación por lluvia', 'Sismo', 'Robo de equipos',
+    'Vendaval', 'Explosión de caldera', 'Daños maliciosos', 'Rotura de maquinaria'
+]
+
+
+def _escribir_xlsx(hojas: List[Tuple[str, Any]]) -> bytes:
+    """Escribe un libro xlsx en modo write-only a partir de [(hoja, filas)]"""
+    wb = Workbook(write_only=True)
+    for nombre_hoja, filas in hojas:
+        ws = wb.create_sheet(title=nombre_hoja)
+        for fila in filas:
+            ws.append(fila)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def _siniestros_sinteticos(n_filas: int, semilla: int) -> Dict[str, Any]:
+    """Genera columnas aleatorias de siniestros (fechas, causas y montos)"""
+    rng = np.random.default_rng(semilla)
+    dias = rng.integers(0, 5 * 365, n_filas)
+    fechas = [datetime(2019, 1, 1) + pd.Timedelta(days=int(d)) for d in dias]
+    incurrido = np.round(rng.lognormal(16, 1.3, n_filas), 2)
+    pagado = np.round(incurrido * rng.uniform(0, 1, n_filas), 2)
+    return {
+        'fechas': fechas,
+        'causas': rng.choice(CAUSAS_SINTETICAS, n_filas),
+        'incurrido': incurrido,
+        'pagado': pagado,
+        'reservado': np.round(incurrido - pagado, 2)
+    }
+
+
+def _valores_sinteticos(n_filas: int, semilla: int) -> np.ndarray:
+    """Genera sumas aseguradas por ubicación"""
+    rng = np.random.default_rng(semilla)
+    return np.round(rng.lognormal(21, 0.8, n_filas), 2)
+
+
+def _libro_grupo_i(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    d = _siniestros_sinteticos(n_filas, semilla)
+
+    def filas():
+        yield ['Reporte de siniestros - GRUPO I']
+        yield ['Num. Poliza', 'Nom. Procucto', 'Fec. Sini', 'Nom. Exp.',
+               'Liquidado', 'Rva. Actual', 'Total Incurrido']
+        for i in range(n_filas):
+            yield [f'POL-{i % 97:04d}', 'TODO RIESGO DAÑO MATERIAL', d['fechas'][i], str(d['causas'][i]),
+                   float(d['pagado'][i]), float(d['reservado'][i]), float(d['incurrido'][i])]
+
+    return 'siniestralidad_grupo_i.xlsx', _escribir_xlsx([('GRUPO I', filas())])
+
+
+def _libro_la_costena_siniestros(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    d = _siniestros_sinteticos(n_filas, semilla)
+
+    def filas():
+        for i in range(8):
+            yield [f'La Costeña - reporte de siniestros ({i + 1})']
+        yield ['SINIESTRO', 'DESCRIPCIÓN', 'SUBCATEGORIA', 'fechasin', 'PERDIDA',
+               'SINPAGADO', 'RESERVA_INDEMNIZA', 'RESERVA_GASTOS']
+        for i in range(n_filas):
+            reserva = float(d['reservado'][i])
+            yield [f'S{100000 + i}', str(d['causas'][i]), 'General', d['fechas'][i],
+                   float(d['incurrido'][i]), float(d['pagado'][i]), round(reserva * 0.9, 2), round(reserva * 0.1, 2)]
+
+    return 'siniestros_la_costena.xlsx', _escribir_xlsx([('SIN_AGOSTO', filas())])
+
+
+def _libro_conagua_siniestros(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    d = _siniestros_sinteticos(n_filas, semilla)
+
+    def filas():
+        yield ['CONAGUA - Loss Run']
+        yield ['Póliza', 'Fecha Ocurrencia ', 'Causa', 'Cat / No Cat', 'Pérdida Pagada Neta', 'Reserva Bruta']
+        for i in range(n_filas):
+            cat = 'Cat' if 'lluvia' in d['causas'][i] or 'Sismo' in d['causas'][i] else 'No Cat'
+            yield [f'CNA-{i % 13:03d}', d['fechas'][i], str(d['causas'][i]), cat,
+                   float(d['pagado'][i]), float(d['reservado'][i])]
+
+    resumen = [['CONAGUA - Resumen'], ['Siniestros', n_filas]]
+    return 'conagua_loss_run.xlsx', _escribir_xlsx([('Resume', resumen), ('Detail', filas())])
+
+
+def _csv_siniestros(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    d = _siniestros_sinteticos(n_filas, semilla)
+    lineas = ['fecha_siniestro;causa_siniestro;monto_pagado;monto_reservado;monto_incurrido']
+    for i in range(n_filas):
+        lineas.append(f"{d['fechas'][i]:%Y-%m-%d};{d['causas'][i]};{d['pagado'][i]};"
+                      f"{d['reservado'][i]};{d['incurrido'][i]}")
+    return 'siniestros.csv', ('\n'.join(lineas) + '\n').encode('utf-8')
+
+
+def _libro_rio_magdalena_tiv(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    valores = _valores_sinteticos(n_filas, semilla)
+    total = max(float(valores.sum()), 1.5e9)
+
+    resumen = [['Resumen de valores asegurados']] + [[f'Rubro {i}'] for i in range(2, 24)]
+    resumen.append(['TOTAL', None, None, None, None, None, total])
+
+    def detalle():
+        yield ['Ubicacion', 'Municipio', 'Valor']
+        for i in range(n_filas):
+            yield [f'Sede {i}', f'Municipio {i % 40}', float(valores[i])]
+
+    return 'tiv_rio_magdalena.xlsx', _escribir_xlsx([('Resumen', resumen), ('Detalle', detalle())])
+
+
+def _libro_antioquia_tiv(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    valores = _valores_sinteticos(max(n_filas, 10), semilla)
+    total = max(float(valores.sum()), 1.5e9)
+    encabezado = ['Item', 'Nombre', 'Dirección', 'Municipio', 'Departamento'] + \
+        [f'Campo {c}' for c in range(5, 21)] + ['Valor Asegurado', 'Total']
+
+    def filas():
+        for i in range(7):
+            yield [f'Relación de bienes asegurados ({i + 1})']
+        yield encabezado
+        for i in range(len(valores)):
+            fila = [i + 1, f'Sede {i}', f'Calle {i}', f'Municipio {i % 40}', 'Antioquia'] + \
+                [None] * 16 + [float(valores[i])]
+            # W18 = fila 10 de datos (encabezado en la fila 8)
+            fila.append(total if i == 9 else None)
+            yield fila
+
+    return 'tiv_antioquia.xlsx', _escribir_xlsx([('Valores', filas())])
+
+
+def _libro_la_costena_tiv(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    valores = _valores_sinteticos(n_filas, semilla)
+
+    def filas():
+        yield ['La Costeña - Desglose por ubicación']
+        yield ['Vigencia 2024-2025']
+        yield ['Cifras en MXN']
+        yield ['No', 'UBICACION', 'ESTADO', 'MUNICIPIO', 'EDIFICIOS', 'CONTENIDOS',
+               'INVENTARIO', 'PERDIDAS CONSEC', 'VALORES TOTALES']
+        for i in range(n_filas):
+            v = float(valores[i])
+            yield [i + 1, f'Planta {i}', f'Estado {i % 32}', f'Municipio {i % 120}',
+                   round(v * 0.5, 2), round(v * 0.2, 2), round(v * 0.2, 2), round(v * 0.1, 2), v]
+
+    return 'desglose_valores_la_costena.xlsx', _escribir_xlsx([('SUM ASEG', filas())])
+
+
+def _libro_conagua_tiv(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    valores = _valores_sinteticos(n_filas, semilla)
+
+    def filas():
+        for i in range(11):
+            yield [f'CONAGUA - Relación de inmuebles ({i + 1})']
+        yield ['No', 'Nombre', 'Estado', 'Municipio', 'Edificio', 'Contenidos']
+        for i in range(n_filas):
+            v = float(valores[i])
+            yield [i + 1, f'Inmueble {i}', f'Estado {i % 32}', f'Municipio {i % 120}', v, round(v * 0.1, 2)]
+
+    return 'conagua_sov.xlsx', _escribir_xlsx([('Conagua 2024', filas())])
+
+
+def _csv_tiv(n_filas: int, semilla: int) -> Tuple[str, bytes]:
+    valores = _valores_sinteticos(n_filas, semilla)
+    lineas = ['ubicacion;estado;municipio;suma_asegurada']
+    for i in range(n_filas):
+        lineas.append(f'Sede {i};Estado {i % 32};Municipio {i % 120};{valores[i]}')
+    return 'tiv.csv', ('\n'.join(lineas) + '\n').encode('utf-8')
+
+
+# formato -> (rol, constructor)
+FORMATOS_SINTETICOS = {
+    'grupo_i': ('siniestralidad', _libro_grupo_i),
+    'la_costena_siniestros': ('siniestralidad', _libro_la_costena_siniestros),
+    'conagua_siniestros': ('siniestralidad', _libro_conagua_siniestros),
+    'csv_siniestros': ('siniestralidad', _csv_siniestros),
+    'rio_magdalena_tiv': ('tiv', _libro_rio_magdalena_tiv),
+    'antioquia_tiv': ('tiv', _libro_antioquia_tiv),
+    'la_costena_tiv': ('tiv', _libro_la_costena_tiv),
+    'conagua_tiv': ('tiv', _libro_conagua_tiv),
+    'csv_tiv': ('tiv', _csv_tiv),
+}
+
+
+def generar_libro_sintetico(formato: str, n_filas: int = 5, semilla: int = 0) -> Tuple[str, bytes]:
+    """
+    Genera un archivo sintético con la estructura de un formato soportado
+
+    Args:
+        formato: Clave de FORMATOS_SINTETICOS
+        n_filas: Número de siniestros o ubicaciones
+        semilla: Semilla del generador aleatorio
+
+    Returns:
+        Tupla (nombre_archivo, contenido_bytes)
+    """
+    if formato not in FORMATOS_SINTETICOS:
+        raise ValueError(f"Formato sintético no soportado: {formato}")
+    _, constructor = FORMATOS_SINTETICOS[formato]
+    return constructor(n_filas, semilla)
+
+
+def escribir_libros_calentamiento(directorio: str = DIRECTORIO_CALENTAMIENTO) -> Dict[str, str]:
+    """Escribe un libro mínimo por formato (FILAS_CALENTAMIENTO filas); retorna formato -> archivo"""
+    os.makedirs(directorio, exist_ok=True)
+    archivos = {}
+    for formato in FORMATOS_SINTETICOS:
+        nombre, contenido = generar_libro_sintetico(formato, FILAS_CALENTAMIENTO)
+        with open(os.path.join(directorio, nombre), 'wb') as f:
+            f.write(contenido)
+        archivos[formato] = nombre
+    return archivos
+
+
+if __name__ == '__main__':
+    for formato, nombre in escribir_libros_calentamiento(*sys.argv[1:2]).items():
+        print(f"{formato:24s} {nombre}")
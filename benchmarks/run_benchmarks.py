@@ -0,0 +1,270 @@
+"""
+Benchmarks end to end de analisis_tecnico por formato de entrada
+
+Genera libros sintéticos de cada formato soportado (libros_sinteticos.FORMATOS_SINTETICOS),
+ejecuta el endpoint en proceso con la KB y las cotizaciones reemplazadas por
+stand-ins locales, y reporta throughput, percentiles de latencia y pico de
+memoria por etapa. Los resultados se comparan contra benchmarks/baseline.json.
+
+Uso:
+    python benchmarks/run_benchmarks.py                        # 10, 1.000 y 10.000 filas
+    python benchmarks/run_benchmarks.py --tamanos 10 500000 --formatos conagua_tiv
+    python benchmarks/run_benchmarks.py --guardar-baseline     # actualiza baseline.json
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+import azure.functions as func  # noqa: E402
+
+import function_app  # noqa: E402
+from benchmarks.libros_sinteticos import FORMATOS_SINTETICOS, generar_libro_sintetico  # noqa: E402
+from benchmarks.servicios_locales import ASEGURADO_KB, servicios_locales  # noqa: E402
+
+BASELINE_DEFAULT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Escenario extra: histórico completo desde la KB (sin archivo de siniestros)
+ESCENARIO_KB = 'kb_historico'
+
+# Archivos acompañantes pequeños para que cada corrida tenga TIV y siniestros
+ACOMPANANTE_TIV = 'csv_tiv'
+ACOMPANANTE_SINIESTROS = 'grupo_i'
+
+
+def _archivo_json(nombre: str, contenido: bytes, tipo: str) -> Dict[str, str]:
+    return {'nombre': nombre, 'tipo': tipo, 'contenido_base64': base64.b64encode(contenido).decode()}
+
+
+def construir_request(formato: str, n_filas: int, medir_memoria: bool) -> func.HttpRequest:
+    """Arma el request JSON (formato n8n) para un formato y tamaño"""
+    archivos = []
+    asegurado = 'Asegurado Benchmark'
+
+    if formato == ESCENARIO_KB:
+        asegurado = ASEGURADO_KB
+        archivos.append(_archivo_json(*generar_libro_sintetico(ACOMPANANTE_TIV, 10), 'tiv'))
+    else:
+        rol, _ = FORMATOS_SINTETICOS[formato]
+        nombre, contenido = generar_libro_sintetico(formato, n_filas)
+        if rol == 'tiv':
+            archivos.append(_archivo_json(nombre, contenido, 'tiv'))
+            archivos.append(_archivo_json(*generar_libro_sintetico(ACOMPANANTE_SINIESTROS, 10),
+                                          'siniestralidad'))
+        else:
+            archivos.append(_archivo_json(*generar_libro_sintetico(ACOMPANANTE_TIV, 10), 'tiv'))
+            archivos.append(_archivo_json(nombre, contenido, 'siniestralidad'))
+
+    body = json.dumps({'asegurado': asegurado, 'archivos': archivos, 'parametros': {}}).encode()
+    headers = {'Content-Type': 'application/json',
+               'X-Instrumentacion': 'memoria' if medir_memoria else 'tiempos'}
+    return func.HttpRequest('POST', '/api/analisis-tecnico', headers=headers, body=body)
+
+
+def verificar_lectura_csv() -> List[str]:
+    """
+    Chequeo de regresión leer_csv -> convertir_fechas: el motor pyarrow entrega
+    las fechas ISO de un CSV como datetime.date y todas deben convertirse
+    """
+    errores = []
+    _, contenido = generar_libro_sintetico('csv_siniestros', 5)
+    try:
+        df = function_app.leer_csv(contenido)
+        fechas = function_app.convertir_fechas(df['fecha_siniestro'])
+    except Exception as e:
+        return [f"leer_csv -> convertir_fechas: {type(e).__name__}: {e}"]
+    if len(df) != 5:
+        errores.append(f"leer_csv: {len(df)} filas en lugar de 5")
+    if fechas.isna().any():
+        errores.append(f"convertir_fechas: {int(fechas.isna().sum())} fechas ISO sin convertir")
+    return errores
+
+
+def _percentil(valores: List[float], q: float) -> float:
+    return round(float(np.percentile(valores, q)), 3) if valores else 0.0
+
+
+def validar_respuesta(formato: str, n_filas: int, cuerpo: Dict[str, Any]) -> Optional[str]:
+    """
+    Error si el análisis respondió 200 sin procesar el archivo del caso
+    (consolidar_siniestralidad registra los errores de parseo y sigue)
+    """
+    rol = 'siniestralidad' if formato == ESCENARIO_KB else FORMATOS_SINTETICOS[formato][0]
+    if rol == 'siniestralidad' and cuerpo.get('siniestros_procesados') != n_filas:
+        return f"siniestros_procesados={cuerpo.get('siniestros_procesados')} (esperado {n_filas})"
+    if rol == 'tiv' and not (cuerpo.get('tiv_total') or 0) > 0:
+        return f"tiv_total={cuerpo.get('tiv_total')} (esperado > 0)"
+    return None
+
+
+def ejecutar_caso(formato: str, n_filas: int, repeticiones: int, cache_libros: bool = False) -> Dict[str, Any]:
+    """Corre un formato/tamaño: repeticiones con tiempos + 1 corrida con memoria"""
+    filas_kb = n_filas if formato == ESCENARIO_KB else 0
+    latencias = []
+    etapas: Dict[str, List[float]] = {}
+    memoria: Dict[str, float] = {}
+    errores = []
+
+    with servicios_locales(filas_historico_kb=filas_kb, cache_libros=cache_libros):
+        req_tiempos = construir_request(formato, n_filas, medir_memoria=False)
+        req_memoria = construir_request(formato, n_filas, medir_memoria=True)
+
+        for i in range(repeticiones + 1):
+            medir_memoria = i == repeticiones
+            inicio = time.perf_counter()
+            respuesta = asyncio.run(function_app.analisis_tecnico(req_memoria if medir_memoria else req_tiempos))
+            duracion = time.perf_counter() - inicio
+
+            cuerpo = json.loads(respuesta.get_body())
+            if respuesta.status_code != 200:
+                errores.append(cuerpo.get('error', f'HTTP {respuesta.status_code}'))
+                continue
+            error = validar_respuesta(formato, n_filas, cuerpo)
+            if error:
+                errores.append(error)
+                continue
+
+            spans = cuerpo['json_pricing']['trazabilidad']['instrumentacion']['spans']
+            if medir_memoria:
+                for span in spans:
+                    memoria[span['etapa']] = max(memoria.get(span['etapa'], 0), span.get('memoria_pico_kb', 0))
+            else:
+                latencias.append(duracion * 1000)
+                for span in spans:
+                    etapas.setdefault(span['etapa'], []).append(span['wall_ms'])
+                formatos = cuerpo['json_pricing']['trazabilidad'].get('formatos_detectados')
+
+    if not latencias:
+        return {'formato': formato, 'filas': n_filas, 'errores': sorted(set(errores))}
+
+    p50 = _percentil(latencias, 50)
+    return {
+        'formato': formato,
+        'filas': n_filas,
+        'formatos_detectados': formatos,
+        'repeticiones': len(latencias),
+        'latencia_ms': {'p50': p50, 'p95': _percentil(latencias, 95), 'max': round(max(latencias), 3)},
+        'throughput_filas_por_s': round(n_filas / (p50 / 1000), 1) if p50 > 0 else None,
+        'etapas': {
+            etapa: {
+                'p50_ms': _percentil(valores, 50),
+                'p95_ms': _percentil(valores, 95),
+                'memoria_pico_kb': memoria.get(etapa)
+            }
+            for etapa, valores in sorted(etapas.items())
+        },
+        'errores': sorted(set(errores))
+    }
+
+
+def comparar_con_baseline(resultados: List[Dict], baseline: Dict, tolerancia: float) -> List[str]:
+    """Lista de regresiones de p50 por encima de la tolerancia"""
+    previos = {(r['formato'], r['filas']): r for r in baseline.get('resultados', [])}
+    regresiones = []
+    for r in resultados:
+        previo = previos.get((r['formato'], r['filas']))
+        if not previo or 'latencia_ms' not in previo:
+            continue
+        if 'latencia_ms' not in r:
+            regresiones.append(f"{r['formato']} ({r['filas']} filas): falla y antes funcionaba")
+            continue
+        antes, ahora = previo['latencia_ms']['p50'], r['latencia_ms']['p50']
+        if antes > 0 and ahora > antes * (1 + tolerancia):
+            regresiones.append(f"{r['formato']} ({r['filas']} filas): p50 {antes:.1f} ms -> {ahora:.1f} ms "
+                               f"(+{(ahora / antes - 1) * 100:.0f}%)")
+    return regresiones
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    formatos_disponibles = list(FORMATOS_SINTETICOS) + [ESCENARIO_KB]
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--formatos', nargs='+', default=formatos_disponibles, choices=formatos_disponibles)
+    parser.add_argument('--tamanos', nargs='+', type=int, default=[10, 1000, 10000],
+                        help='Filas por archivo (10 a 500000)')
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--cache-libros', action='store_true',
+                        help='Mide re-análisis con la cache de libros parseados (no se compara con el baseline)')
+    parser.add_argument('--baseline', default=BASELINE_DEFAULT)
+    parser.add_argument('--guardar-baseline', action='store_true',
+                        help='Actualiza en el baseline los casos de esta corrida')
+    parser.add_argument('--tolerancia', type=float, default=0.25, help='Regresión permitida en p50 (0.25 = 25%%)')
+    parser.add_argument('--salida', help='Archivo JSON adicional con los resultados')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+
+    errores_lectura = verificar_lectura_csv()
+    for error in errores_lectura:
+        print(f"ERROR de lectura: {error}")
+
+    resultados = []
+    for formato in args.formatos:
+        for n_filas in args.tamanos:
+            resultado = ejecutar_caso(formato, n_filas, args.repeticiones, args.cache_libros)
+            resultados.append(resultado)
+            if 'latencia_ms' in resultado:
+                print(f"{formato:24s} {n_filas:>8d} filas  p50={resultado['latencia_ms']['p50']:>10.1f} ms  "
+                      f"p95={resultado['latencia_ms']['p95']:>10.1f} ms  "
+                      f"{resultado['throughput_filas_por_s'] or 0:>12.0f} filas/s")
+            else:
+                print(f"{formato:24s} {n_filas:>8d} filas  ERROR: {'; '.join(resultado['errores'])}")
+
+    reporte = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'cache_libros': args.cache_libros,
+        'entorno': {
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'resultados': resultados
+    }
+
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+
+    codigo = 1 if errores_lectura else 0
+    if args.cache_libros:
+        print("\nCorrida con cache de libros: no se compara con el baseline (mide parseo completo)")
+    elif args.guardar_baseline:
+        # Los casos no corridos ahora se conservan del baseline anterior
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                previos = json.load(f).get('resultados', [])
+            corridos = {(r['formato'], r['filas']) for r in resultados}
+            reporte['resultados'] = [r for r in previos if (r['formato'], r['filas']) not in corridos] + resultados
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+        print(f"Baseline guardado en {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            regresiones = comparar_con_baseline(resultados, json.load(f), args.tolerancia)
+        if regresiones:
+            print("\nREGRESIONES respecto al baseline:")
+            for r in regresiones:
+                print(f"  - {r}")
+            codigo = 1
+        else:
+            print("\nSin regresiones respecto al baseline")
+
+    return codigo
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Stand-ins locales de la Knowledge Base y de la API de cotizaciones
+
+Permiten correr analisis_tecnico end to end en proceso, sin Azure SQL ni red:
+- buscar_asegurado_en_kb / consultar_historico_siniestros responden desde
+  un snapshot SQLite de la KB con un histórico sintético (ver SnapshotKB)
+- la KB remota queda sin conexión, como ante un miss del snapshot sin red
+- la cache compartida de CotizacionDolar se precarga con tasas fijas
+- la cache de libros parseados queda deshabilitada (o en un directorio temporal)
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import function_app
+from benchmarks.libros_sinteticos import _siniestros_sinteticos
+
+ASEGURADO_KB = 'Asegurado Benchmark KB'
+TASAS_FIJAS = {'COP': 4000.0, 'MXN': 18.0}
+AÑOS_SNAPSHOT = 6
+
+
+def historico_kb_sintetico(n_filas: int, semilla: int = 0) -> pd.DataFrame:
+    """Siniestros con las columnas de la tabla siniestros del snapshot (insured_key=1)"""
+    datos = _siniestros_sinteticos(n_filas, semilla)
+    # Correr las fechas sintéticas (2019-2023) a los últimos 5 años
+    desplazamiento = pd.Timestamp(datetime.now().year - 5, 1, 1) - pd.Timestamp(2019, 1, 1)
+    fechas = pd.to_datetime(pd.Series(datos['fechas'])) + desplazamiento
+    rng = np.random.default_rng(semilla + 1)
+    return pd.DataFrame({
+        'insured_key': 1,
+        'num_poliza': [f'KB-{i:07d}' for i in range(n_filas)],
+        'occurrence_date_key': fechas.dt.strftime('%Y%m%d').astype(int),
+        'monto_pagado_cop': datos['pagado'] * TASAS_FIJAS['COP'],
+        'monto_reservado_usd': datos['reservado'],
+        'monto_incurrido_usd': datos['incurrido'],
+        'monto_pagado_usd': datos['pagado'],
+        'causa_siniestro': datos['causas'],
+        'estado': rng.choice(['Abierto', 'Cerrado'], n_filas),
+        'salvamento': 0.0,
+        'subrogacion': 0.0,
+    })
+
+
+def escribir_snapshot_sintetico(ruta: str, filas_historico_kb: int) -> None:
+    """Snapshot KB con ASEGURADO_KB (insured_key=1) y su histórico; sin asegurados si filas_historico_kb=0"""
+    asegurados = pd.DataFrame({
+        'insured_key': [1],
+        'insured_name': [ASEGURADO_KB],
+        'insured_short_name': [ASEGURADO_KB],
+        'cedant_name': ['Cedente Benchmark'],
+        'country': ['COLOMBIA'],
+    }).iloc[:1 if filas_historico_kb else 0]
+    fecha_limite = (datetime.now().year - AÑOS_SNAPSHOT) * 10000 + 101
+    function_app.escribir_snapshot_kb(ruta, asegurados, historico_kb_sintetico(filas_historico_kb), fecha_limite)
+
+
+@contextmanager
+def servicios_locales(filas_historico_kb: int = 0, cache_libros: bool = False):
+    """
+    Reemplaza KB y FX por stand-ins locales mientras dure el bloque
+
+    Args:
+        filas_historico_kb: Siniestros de ASEGURADO_KB en el snapshot
+            (0 = el asegurado no existe en la KB)
+        cache_libros: Usar la cache de libros parseados (vacía al empezar)
+    """
+    originales = (function_app.SNAPSHOT_KB, function_app.get_azure_sql_connection, function_app.CACHE_LIBROS)
+    cache_original = dict(function_app.CotizacionDolar._cache_compartida)
+
+    with tempfile.TemporaryDirectory(prefix='bench_kb_') as directorio:
+        ruta = os.path.join(directorio, 'kb_snapshot.sqlite')
+        escribir_snapshot_sintetico(ruta, filas_historico_kb)
+
+        function_app.SNAPSHOT_KB = function_app.SnapshotKB(ruta, habilitado=True)
+        function_app.get_azure_sql_connection = lambda: None
+        function_app.CACHE_LIBROS = function_app.CacheLibros(
+            os.path.join(directorio, 'cache_libros'), max_mb=1024, habilitado=cache_libros)
+        ahora = datetime.now().timestamp()
+        function_app.CotizacionDolar._cache_compartida.update(
+            {moneda: (tasa, ahora) for moneda, tasa in TASAS_FIJAS.items()})
+        try:
+            yield
+        finally:
+            function_app.SNAPSHOT_KB, function_app.get_azure_sql_connection, function_app.CACHE_LIBROS = originales
+            function_app.CotizacionDolar._cache_compartida.clear()
+            function_app.CotizacionDolar._cache_compartida.update(cache_original)
@@ -1,9 +1,85 @@
 """
-Azure Function: Análisis Técnico de Suscripción de Reaseguros - VERSIÓN 3.2
-Versión: 3.2
+Azure Function: Análisis Técnico de Suscripción de Reaseguros - VERSIÓN 3.3
+Versión: 3.3
 Autor: Arquitectura iPaaS
 Descripción: Análisis técnico completo con histórico desde Azure SQL Knowledge Base
 
+Cambios v3.3:
+- ✅ Endpoint /api/warmup para precalentar instancias nuevas
+  - Pool ODBC de la KB, cotizaciones FX y parsers de cada formato
+  - Hook opcional de arranque (CALENTAMIENTO_AL_INICIAR)
+  - Cache de cotizaciones compartida entre requests con TTL
+- ✅ Instrumentación por etapa (tiempo de pared, CPU y pico de memoria)
+  - PASO 1-6, estrategias TIV, archivos de siniestralidad y consultas KB
+  - Opt-in por request (X-Instrumentacion) o global (INSTRUMENTACION_LOGS)
+- ✅ Perfilado opcional de un request con cProfile (X-Perfilar + PERFILADO_CLAVE)
+- ✅ Endpoint /api/metrics en formato de exposición Prometheus
+  - Latencia por etapa y por formato, KB hit/miss, edad cache FX,
+    conexiones KB en uso, siniestros procesados y bytes de respuesta
+- ✅ Snapshot local de la KB (SQLite + mmap) como réplica de lectura
+  - Timer de exportación (KB_SNAPSHOT_CRON) y carga en el warm-up
+  - KB remota solo ante miss o snapshot vencido; marca de agua en trazabilidad
+- ✅ Cache de libros parseados (Arrow IPC + memory map) por hash de contenido
+  - Re-analizar el mismo TIV o loss run no vuelve a pasar por openpyxl
+  - LRU en disco acotada por CACHE_LIBROS_MAX_MB
+- ✅ Detección de CSV por contenido (magic bytes) antes de intentar Excel
+  - Encoding y delimitador detectados de una muestra; una sola lectura con
+    motor pyarrow y solo las columnas estándar de siniestros
+  - Fechas y montos de CSV / Excel genérico convertidos a tipos correctos
+- ✅ Lectura de celdas por dirección en .xlsx (streaming del XML de la hoja)
+  - Estrategias G24 / W18 leen solo hasta la fila necesaria
+  - La tabla de ubicaciones se carga solo cuando una estrategia la usa
+- ✅ Agregación en streaming de relaciones de valores muy grandes (SUM ASEG, CONAGUA)
+  - TIV, desglose por componente y estadísticas por ubicación en una pasada
+    con memoria constante (desde TIV_STREAMING_MIN_FILAS filas)
+  - Tabla completa de ubicaciones solo si se pide (parametros.tiv_ubicaciones)
+- ✅ Ubicaciones críticas y concentración del TIV (antes ubicaciones_criticas = [])
+  - Top de ubicaciones por selección parcial, HHI y participación por estado / municipio
+  - Cruce de siniestros con ubicaciones por id_ubicacion / ubicacion
+- ✅ Agrupación de siniestros en eventos por cláusula horaria del peril
+  - Ordenamiento único por (peril, fecha) y cortes vectorizados, O(n log n)
+  - Pérdida por evento, top eventos y máximo anual (insumo XL)
+  - es_catastrofico respeta la marca Cat / No Cat del archivo (CONAGUA)
+- ✅ Grilla de pricing opcional (parametros.grilla_pricing)
+  - Tasas × deducibles × capas XL en un broadcast de NumPy por ocurrencia
+  - Burning cost, margen y semáforo por combinación; tasa propuesta configurable
+- ✅ Intervalos de confianza por bootstrap (parametros.bootstrap)
+  - Remuestreo de años y siniestros en bloques con semilla reproducible
+  - Frecuencia anual, severidad promedio y burning cost por mil
+- ✅ Triángulos de desarrollo y chain-ladder (analisis_completo.chain_ladder)
+  - Un loss run por año de evaluación, o agregado en SQL desde FACT_CLAIMS
+    (KB_COLUMNA_EVALUACION)
+  - Factores ponderados por volumen, último estimado e IBNR por año de ocurrencia
+- ✅ Deduplicación del histórico KB contra los loss runs cargados
+  - Claves normalizadas (referencia, fecha, peril, monto) cruzadas por hash en tiempo lineal
+  - Coincidencias por nivel en calidad_datos.deduplicacion_kb
+- ✅ Montos y fechas en formatos latinoamericanos en todos los loss runs
+  - Separador decimal ('1.234.567,89' / '1,234.50') y orden día/mes detectados
+    por columna sobre una muestra; seriales de Excel, YYYYMMDD y '15-ene-2023'
+- ✅ Ubicación automática de la fila de encabezado (primeras 50 filas en streaming)
+  - GRUPO I, La Costeña, CONAGUA, Antioquia y Excel genérico toleran filas de título extra
+- ✅ Endpoint analisis-tecnico async con pools acotados y backpressure
+  - KB y cotización en un pool de I/O en paralelo al TIV; parseo de loss runs
+    opcional en pool de procesos (PROCESOS_PARSEO); 503 + Retry-After con la cola llena
+- ✅ Circuit breakers para KB y API de cotizaciones con sonda de recuperación
+  - Presupuesto de tiempo por request: sin KB, cotización cacheada o sin
+    bootstrap cuando no alcanza; degradaciones en trazabilidad.presupuesto
+- ✅ Reporte Excel generado en la función (parametros.formato_salida = 'xlsx')
+  - Hojas Resumen, Siniestros, Por año y Por peril con openpyxl write-only
+  - reporte_excel_data vectorizado y con la tasa de cambio detectada
+- ✅ Formato NDJSON solo por compatibilidad con clientes que leen líneas (parametros.formato_salida = 'ndjson')
+  - Resumen en la primera línea y un siniestro por línea, sin duplicar los
+    siniestros en reporte_excel_data
+- ✅ Resultados en memoria por analisis_id (LRU con TTL) y paginación
+  - GET /api/analisis/{analisis_id}/siniestros con cursor, filtros y orden
+    sobre índices de la tabla guardada; /perils con los agregados por peril
+- ✅ Sesiones de análisis incremental (parametros.sesion / sesion_id)
+  - Agregar o reemplazar loss runs parsea solo esos archivos; TIV e histórico
+    KB se reusan y los agregados se recalculan sobre la tabla normalizada
+- ✅ Resúmenes materializados del histórico KB por asegurado (parametros.historico_kb)
+  - Timer que agrega FACT_CLAIMS por asegurado/año/peril en un store SQLite,
+    incremental por fecha de modificación; la renovación lee una fila por clave
+
 Cambios v3.2 (2024-12-30):
 - ✅ Integración API de Cotizaciones del Dólar
   - Soporte USD/COP (Colombia)
@@ -39,12 +115,41 @@ import json
 import logging
 import os
 from datetime import datetime
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Any, Optional, Tuple
 import io
+import csv
+import zipfile
+import xml.etree.ElementTree as ET
+import base64
 import hashlib
+import heapq
+import math
 import pyodbc
 import numpy as np
 import requests
+try:
+    import pyarrow as pa
+    import pyarrow.ipc  # noqa: F401  (registra pa.ipc)
+except ImportError:  # Cache de libros parseados deshabilitada
+    pa = None
+import threading
+import time
+import contextvars
+import cProfile
+import pstats
+import hmac
+import re
+import tempfile
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+import functools
+import tracemalloc
+import asyncio
+import multiprocessing
+from contextlib import closing, contextmanager, nullcontext, suppress
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
@@ -52,6 +157,17 @@ logger = logging.getLogger(__name__)
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
+# Versión reportada en logs y en el response (mantener igual al encabezado del módulo)
+VERSION = '3.3'
+
+
+def _env_bool(nombre: str, default: bool = False) -> bool:
+    """Lee un app setting booleano ('1', 'true', 'si', 'yes')"""
+    valor = os.getenv(nombre)
+    if valor is None:
+        return default
+    return valor.strip().lower() in ('1', 'true', 'si', 'sí', 'yes', 'on')
+
 
 # JSON Encoder personalizado para manejar tipos de NumPy/Pandas
 class NumpyEncoder(json.JSONEncoder):
@@ -70,6 +186,416 @@ class NumpyEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+# ============================================
+# INSTRUMENTACIÓN POR ETAPA
+# ============================================
+
+_INSTRUMENTACION_ACTUAL: contextvars.ContextVar = contextvars.ContextVar('instrumentacion', default=None)
+# tracemalloc mide el proceso entero y reset_peak() es global: los análisis con
+# medición de memoria se ejecutan de a uno
+_LOCK_MEDICION_MEMORIA = threading.Lock()
+
+
+class Instrumentacion:
+    """
+    Recolector de spans de un request: tiempo de pared, CPU y pico de memoria
+
+    Uso:
+        instr = Instrumentacion(medir_memoria=True)
+        with instr.activa():
+            with medir_etapa('paso_1_kb'):
+                ...
+        instr.resumen()
+
+    medir_etapa() siempre alimenta el histograma duracion_etapa de /api/metrics; solo el
+    span (traza, CPU, log metrica_etapa) y la captura de memoria dependen de un bloque activa().
+    Con medir_memoria, activa() toma _LOCK_MEDICION_MEMORIA hasta terminar.
+    """
+
+    def __init__(self, medir_memoria: bool = False, emitir_logs: bool = True, incluir_en_respuesta: bool = False):
+        self.medir_memoria = medir_memoria
+        self.emitir_logs = emitir_logs
+        self.incluir_en_respuesta = incluir_en_respuesta
+        self.spans: List[Dict[str, Any]] = []
+        self._local = threading.local()
+        self._hilo_memoria: Optional[int] = None
+
+    def _pila(self) -> List[Dict[str, Any]]:
+        if not hasattr(self._local, 'pila'):
+            self._local.pila = []
+        return self._local.pila
+
+    @contextmanager
+    def activa(self):
+        """Activa la instrumentación en el contexto actual"""
+        iniciado = False
+        if self.medir_memoria:
+            _LOCK_MEDICION_MEMORIA.acquire()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                iniciado = True
+            self._hilo_memoria = threading.get_ident()
+        token = _INSTRUMENTACION_ACTUAL.set(self)
+        try:
+            yield self
+        finally:
+            _INSTRUMENTACION_ACTUAL.reset(token)
+            if self.medir_memoria:
+                if iniciado:
+                    tracemalloc.stop()
+                _LOCK_MEDICION_MEMORIA.release()
+
+    def _mide_memoria(self) -> bool:
+        """
+        Memoria solo en el hilo que activó la instrumentación: reset_peak() es global y
+        un span de POOL_IO (KB, FX) pisaría el pico del span del análisis que corre en paralelo
+        """
+        return (self.medir_memoria and threading.get_ident() == self._hilo_memoria
+                and tracemalloc.is_tracing())
+
+    def _abrir(self, nombre: str, atributos: Dict[str, Any]) -> Dict[str, Any]:
+        pila = self._pila()
+        marco = {
+            'etapa': nombre,
+            'atributos': atributos,
+            'padre': pila[-1]['etapa'] if pila else None,
+            'inicio_pared': time.perf_counter(),
+            'inicio_cpu': time.thread_time(),
+            'memoria_base': 0,
+            'pico': 0
+        }
+        if self._mide_memoria():
+            actual, pico = tracemalloc.get_traced_memory()
+            if pila:
+                pila[-1]['pico'] = max(pila[-1]['pico'], pico)
+            marco['memoria_base'] = actual
+            tracemalloc.reset_peak()
+        pila.append(marco)
+        return marco
+
+    def _cerrar(self, marco: Dict[str, Any], error: Optional[BaseException]):
+        pila = self._pila()
+        if pila and pila[-1] is marco:
+            pila.pop()
+
+        span = {
+            'etapa': marco['etapa'],
+            'padre': marco['padre'],
+            'wall_ms': round((time.perf_counter() - marco['inicio_pared']) * 1000, 3),
+            'cpu_ms': round((time.thread_time() - marco['inicio_cpu']) * 1000, 3)
+        }
+        if self._mide_memoria():
+            marco['pico'] = max(marco['pico'], tracemalloc.get_traced_memory()[1])
+            span['memoria_pico_kb'] = round(max(marco['pico'] - marco['memoria_base'], 0) / 1024, 1)
+            if pila:
+                pila[-1]['pico'] = max(pila[-1]['pico'], marco['pico'])
+        if marco['atributos']:
+            span['atributos'] = marco['atributos']
+        if error is not None:
+            span['error'] = type(error).__name__
+        self.spans.append(span)
+        METRICAS.duracion_etapa.observe(span['wall_ms'] / 1000, etapa=span['etapa'])
+
+        if self.emitir_logs:
+            # Todos los campos en el texto y en orden fijo ('-' si no aplica): el worker de
+            # Functions no reenvía `extra`, así que Application Insights los extrae con parse
+            logger.info(
+                f"⏱️ metrica_etapa etapa={span['etapa']} padre={span['padre'] or '-'} "
+                f"wall_ms={span['wall_ms']} cpu_ms={span['cpu_ms']} "
+                f"memoria_pico_kb={span.get('memoria_pico_kb', '-')} error={span.get('error', '-')}"
+            )
+
+    def resumen(self) -> Dict[str, Any]:
+        """Retorna los spans registrados en formato serializable"""
+        return {
+            'medir_memoria': self.medir_memoria,
+            'spans': list(self.spans)
+        }
+
+
+@contextmanager
+def medir_etapa(nombre: str, **atributos):
+    """
+    Mide una etapa del pipeline: siempre en el histograma de /api/metrics y,
+    si hay una Instrumentacion activa, además como span
+
+    Args:
+        nombre: Nombre de la etapa (ej. 'paso_2_tiv', 'kb.consultar_historico')
+        **atributos: Datos adicionales del span (archivo, estrategia, etc.)
+    """
+    instr = _INSTRUMENTACION_ACTUAL.get()
+    if instr is None:
+        # Sin instrumentación solo se alimenta el histograma de /api/metrics
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            METRICAS.duracion_etapa.observe(time.perf_counter() - inicio, etapa=nombre)
+        return
+
+    marco = instr._abrir(nombre, atributos)
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        instr._cerrar(marco, error)
+
+
+def etapa_instrumentada(nombre: str):
+    """Decorador: mide la función completa como una etapa"""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with medir_etapa(nombre):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+def configurar_instrumentacion(req: func.HttpRequest, parametros: Dict) -> Optional[Instrumentacion]:
+    """
+    Decide si el request se instrumenta
+
+    - Header X-Instrumentacion o parametro 'instrumentacion': 'tiempos' | 'memoria'
+    - App setting INSTRUMENTACION_LOGS=true instrumenta todos los requests (solo logs)
+
+    Returns:
+        Instrumentacion o None si está deshabilitada
+    """
+    solicitado = req.headers.get('X-Instrumentacion') or req.params.get('instrumentacion') \
+        or parametros.get('instrumentacion')
+    if isinstance(solicitado, str) and solicitado.strip().lower() in ('', '0', 'false', 'no'):
+        solicitado = None
+
+    if solicitado:
+        medir_memoria = str(solicitado).strip().lower() == 'memoria' or _env_bool('INSTRUMENTACION_MEMORIA')
+        return Instrumentacion(medir_memoria=medir_memoria, incluir_en_respuesta=True)
+
+    if _env_bool('INSTRUMENTACION_LOGS'):
+        return Instrumentacion(medir_memoria=_env_bool('INSTRUMENTACION_MEMORIA'))
+
+    return None
+
+
+# ============================================
+# MÉTRICAS EN PROCESO (FORMATO PROMETHEUS)
+# ============================================
+
+class _MetricaFragmentada(ABC):
+    """
+    Base de métricas con un fragmento por hilo
+
+    Cada hilo actualiza solo su propio diccionario (sin locks en el camino
+    caliente); /api/metrics combina los fragmentos al exponer. El lock solo
+    se toma la primera vez que un hilo registra su fragmento.
+    """
+
+    tipo = ''
+
+    def __init__(self, nombre: str, ayuda: str):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self._local = threading.local()
+        self._fragmentos: List[Dict] = []
+        self._lock_registro = threading.Lock()
+
+    def _fragmento(self) -> Dict:
+        fragmento = getattr(self._local, 'fragmento', None)
+        if fragmento is None:
+            fragmento = {}
+            self._local.fragmento = fragmento
+            with self._lock_registro:
+                self._fragmentos.append(fragmento)
+        return fragmento
+
+    @staticmethod
+    def _clave(etiquetas: Dict[str, Any]) -> Tuple:
+        return tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+    @staticmethod
+    def _formatear_etiquetas(clave: Tuple, extra: Optional[Tuple] = None) -> str:
+        pares = list(clave) + ([extra] if extra else [])
+        if not pares:
+            return ''
+        # Formato de texto de Prometheus: \\, \" y \n dentro del valor
+        texto = ','.join(
+            f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for k, v in pares)
+        return '{' + texto + '}'
+
+    @abstractmethod
+    def _combinados(self) -> Dict:
+        """Valores de todos los fragmentos sumados por clave de etiquetas"""
+
+    @abstractmethod
+    def exponer(self) -> List[str]:
+        """Líneas HELP / TYPE y muestras de la métrica"""
+
+
+class Contador(_MetricaFragmentada):
+    """Contador monótono con etiquetas"""
+
+    tipo = 'counter'
+
+    def inc(self, valor: float = 1, **etiquetas):
+        fragmento = self._fragmento()
+        clave = self._clave(etiquetas)
+        fragmento[clave] = fragmento.get(clave, 0) + valor
+
+    def _combinados(self) -> Dict:
+        total: Dict[Tuple, float] = {}
+        with self._lock_registro:
+            fragmentos = list(self._fragmentos)
+        for fragmento in fragmentos:
+            for clave, valor in fragmento.copy().items():
+                total[clave] = total.get(clave, 0) + valor
+        return total
+
+    def exponer(self) -> List[str]:
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {self.tipo}']
+        for clave, valor in sorted(self._combinados().items()):
+            lineas.append(f'{self.nombre}{self._formatear_etiquetas(clave)} {valor:g}')
+        return lineas
+
+
+class Histograma(_MetricaFragmentada):
+    """Histograma acumulativo con buckets fijos y etiquetas"""
+
+    tipo = 'histogram'
+
+    def __init__(self, nombre: str, ayuda: str, buckets: List[float]):
+        super().__init__(nombre, ayuda)
+        self.buckets = sorted(buckets)
+
+    def observe(self, valor: float, **etiquetas):
+        fragmento = self._fragmento()
+        clave = self._clave(etiquetas)
+        serie = fragmento.get(clave)
+        if serie is None:
+            # [conteos por bucket..., +Inf, suma]
+            serie = [0] * (len(self.buckets) + 1) + [0.0]
+            fragmento[clave] = serie
+        indice = len(self.buckets)
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                indice = i
+                break
+        serie[indice] += 1
+        serie[-1] += valor
+
+    def _combinados(self) -> Dict:
+        total: Dict[Tuple, List[float]] = {}
+        with self._lock_registro:
+            fragmentos = list(self._fragmentos)
+        for fragmento in fragmentos:
+            for clave, serie in fragmento.copy().items():
+                acumulada = total.setdefault(clave, [0] * len(serie))
+                for i, valor in enumerate(list(serie)):
+                    acumulada[i] += valor
+        return total
+
+    def exponer(self) -> List[str]:
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {self.tipo}']
+        for clave, serie in sorted(self._combinados().items()):
+            acumulado = 0
+            for limite, conteo in zip(self.buckets + [float('inf')], serie[:-1]):
+                acumulado += conteo
+                le = '+Inf' if limite == float('inf') else f'{limite:g}'
+                lineas.append(f'{self.nombre}_bucket{self._formatear_etiquetas(clave, ("le", le))} {acumulado:g}')
+            lineas.append(f'{self.nombre}_sum{self._formatear_etiquetas(clave)} {serie[-1]:g}')
+            lineas.append(f'{self.nombre}_count{self._formatear_etiquetas(clave)} {acumulado:g}')
+        return lineas
+
+
+class Medidor:
+    """Gauge calculado al momento de exponer (ej. edad de la cache FX)"""
+
+    tipo = 'gauge'
+
+    def __init__(self, nombre: str, ayuda: str, funcion):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+
+    def exponer(self) -> List[str]:
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {self.tipo}']
+        try:
+            for etiquetas, valor in self.funcion():
+                clave = _MetricaFragmentada._clave(etiquetas)
+                lineas.append(f'{self.nombre}{_MetricaFragmentada._formatear_etiquetas(clave)} {valor:g}')
+        except Exception as e:
+            logger.debug(f"No se pudo calcular {self.nombre}: {e}")
+        return lineas
+
+
+BUCKETS_SEGUNDOS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+BUCKETS_BYTES = [1024 * 4 ** i for i in range(10)]  # 1 KB .. 256 MB
+
+
+class MetricasProceso:
+    """Registro de métricas del proceso expuestas en /api/metrics"""
+
+    def __init__(self):
+        self.duracion_request = Histograma(
+            'analisis_request_duracion_segundos',
+            'Latencia total de analisis-tecnico por formato de entrada detectado',
+            BUCKETS_SEGUNDOS)
+        self.duracion_etapa = Histograma(
+            'analisis_etapa_duracion_segundos', 'Latencia por etapa del pipeline', BUCKETS_SEGUNDOS)
+        self.requests = Contador('analisis_requests_total', 'Requests de analisis-tecnico por código HTTP')
+        self.archivos = Contador('analisis_archivos_total', 'Archivos procesados por rol y formato detectado')
+        self.kb_busquedas = Contador('kb_busquedas_total', 'Búsquedas de asegurado en la KB por resultado')
+        self.kb_conexiones = Contador('kb_conexiones_total', 'Intentos de conexión a la KB por resultado')
+        self.cache_libros = Contador('cache_libros_total', 'Lecturas de la cache de libros parseados por rol y resultado')
+        self.kb_snapshot = Contador(
+            'kb_snapshot_consultas_total', 'Consultas al snapshot local de la KB por operación y resultado')
+        self.fx_consultas = Contador('fx_consultas_total', 'Consultas de cotización por moneda y origen')
+        self.siniestros = Contador('siniestros_procesados_total', 'Filas de siniestros procesadas por fuente')
+        self.bytes_respuesta = Histograma(
+            'analisis_respuesta_bytes', 'Tamaño del response de analisis-tecnico', BUCKETS_BYTES)
+        self._conexiones_en_uso = 0
+        self._lock_conexiones = threading.Lock()
+        self.medidores = [
+            Medidor('kb_conexiones_en_uso', 'Conexiones a la KB abiertas en este proceso',
+                    lambda: [({}, self._conexiones_en_uso)]),
+            Medidor('analisis_en_curso', 'Análisis en ejecución o esperando un hilo del pool',
+                    lambda: [({}, CONTROL_CARGA.en_curso)]),
+            Medidor('resultados_en_memoria', 'Análisis guardados para paginación en este proceso',
+                    lambda: [({}, len(ALMACEN_RESULTADOS))]),
+            Medidor('circuito_abierto', 'Circuito de la dependencia abierto (1) o cerrado (0)',
+                    lambda: [({'dependencia': b.nombre}, int(b.estado == 'abierto')) for b in (BREAKER_KB, BREAKER_FX)]),
+            Medidor('fx_cache_edad_segundos', 'Antigüedad de cada cotización en la cache compartida',
+                    lambda: [({'moneda': moneda}, time.time() - ts)
+                             for moneda, (_, ts) in CotizacionDolar._cache_compartida.copy().items()]),
+            Medidor('kb_snapshot_edad_segundos', 'Antigüedad del snapshot local de la KB',
+                    lambda: [({}, marca['edad_horas'] * 3600)
+                             for marca in [SNAPSHOT_KB.marca_agua()] if marca]),
+        ]
+
+    def conexion_abierta(self):
+        with self._lock_conexiones:
+            self._conexiones_en_uso += 1
+
+    def conexion_cerrada(self):
+        with self._lock_conexiones:
+            self._conexiones_en_uso -= 1
+
+    def exponer(self) -> str:
+        """Texto en formato de exposición Prometheus 0.0.4"""
+        lineas = []
+        for metrica in [self.duracion_request, self.duracion_etapa, self.requests, self.archivos,
+                        self.kb_busquedas, self.kb_conexiones, self.kb_snapshot, self.cache_libros,
+                        self.fx_consultas, self.siniestros, self.bytes_respuesta] + self.medidores:
+            lineas.extend(metrica.exponer())
+        return '\n'.join(lineas) + '\n'
+
+
+METRICAS = MetricasProceso()
+
+
 # ============================================
 # DETECTORES DE FORMATO
 # ============================================
@@ -151,6 +677,162 @@ def es_formato_conagua_tiv(archivo_bytes: bytes, filename: str) -> bool:
     return False
 
 
+# ============================================
+# CIRCUIT BREAKERS Y PRESUPUESTO DE LATENCIA
+# ============================================
+# Con la KB o la API de cotizaciones caídas, cada request pagaba los timeouts
+# completos (30 s de login ODBC, 10 s por intento HTTP). Tras varios fallos
+# seguidos el circuito se abre y las llamadas fallan al instante mientras una
+# sonda en segundo plano detecta la recuperación. Además cada request lleva un
+# presupuesto de tiempo: con poco margen las etapas opcionales se degradan
+# (sin histórico KB, cotización cacheada, sin bootstrap) y queda registrado en
+# la trazabilidad.
+
+CIRCUITO_FALLOS_PARA_ABRIR = int(os.getenv('CIRCUITO_FALLOS_PARA_ABRIR', '3'))
+CIRCUITO_SEGUNDOS_ABIERTO = float(os.getenv('CIRCUITO_SEGUNDOS_ABIERTO', '30'))
+KB_TIMEOUT_CONEXION = int(os.getenv('KB_TIMEOUT_CONEXION', '30'))
+KB_TIMEOUT_SONDA = 5
+FX_TIMEOUT_SEGUNDOS = float(os.getenv('FX_TIMEOUT_SEGUNDOS', '10'))
+ANALISIS_PRESUPUESTO_SEGUNDOS = float(os.getenv('ANALISIS_PRESUPUESTO_SEGUNDOS', '240'))
+# Margen mínimo que debe quedar para intentar cada dependencia o etapa opcional
+PRESUPUESTO_MIN_SEGUNDOS = {
+    'kb': float(os.getenv('PRESUPUESTO_MIN_KB_SEGUNDOS', '30')),
+    'fx': float(os.getenv('PRESUPUESTO_MIN_FX_SEGUNDOS', '5')),
+    'bootstrap': float(os.getenv('PRESUPUESTO_MIN_BOOTSTRAP_SEGUNDOS', '20')),
+}
+
+
+class CircuitBreaker:
+    """
+    Circuito de una dependencia externa: 'cerrado' deja pasar las llamadas y
+    'abierto' las rechaza sin esperar timeouts
+
+    Se abre con CIRCUITO_FALLOS_PARA_ABRIR fallos consecutivos. Pasado
+    CIRCUITO_SEGUNDOS_ABIERTO, la primera llamada rechazada lanza la sonda en
+    un hilo aparte; si responde el circuito se cierra, si no sigue abierto otro
+    período. Los requests nunca esperan a la sonda.
+    """
+
+    def __init__(self, nombre: str, sonda: Callable[[], bool],
+                 fallos_para_abrir: int = CIRCUITO_FALLOS_PARA_ABRIR,
+                 segundos_abierto: float = CIRCUITO_SEGUNDOS_ABIERTO):
+        self.nombre = nombre
+        self.sonda = sonda
+        self.fallos_para_abrir = fallos_para_abrir
+        self.segundos_abierto = segundos_abierto
+        self.estado = 'cerrado'
+        self.fallos_consecutivos = 0
+        self._reintentar_en = 0.0
+        self._sondeando = False
+        self._lock = threading.Lock()
+
+    def permitir(self) -> bool:
+        with self._lock:
+            if self.estado == 'cerrado':
+                return True
+            if time.monotonic() >= self._reintentar_en and not self._sondeando:
+                self._sondeando = True
+                threading.Thread(target=self._sondear, name=f'sonda-{self.nombre}', daemon=True).start()
+            return False
+
+    def registrar_exito(self) -> None:
+        with self._lock:
+            self.fallos_consecutivos = 0
+            if self.estado != 'cerrado':
+                logger.info(f"✅ Circuito {self.nombre} cerrado")
+            self.estado = 'cerrado'
+
+    def registrar_fallo(self) -> None:
+        with self._lock:
+            self.fallos_consecutivos += 1
+            if self.estado == 'cerrado' and self.fallos_consecutivos >= self.fallos_para_abrir:
+                self.estado = 'abierto'
+                self._reintentar_en = time.monotonic() + self.segundos_abierto
+                logger.warning(f"⚠️ Circuito {self.nombre} abierto tras {self.fallos_consecutivos} fallos")
+
+    def _sondear(self) -> None:
+        try:
+            recuperada = bool(self.sonda())
+        except Exception as e:
+            logger.debug(f"Sonda {self.nombre} falló: {e}")
+            recuperada = False
+        if recuperada:
+            self.registrar_exito()
+        with self._lock:
+            self._sondeando = False
+            if not recuperada:
+                self._reintentar_en = time.monotonic() + self.segundos_abierto
+
+
+class PresupuestoRequest:
+    """Plazo total de un request y etapas degradadas por falta de tiempo o dependencias caídas"""
+
+    def __init__(self, segundos: float = ANALISIS_PRESUPUESTO_SEGUNDOS, inicio: Optional[float] = None):
+        self.segundos = segundos
+        self.inicio = time.perf_counter() if inicio is None else inicio
+        self.degradaciones: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def restante(self) -> float:
+        return self.segundos - (time.perf_counter() - self.inicio)
+
+    def degradar(self, etapa: str, motivo: str) -> None:
+        with self._lock:
+            if not any(d['etapa'] == etapa for d in self.degradaciones):
+                self.degradaciones.append({'etapa': etapa, 'motivo': motivo,
+                                           'restante_segundos': round(self.restante(), 3)})
+                logger.warning(f"⚠️ Etapa {etapa} degradada: {motivo}")
+
+    def degradada(self, etapa: str) -> bool:
+        return any(d['etapa'] == etapa for d in self.degradaciones)
+
+    def resumen(self) -> Dict[str, Any]:
+        return {
+            'presupuesto_segundos': self.segundos,
+            'consumido_segundos': round(time.perf_counter() - self.inicio, 3),
+            'degradaciones': list(self.degradaciones),
+            'circuitos': {b.nombre: b.estado for b in (BREAKER_KB, BREAKER_FX)}
+        }
+
+
+_PRESUPUESTO_ACTUAL: contextvars.ContextVar = contextvars.ContextVar('presupuesto', default=None)
+
+
+def dependencia_disponible(etapa: str, breaker: Optional[CircuitBreaker] = None) -> bool:
+    """
+    False si la etapa ya se degradó en este request, su circuito está abierto o
+    el presupuesto del request no alcanza (en esos casos queda registrado)
+    """
+    presupuesto = _PRESUPUESTO_ACTUAL.get()
+    if presupuesto is not None and presupuesto.degradada(etapa):
+        return False
+    if breaker is not None and not breaker.permitir():
+        if presupuesto is not None:
+            presupuesto.degradar(etapa, 'circuito_abierto')
+        return False
+    if presupuesto is not None and presupuesto.restante() < PRESUPUESTO_MIN_SEGUNDOS.get(etapa, 0):
+        presupuesto.degradar(etapa, 'presupuesto_agotado')
+        return False
+    return True
+
+
+def timeout_con_presupuesto(timeout: float) -> float:
+    """El timeout de una llamada, recortado a lo que le queda al request"""
+    presupuesto = _PRESUPUESTO_ACTUAL.get()
+    if presupuesto is None:
+        return timeout
+    return max(1.0, min(timeout, presupuesto.restante()))
+
+
+def normalizar_presupuesto(valor: Any) -> float:
+    """parametros.presupuesto_segundos: número > 0 (ValueError si no)"""
+    if valor is None:
+        return ANALISIS_PRESUPUESTO_SEGUNDOS
+    if isinstance(valor, bool) or not isinstance(valor, (int, float)) or valor <= 0:
+        raise ValueError("presupuesto_segundos debe ser un número mayor a 0")
+    return float(valor)
+
+
 # ============================================
 # CLASE PARA COTIZACIONES DE MONEDA
 # ============================================
@@ -193,13 +875,63 @@ class CotizacionDolar:
         usd_amount = api.convertir_a_usd(monto_cop, 'COP')
     """
 
+    # Cache compartida por todas las instancias del proceso: {moneda: (tasa, timestamp)}
+    # Así una instancia precalentada (/api/warmup) no vuelve a consultar la API en cada request
+    _cache_compartida: Dict[str, Tuple[float, float]] = {}
+    TTL_CACHE_SEGUNDOS = int(os.getenv('FX_CACHE_TTL_SEGUNDOS', '3600'))
+
     def __init__(self):
         """Inicializa el gestor de cotizaciones"""
         self.apis = {
             'exchangerate-api': 'https://api.exchangerate-api.com/v4/latest/USD',
             'frankfurter': 'https://api.frankfurter.app/latest?from=USD'
         }
-        self._cache = {}
+        self._cache = CotizacionDolar._cache_compartida
+
+    def _leer_cache(self, moneda: str, vigente: bool = True) -> Optional[float]:
+        """Retorna la tasa cacheada si no ha expirado (con vigente=False, aunque haya expirado)"""
+        entrada = self._cache.get(moneda)
+        if entrada and (not vigente or (time.time() - entrada[1]) < self.TTL_CACHE_SEGUNDOS):
+            return entrada[0]
+        return None
+
+    def _cotizacion_respaldo(self, moneda: str, aproximada: float) -> float:
+        """Sin API: la última cotización cacheada aunque haya vencido, o la aproximada"""
+        vencida = self._leer_cache(moneda, vigente=False)
+        if vencida is None:
+            logger.warning(f"Usando cotización aproximada {moneda}")
+        METRICAS.fx_consultas.inc(moneda=moneda, origen='cache_vencida' if vencida is not None else 'aproximada')
+        return vencida if vencida is not None else aproximada
+
+    def _cotizacion_sin_api(self, moneda: str, aproximada: float) -> Optional[float]:
+        """Respaldo si el circuito FX está abierto o no queda presupuesto; None = se puede llamar a la API"""
+        if dependencia_disponible('fx', BREAKER_FX):
+            return None
+        return self._cotizacion_respaldo(moneda, aproximada)
+
+    def sondear(self) -> bool:
+        """
+        Sonda del circuito FX: consulta la API y renueva COP y MXN en la cache;
+        si falla, alcanza con que responda el respaldo (frankfurter)
+        """
+        try:
+            response = requests.get(self.apis['exchangerate-api'], timeout=FX_TIMEOUT_SEGUNDOS)
+            response.raise_for_status()
+            tasas = response.json()['rates']
+            for moneda in ('COP', 'MXN'):
+                self._guardar_cache(moneda, tasas[moneda])
+            return True
+        except Exception:
+            response = requests.get(self.apis['frankfurter'], timeout=FX_TIMEOUT_SEGUNDOS)
+            response.raise_for_status()
+            tasas = response.json()['rates']
+            for moneda in ('COP', 'MXN'):
+                if moneda in tasas:
+                    self._guardar_cache(moneda, tasas[moneda])
+            return True
+
+    def _guardar_cache(self, moneda: str, cotizacion: float):
+        self._cache[moneda] = (cotizacion, time.time())
 
     def obtener_cotizacion_cop(self) -> float:
         """
@@ -208,30 +940,40 @@ class CotizacionDolar:
         Returns:
             Tasa de cambio USD/COP
         """
-        if 'COP' in self._cache:
-            return self._cache['COP']
+        cacheada = self._leer_cache('COP')
+        if cacheada is not None:
+            METRICAS.fx_consultas.inc(moneda='COP', origen='cache')
+            return cacheada
+        degradada = self._cotizacion_sin_api('COP', 4200.0)
+        if degradada is not None:
+            return degradada
 
         try:
-            response = requests.get(self.apis['exchangerate-api'], timeout=10)
+            response = requests.get(self.apis['exchangerate-api'], timeout=timeout_con_presupuesto(FX_TIMEOUT_SEGUNDOS))
             response.raise_for_status()
             data = response.json()
             cotizacion = data['rates']['COP']
-            self._cache['COP'] = cotizacion
+            self._guardar_cache('COP', cotizacion)
+            BREAKER_FX.registrar_exito()
             logger.info(f"Cotización USD/COP: {cotizacion:,.2f}")
+            METRICAS.fx_consultas.inc(moneda='COP', origen='exchangerate-api')
             return cotizacion
         except Exception as e:
             logger.warning(f"Error obteniendo cotización COP: {str(e)}")
+            # El circuito cuenta un fallo solo si tampoco responde el respaldo
             try:
-                response = requests.get(self.apis['frankfurter'], timeout=10)
+                response = requests.get(self.apis['frankfurter'], timeout=timeout_con_presupuesto(FX_TIMEOUT_SEGUNDOS))
                 data = response.json()
                 if 'COP' in data['rates']:
                     cotizacion = data['rates']['COP']
-                    self._cache['COP'] = cotizacion
+                    self._guardar_cache('COP', cotizacion)
+                    BREAKER_FX.registrar_exito()
+                    METRICAS.fx_consultas.inc(moneda='COP', origen='frankfurter')
                     return cotizacion
             except Exception:
                 pass
-            logger.warning("Usando cotización aproximada COP")
-            return 4200.0
+            BREAKER_FX.registrar_fallo()
+            return self._cotizacion_respaldo('COP', 4200.0)
 
     def obtener_cotizacion_mxn(self) -> float:
         """
@@ -240,21 +982,28 @@ class CotizacionDolar:
         Returns:
             Tasa de cambio USD/MXN
         """
-        if 'MXN' in self._cache:
-            return self._cache['MXN']
+        cacheada = self._leer_cache('MXN')
+        if cacheada is not None:
+            METRICAS.fx_consultas.inc(moneda='MXN', origen='cache')
+            return cacheada
+        degradada = self._cotizacion_sin_api('MXN', 18.0)
+        if degradada is not None:
+            return degradada
 
         try:
-            response = requests.get(self.apis['exchangerate-api'], timeout=10)
+            response = requests.get(self.apis['exchangerate-api'], timeout=timeout_con_presupuesto(FX_TIMEOUT_SEGUNDOS))
             response.raise_for_status()
             data = response.json()
             cotizacion = data['rates']['MXN']
-            self._cache['MXN'] = cotizacion
+            self._guardar_cache('MXN', cotizacion)
+            BREAKER_FX.registrar_exito()
             logger.info(f"Cotización USD/MXN: {cotizacion:,.2f}")
+            METRICAS.fx_consultas.inc(moneda='MXN', origen='exchangerate-api')
             return cotizacion
         except Exception as e:
+            BREAKER_FX.registrar_fallo()
             logger.warning(f"Error obteniendo cotización MXN: {str(e)}")
-            logger.warning("Usando cotización aproximada MXN")
-            return 18.0
+            return self._cotizacion_respaldo('MXN', 18.0)
 
     def convertir_a_usd(self, monto: float, moneda: str) -> float:
         """
@@ -281,6 +1030,27 @@ class CotizacionDolar:
         logger.warning(f"Moneda no soportada: {moneda}")
         return monto
 
+    def precargar_moneda(self, moneda: str) -> None:
+        """Trae a la cache la cotización de una moneda si no está vigente (en segundo plano)"""
+        consultas = {'COP': self.obtener_cotizacion_cop, 'MXN': self.obtener_cotizacion_mxn}
+        if moneda in consultas and self._leer_cache(moneda) is None:
+            consultas[moneda]()
+
+    def precargar(self) -> Dict[str, float]:
+        """
+        Precarga en la cache compartida las cotizaciones soportadas
+
+        Returns:
+            Diccionario {moneda: tasa} con las cotizaciones obtenidas
+        """
+        return {
+            'COP': self.obtener_cotizacion_cop(),
+            'MXN': self.obtener_cotizacion_mxn()
+        }
+
+
+BREAKER_FX = CircuitBreaker('fx', lambda: CotizacionDolar().sondear())
+
 
 # ========================================
 # CONFIGURACIÓN AZURE SQL KNOWLEDGE BASE
@@ -291,24 +1061,78 @@ AZURE_SQL_USER = os.getenv('AZURE_SQL_USER', 'kb_access_agents')
 AZURE_SQL_PASSWORD = os.getenv('AZURE_SQL_PASSWORD', 'PasswordFuerte123!')
 
 
+def _conectar_kb(timeout: int):
+    connection_string = (
+        f'DRIVER={{ODBC Driver 17 for SQL Server}};'
+        f'SERVER={AZURE_SQL_SERVER};'
+        f'DATABASE={AZURE_SQL_DATABASE};'
+        f'UID={AZURE_SQL_USER};'
+        f'PWD={AZURE_SQL_PASSWORD}'
+    )
+    return pyodbc.connect(connection_string, timeout=timeout)
+
+
+def _sondear_kb() -> bool:
+    """Sonda del circuito KB: login con timeout corto"""
+    _conectar_kb(KB_TIMEOUT_SONDA).close()
+    return True
+
+
+BREAKER_KB = CircuitBreaker('kb', _sondear_kb)
+
+
 def get_azure_sql_connection():
-    """Establece conexión a Azure SQL Knowledge Base"""
+    """
+    Establece conexión a Azure SQL Knowledge Base
+
+    None sin esperar el timeout si el circuito KB está abierto, si la KB ya
+    falló en este request o si no queda presupuesto; el login y las consultas
+    se limitan a lo que le queda al request.
+    """
+    if not dependencia_disponible('kb', BREAKER_KB):
+        METRICAS.kb_conexiones.inc(resultado='omitida')
+        return None
     try:
-        connection_string = (
-            f'DRIVER={{ODBC Driver 17 for SQL Server}};'
-            f'SERVER={AZURE_SQL_SERVER};'
-            f'DATABASE={AZURE_SQL_DATABASE};'
-            f'UID={AZURE_SQL_USER};'
-            f'PWD={AZURE_SQL_PASSWORD}'
-        )
-        conn = pyodbc.connect(connection_string, timeout=30)
+        timeout = int(timeout_con_presupuesto(KB_TIMEOUT_CONEXION))
+        conn = _conectar_kb(timeout)
+        presupuesto = _PRESUPUESTO_ACTUAL.get()
+        if presupuesto is not None:
+            # Timeout de consulta: lo que le queda al request
+            conn.timeout = max(1, int(presupuesto.restante()))
         logger.info("✅ Conexión exitosa a Azure SQL Knowledge Base")
-        return conn
+        METRICAS.kb_conexiones.inc(resultado='ok')
+        BREAKER_KB.registrar_exito()
+        return _ConexionKB(conn)
     except Exception as e:
         logger.error(f"❌ Error conectando a Azure SQL: {str(e)}")
+        METRICAS.kb_conexiones.inc(resultado='error')
+        BREAKER_KB.registrar_fallo()
+        # El resto del request no vuelve a esperar el login
+        presupuesto = _PRESUPUESTO_ACTUAL.get()
+        if presupuesto is not None:
+            presupuesto.degradar('kb', 'sin_conexion')
         return None
 
 
+class _ConexionKB:
+    """Envoltura de la conexión pyodbc que lleva la cuenta de conexiones en uso"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._abierta = True
+        METRICAS.conexion_abierta()
+
+    def close(self):
+        if self._abierta:
+            self._abierta = False
+            METRICAS.conexion_cerrada()
+        self._conn.close()
+
+    def __getattr__(self, nombre):
+        return getattr(self._conn, nombre)
+
+
+@etapa_instrumentada('kb.buscar_asegurado')
 def buscar_asegurado_en_kb(nombre_asegurado: str) -> Optional[int]:
     """
     Busca el insured_key del asegurado en consumption.DIM_INSURED
@@ -319,8 +1143,16 @@ def buscar_asegurado_en_kb(nombre_asegurado: str) -> Optional[int]:
     Returns:
         insured_key si se encuentra, None si no existe
     """
+    if SNAPSHOT_KB.vigente():
+        insured_key = SNAPSHOT_KB.buscar_asegurado(nombre_asegurado)
+        if insured_key is not None:
+            logger.info(f"✅ Asegurado encontrado en snapshot KB (insured_key={insured_key})")
+            METRICAS.kb_busquedas.inc(resultado='encontrado')
+            return insured_key
+
     conn = get_azure_sql_connection()
     if not conn:
+        METRICAS.kb_busquedas.inc(resultado='sin_conexion')
         return None
 
     try:
@@ -350,18 +1182,22 @@ def buscar_asegurado_en_kb(nombre_asegurado: str) -> Optional[int]:
             insured_key = row[0]
             insured_name = row[1]
             logger.info(f"✅ Asegurado encontrado en KB: {insured_name} (insured_key={insured_key})")
+            METRICAS.kb_busquedas.inc(resultado='encontrado')
             return insured_key
         else:
             logger.warning(f"⚠️ Asegurado '{nombre_asegurado}' NO encontrado en KB")
+            METRICAS.kb_busquedas.inc(resultado='no_encontrado')
             return None
 
     except Exception as e:
         logger.error(f"❌ Error buscando asegurado: {str(e)}")
+        METRICAS.kb_busquedas.inc(resultado='error')
         return None
     finally:
         conn.close()
 
 
+@etapa_instrumentada('kb.consultar_historico')
 def consultar_historico_siniestros(insured_key: int, años_historico: int = 5) -> pd.DataFrame:
     """
     Consulta histórico de siniestros desde consumption.FACT_CLAIMS
@@ -373,13 +1209,19 @@ def consultar_historico_siniestros(insured_key: int, años_historico: int = 5) -
     Returns:
         DataFrame con siniestros históricos en formato estándar
     """
+    # Calcular fecha límite (YYYYMMDD format)
+    fecha_limite = (datetime.now().year - años_historico) * 10000 + 101  # Ej: 20200101
+
+    if SNAPSHOT_KB.vigente():
+        df = SNAPSHOT_KB.consultar_historico(insured_key, fecha_limite)
+        if df is not None:
+            return _normalizar_historico_kb(df, años_historico, insured_key, origen='snapshot')
+
     conn = get_azure_sql_connection()
     if not conn:
         return pd.DataFrame()
 
     try:
-        # Calcular fecha límite (YYYYMMDD format)
-        fecha_limite = (datetime.now().year - años_historico) * 10000 + 101  # Ej: 20200101
 
         query = """
         SELECT
@@ -403,273 +1245,2877 @@ def consultar_historico_siniestros(insured_key: int, años_historico: int = 5) -
         """
 
         df = pd.read_sql(query, conn, params=(insured_key, fecha_limite))
+        return _normalizar_historico_kb(df, años_historico, insured_key, origen='remota')
+
+    except Exception as e:
+        logger.error(f"❌ Error consultando histórico: {str(e)}")
+        return pd.DataFrame()
+    finally:
+        conn.close()
 
-        if not df.empty:
-            logger.info(f"✅ Histórico KB: {len(df)} siniestros de últimos {años_historico} años")
 
-            # Convertir a formato estándar (USD como base)
-            df['monto_incurrido'] = df['monto_incurrido_usd']
-            df['monto_pagado'] = df['monto_pagado_usd']
-            df['monto_reservado'] = df['monto_reservado_usd']
+# Fecha de corte (YYYYMMDD) de cada foto de FACT_CLAIMS; vacío = sin triángulo desde la KB
+KB_COLUMNA_EVALUACION = os.getenv('KB_COLUMNA_EVALUACION', '')
+KB_TRIANGULO_AÑOS = int(os.getenv('KB_TRIANGULO_AÑOS', '30'))
 
-        else:
-            logger.warning(f"⚠️ No se encontraron siniestros históricos para insured_key={insured_key}")
 
+@etapa_instrumentada('kb.consultar_triangulo')
+def consultar_triangulo_kb(insured_key: int, años_historico: int = KB_TRIANGULO_AÑOS) -> pd.DataFrame:
+    """
+    Triángulo de desarrollo agregado en SQL desde consumption.FACT_CLAIMS
+
+    Usa el último corte de cada año calendario (KB_COLUMNA_EVALUACION) y
+    devuelve una fila por (año de ocurrencia, desarrollo) con incurrido y
+    pagado acumulados en USD; los siniestros no viajan a la función.
+
+    Returns:
+        DataFrame año_ocurrencia, desarrollo, incurrido, pagado, siniestros
+        (vacío si no hay columna de corte configurada o conexión)
+    """
+    columna = KB_COLUMNA_EVALUACION
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', columna):
+        return pd.DataFrame()
+
+    conn = get_azure_sql_connection()
+    if not conn:
+        return pd.DataFrame()
+
+    fecha_limite = (datetime.now().year - años_historico) * 10000 + 101
+    try:
+        query = f"""
+        WITH cortes AS (
+            SELECT MAX(fc.{columna}) AS corte
+            FROM consumption.FACT_CLAIMS fc
+            WHERE fc.insured_key = ?
+            GROUP BY fc.{columna} / 10000
+        )
+        SELECT
+            fc.occurrence_date_key / 10000 AS año_ocurrencia,
+            fc.{columna} / 10000 - fc.occurrence_date_key / 10000 AS desarrollo,
+            SUM(fc.total_incurred_dynamic_usd) AS incurrido,
+            SUM(fc.total_paid_dynamic_usd) AS pagado,
+            COUNT(*) AS siniestros
+        FROM consumption.FACT_CLAIMS fc
+        JOIN cortes c ON fc.{columna} = c.corte
+        WHERE fc.insured_key = ?
+            AND fc.occurrence_date_key >= ?
+            AND fc.{columna} >= fc.occurrence_date_key
+        GROUP BY fc.occurrence_date_key / 10000, fc.{columna} / 10000 - fc.occurrence_date_key / 10000
+        """
+        df = pd.read_sql(query, conn, params=(insured_key, insured_key, fecha_limite))
+        logger.info(f"✅ Triángulo KB: {len(df)} celdas para insured_key={insured_key}")
         return df
 
     except Exception as e:
-        logger.error(f"❌ Error consultando histórico: {str(e)}")
+        logger.error(f"❌ Error consultando triángulo KB: {str(e)}")
         return pd.DataFrame()
     finally:
         conn.close()
 
 
-class AnalizadorTecnico:
-    """Clase principal para el análisis técnico de reaseguros con Knowledge Base"""
+def _normalizar_historico_kb(df: pd.DataFrame, años_historico: int, insured_key: int,
+                             origen: str) -> pd.DataFrame:
+    """Lleva el histórico de la KB (remota o snapshot) al formato estándar"""
+    if not df.empty:
+        logger.info(f"✅ Histórico KB ({origen}): {len(df)} siniestros de últimos {años_historico} años")
+        METRICAS.siniestros.inc(len(df), fuente='kb')
 
-    def __init__(self, asegurado_nombre: Optional[str] = None):
-        self.datos_consolidados = {
-            'siniestralidad': None,
-            'tiv': None,
-            'tiv_total': 0,
-            'slip': {},
-            'asegurado_nombre': asegurado_nombre or 'Desconocido',
-            'insured_key': None,
-            'tiene_historico_kb': False,
-            'archivos_procesados': []
-        }
-        self.api_cotizacion = CotizacionDolar()
-        self.moneda_local = None
-        self.tasa_cambio = None
-        logger.info("Analizador Técnico v3.2 inicializado con API de cotizaciones.")
+        # Convertir a formato estándar (USD como base); la KB entrega DATE y los archivos
+        # datetime64: sin convertir, combinar ambos no se puede ordenar por fecha
+        df['fecha_siniestro'] = pd.to_datetime(df['fecha_siniestro'], errors='coerce')
+        df['monto_incurrido'] = df['monto_incurrido_usd']
+        df['monto_pagado'] = df['monto_pagado_usd']
+        df['monto_reservado'] = df['monto_reservado_usd']
 
-    def cargar_historico_desde_kb(self, años_historico: int = 5) -> bool:
-        """
-        Intenta cargar histórico de siniestros desde Azure SQL KB
+    else:
+        logger.warning(f"⚠️ No se encontraron siniestros históricos para insured_key={insured_key}")
 
-        Returns:
-            True si se encontró y cargó histórico, False si no
-        """
-        asegurado = self.datos_consolidados['asegurado_nombre']
+    df.attrs['origen_kb'] = origen
+    return df
 
-        # Buscar asegurado en KB
-        insured_key = buscar_asegurado_en_kb(asegurado)
 
-        if not insured_key:
-            logger.info("📊 Cliente SIN histórico en KB - análisis solo con archivos")
-            return False
+@etapa_instrumentada('kb.calentar')
+def calentar_kb() -> Dict[str, Any]:
+    """
+    Abre una conexión a la KB y toca consumption.DIM_INSURED
 
-        # Guardar insured_key
-        self.datos_consolidados['insured_key'] = insured_key
+    pyodbc mantiene activo el pooling ODBC por defecto, así que la conexión
+    cerrada queda en el pool del driver y el siguiente request no paga el
+    handshake TLS/login. La consulta además deja compilado el plan en SQL.
 
-        # Consultar siniestros históricos
-        df_historico = consultar_historico_siniestros(insured_key, años_historico)
+    Returns:
+        Diccionario con 'conectado' y el número de filas leídas
+    """
+    conn = get_azure_sql_connection()
+    if not conn:
+        return {'conectado': False}
 
-        if df_historico.empty:
-            logger.info("📊 Asegurado encontrado en KB pero SIN siniestros históricos")
-            return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT TOP 1 insured_key FROM consumption.DIM_INSURED")
+        filas = cursor.fetchall()
+        return {'conectado': True, 'filas': len(filas)}
+    finally:
+        conn.close()
 
-        # Marcar que tiene histórico
-        self.datos_consolidados['tiene_historico_kb'] = True
-        self.datos_consolidados['siniestralidad'] = df_historico
 
-        logger.info(f"✅ Histórico KB cargado: {len(df_historico)} siniestros")
-        return True
+# ============================================
+# SNAPSHOT LOCAL DE LA KNOWLEDGE BASE
+# ============================================
+# Réplica de lectura en SQLite de las columnas que usan buscar_asegurado_en_kb
+# y consultar_historico_siniestros. Se regenera con el timer exportar_snapshot_kb_timer
+# (o en el calentamiento de arranque del worker) y se lee con mmap; la KB remota solo
+# se consulta ante un miss o si el snapshot está vencido.
 
-    def consolidar_siniestralidad(self, archivos_bytes: List[tuple]) -> pd.DataFrame:
-        """
-        Consolida siniestralidad desde archivos Excel
-        Si ya existe histórico de KB, lo combina
-        """
-        try:
-            dataframes = []
+KB_SNAPSHOT_HABILITADO = _env_bool('KB_SNAPSHOT_HABILITADO')
+KB_SNAPSHOT_PATH = os.getenv('KB_SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'kb_snapshot.sqlite'))
+KB_SNAPSHOT_MAX_HORAS = float(os.getenv('KB_SNAPSHOT_MAX_HORAS', '26'))
+KB_SNAPSHOT_AÑOS = int(os.getenv('KB_SNAPSHOT_AÑOS', '6'))
+KB_SNAPSHOT_CRON = os.getenv('KB_SNAPSHOT_CRON', '0 0 3 * * *')
+KB_SNAPSHOT_MMAP_MB = int(os.getenv('KB_SNAPSHOT_MMAP_MB', '256'))
 
-            if not archivos_bytes:
-                logger.warning("No se proporcionaron archivos de siniestralidad.")
-                # Si tenemos histórico de KB, usarlo
-                if self.datos_consolidados.get('tiene_historico_kb'):
-                    return self.datos_consolidados['siniestralidad']
-                else:
-                    self.datos_consolidados['siniestralidad'] = pd.DataFrame()
-                    return pd.DataFrame()
-
-            for filename, archivo in archivos_bytes:
-                # Registrar nombres de archivos procesados para detección de moneda
-                if filename not in self.datos_consolidados['archivos_procesados']:
-                    self.datos_consolidados['archivos_procesados'].append(filename)
+COLUMNAS_SNAPSHOT_SINIESTROS = [
+    'num_poliza', 'occurrence_date_key', 'monto_pagado_cop', 'monto_reservado_usd',
+    'monto_incurrido_usd', 'monto_pagado_usd', 'causa_siniestro', 'estado', 'salvamento', 'subrogacion'
+]
 
-                df = None
 
-                # Intentar leer como Excel con hoja GRUPO I
-                try:
-                    excel_file = pd.ExcelFile(io.BytesIO(archivo))
-                    if 'GRUPO I' in excel_file.sheet_names:
-                        logger.info(f"Archivo {filename}: Detectada hoja GRUPO I")
-                        df = pd.read_excel(io.BytesIO(archivo), sheet_name='GRUPO I', header=1)
-
-                        # Filtrar solo TRDM
-                        if 'Nom. Procucto' in df.columns:
-                            df = df[df['Nom. Procucto'].str.contains('TODO RIESGO', case=False, na=False)].copy()
-                            logger.info(f"Filtrados registros TRDM: {len(df)}")
-
-                        # Mapear columnas
-                        if 'Fec. Sini' in df.columns:
-                            df['fecha_siniestro'] = pd.to_datetime(df['Fec. Sini'], errors='coerce')
-                        if 'Liquidado' in df.columns:
-                            df['monto_pagado'] = pd.to_numeric(df['Liquidado'], errors='coerce').fillna(0)
-                        if 'Rva. Actual' in df.columns:
-                            df['monto_reservado'] = pd.to_numeric(df['Rva. Actual'], errors='coerce').fillna(0)
-                        if 'Total Incurrido' in df.columns:
-                            df['monto_incurrido'] = pd.to_numeric(df['Total Incurrido'], errors='coerce').fillna(0)
-                        else:
-                            df['monto_incurrido'] = df['monto_pagado'] + df['monto_reservado']
-
-                        # Mapear causa del siniestro desde Nom. Exp.
-                        if 'Nom. Exp.' in df.columns:
-                            df['causa_siniestro'] = df['Nom. Exp.']
-                        else:
-                            df['causa_siniestro'] = 'No especificada'
-
-                    # ============================================
-                    # LA COSTEÑA - SINIESTROS
-                    # ============================================
-                    elif es_formato_la_costena_siniestros(archivo, filename):
-                        logger.info(f"Procesando archivo La Costeña - Siniestros: {filename}")
-
-                        df = pd.read_excel(io.BytesIO(archivo), sheet_name='SIN_AGOSTO', header=8)
-                        df = df.dropna(how='all')
-                        df = df[df['SINIESTRO'].notna()].copy()
-
-                        logger.info(f"Total registros La Costeña: {len(df)}")
-
-                        if len(df) < 3:
-                            logger.warning(f"CRÍTICO: Solo {len(df)} siniestro(s) - Muestra insuficiente")
-
-                        df_mapped = pd.DataFrame()
-                        df_mapped['numero_siniestro'] = df['SINIESTRO'].astype(str)
-                        df_mapped['causa_siniestro'] = df['DESCRIPCIÓN']
-
-                        if len(df.columns) > 2:
-                            df_mapped['subcategoria'] = df.iloc[:, 2]
-
-                        df_mapped['fecha_siniestro'] = pd.to_datetime(df['fechasin'], errors='coerce')
-                        df_mapped['monto_incurrido'] = pd.to_numeric(df['PERDIDA'], errors='coerce').fillna(0)
-                        df_mapped['monto_pagado'] = pd.to_numeric(df['SINPAGADO'], errors='coerce').fillna(0)
-
-                        if 'RESERVA_INDEMNIZA' in df.columns and 'RESERVA_GASTOS' in df.columns:
-                            reserva_indem = pd.to_numeric(df['RESERVA_INDEMNIZA'], errors='coerce').fillna(0)
-                            reserva_gastos = pd.to_numeric(df['RESERVA_GASTOS'], errors='coerce').fillna(0)
-                            df_mapped['monto_reservado'] = reserva_indem + reserva_gastos
-                        else:
-                            df_mapped['monto_reservado'] = (df_mapped['monto_incurrido'] - df_mapped['monto_pagado']).clip(lower=0)
-
-                        df = df_mapped
-                        logger.info(f"Siniestros La Costeña mapeados: {len(df)} registros")
-
-                    # ============================================
-                    # CONAGUA - SINIESTROS
-                    # ============================================
-                    elif es_formato_conagua_siniestros(archivo, filename):
-                        logger.info(f"Procesando archivo CONAGUA - Siniestros: {filename}")
-
-                        df = pd.read_excel(io.BytesIO(archivo), sheet_name='Detail', header=1)
-                        df = df.dropna(how='all')
-                        df = df[df['Fecha Ocurrencia '].notna()].copy()
-
-                        logger.info(f"Total registros CONAGUA: {len(df)}")
-
-                        df_mapped = pd.DataFrame()
-                        df_mapped['fecha_siniestro'] = pd.to_datetime(df['Fecha Ocurrencia '], errors='coerce')
-                        df_mapped['causa_siniestro'] = df['Causa']
-                        df_mapped['monto_pagado'] = pd.to_numeric(df['Pérdida Pagada Neta'], errors='coerce').fillna(0)
-                        df_mapped['monto_reservado'] = pd.to_numeric(df['Reserva Bruta'], errors='coerce').fillna(0)
-                        df_mapped['monto_incurrido'] = df_mapped['monto_pagado'] + df_mapped['monto_reservado']
-
-                        if 'Cat / No Cat' in df.columns:
-                            df_mapped['es_catastrofico'] = df['Cat / No Cat']
-
-                        df = df_mapped
-                        logger.info(f"Siniestros CONAGUA mapeados: {len(df)} registros")
+def escribir_snapshot_kb(ruta: str, asegurados, siniestros, fecha_limite: int) -> Dict[str, Any]:
+    """
+    Escribe un snapshot completo y lo publica con un reemplazo atómico
 
-                    else:
-                        df = pd.read_excel(io.BytesIO(archivo), engine='openpyxl')
-                        df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
+    Args:
+        ruta: Archivo SQLite destino
+        asegurados: DataFrame (o iterable de DataFrames) con las columnas de DIM_INSURED
+        siniestros: DataFrame (o iterable de DataFrames) con insured_key + COLUMNAS_SNAPSHOT_SINIESTROS
+        fecha_limite: occurrence_date_key mínimo incluido (YYYYMMDD)
 
-                except Exception:
-                    # Intentar CSV
-                    for encoding in ['utf-8', 'latin-1']:
-                        try:
-                            df = pd.read_csv(io.BytesIO(archivo), encoding=encoding, delimiter=';')
-                            df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
-                            break
-                        except Exception:
-                            continue
-
-                if df is None:
-                    logger.error(f"No se pudo procesar {filename}")
-                    continue
+    Returns:
+        Marca de agua del snapshot escrito
+    """
+    directorio = os.path.dirname(os.path.abspath(ruta))
+    os.makedirs(directorio, exist_ok=True)
+    fd, temporal = tempfile.mkstemp(prefix='.kb_snapshot_', suffix='.sqlite', dir=directorio)
+    os.close(fd)
 
-                if 'fecha_siniestro' not in df.columns or 'monto_incurrido' not in df.columns:
-                    logger.warning(f"Archivo {filename} no tiene columnas esperadas.")
-                    continue
+    filas = {'asegurados': 0, 'siniestros': 0}
+    try:
+        with closing(sqlite3.connect(temporal)) as conn:
+            for tabla, datos in (('asegurados', asegurados), ('siniestros', siniestros)):
+                bloques = [datos] if isinstance(datos, pd.DataFrame) else datos
+                for bloque in bloques:
+                    bloque.to_sql(tabla, conn, if_exists='append', index=False)
+                    filas[tabla] += len(bloque)
+            conn.execute("CREATE INDEX ix_siniestros_insured ON siniestros (insured_key, occurrence_date_key)")
+            conn.execute("CREATE TABLE metadata (clave TEXT PRIMARY KEY, valor TEXT)")
+            marca = {
+                'generado_en': datetime.now().isoformat(timespec='seconds'),
+                'fecha_limite': fecha_limite,
+                'asegurados': filas['asegurados'],
+                'siniestros': filas['siniestros']
+            }
+            conn.executemany("INSERT INTO metadata VALUES (?, ?)", [(k, str(v)) for k, v in marca.items()])
+            conn.commit()
+        os.replace(temporal, ruta)
+    except Exception:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+    logger.info(f"📦 Snapshot KB escrito en {ruta}: {filas['asegurados']} asegurados, "
+                f"{filas['siniestros']} siniestros")
+    return marca
 
-                # Agregar año si no existe
-                if 'año' not in df.columns and 'fecha_siniestro' in df.columns:
-                    df['año'] = pd.to_datetime(df['fecha_siniestro'], errors='coerce').dt.year
 
-                dataframes.append(df)
+@etapa_instrumentada('kb.exportar_snapshot')
+def exportar_snapshot_kb(ruta: Optional[str] = None, años: int = KB_SNAPSHOT_AÑOS) -> Dict[str, Any]:
+    """
+    Exporta DIM_INSURED y los últimos `años` de FACT_CLAIMS al snapshot local
+
+    Returns:
+        Marca de agua del snapshot, o {'exportado': False} si no hay conexión
+    """
+    conn = get_azure_sql_connection()
+    if not conn:
+        return {'exportado': False}
 
-            if not dataframes:
-                logger.warning("No se procesaron archivos válidos.")
-                # Si tenemos histórico de KB, usarlo
-                if self.datos_consolidados.get('tiene_historico_kb'):
-                    return self.datos_consolidados['siniestralidad']
-                else:
-                    self.datos_consolidados['siniestralidad'] = pd.DataFrame()
-                    return pd.DataFrame()
+    fecha_limite = (datetime.now().year - años) * 10000 + 101
+    try:
+        asegurados = pd.read_sql(
+            "SELECT insured_key, insured_name, insured_short_name, cedant_name, country "
+            "FROM consumption.DIM_INSURED", conn)
+        siniestros = pd.read_sql("""
+        SELECT
+            fc.insured_key,
+            fc.claim_reference_dynamic AS num_poliza,
+            fc.occurrence_date_key,
+            fc.loss_paid_dynamic_oc AS monto_pagado_cop,
+            fc.net_reserve_dynamic_usd AS monto_reservado_usd,
+            fc.total_incurred_dynamic_usd AS monto_incurrido_usd,
+            fc.total_paid_dynamic_usd AS monto_pagado_usd,
+            fc.loss_cause_summary AS causa_siniestro,
+            fc.claim_status AS estado,
+            fc.salvage_recovery_oc AS salvamento,
+            fc.subrogation_recovery_oc AS subrogacion
+        FROM consumption.FACT_CLAIMS fc
+        WHERE fc.occurrence_date_key >= ?
+        """, conn, params=(fecha_limite,), chunksize=50000)
 
-            df_consolidado = pd.concat(dataframes, ignore_index=True)
+        marca = escribir_snapshot_kb(ruta or SNAPSHOT_KB.ruta, asegurados, siniestros, fecha_limite)
+        return {'exportado': True, **marca}
+    finally:
+        conn.close()
 
-            # Si tenemos histórico de KB, combinarlo
-            if self.datos_consolidados.get('tiene_historico_kb'):
-                df_kb = self.datos_consolidados['siniestralidad']
-                logger.info(f"📊 Combinando: {len(df_consolidado)} siniestros archivo + {len(df_kb)} KB")
-                df_consolidado = pd.concat([df_consolidado, df_kb], ignore_index=True)
 
-            # Limpieza y normalización
-            df_consolidado = df_consolidado[df_consolidado['monto_incurrido'] > 0].copy()
-            df_consolidado = df_consolidado.sort_values('fecha_siniestro', ascending=False).reset_index(drop=True)
+class SnapshotKB:
+    """
+    Lector del snapshot SQLite de la KB
 
-            self.datos_consolidados['siniestralidad'] = df_consolidado
-            logger.info(f"✅ Siniestralidad consolidada: {len(df_consolidado)} registros")
-            return df_consolidado
+    Cada hilo abre su propia conexión de solo lectura con mmap; si el archivo
+    se reemplaza (nuevo export) la conexión se reabre en la siguiente consulta.
+    """
 
-        except Exception as e:
-            logger.exception(f"Error consolidando siniestralidad: {str(e)}")
-            if self.datos_consolidados.get('tiene_historico_kb'):
-                return self.datos_consolidados['siniestralidad']
-            else:
-                self.datos_consolidados['siniestralidad'] = pd.DataFrame()
-                return pd.DataFrame()
+    def __init__(self, ruta: str, max_horas: float = KB_SNAPSHOT_MAX_HORAS, habilitado: bool = True):
+        self.ruta = ruta
+        self.max_horas = max_horas
+        self.habilitado = habilitado
+        self._local = threading.local()
 
-    def procesar_tiv(self, archivo_bytes: bytes, filename: str) -> pd.DataFrame:
-        """Procesa el archivo TIV con múltiples estrategias de extracción"""
+    def _conexion(self) -> Optional[sqlite3.Connection]:
+        try:
+            firma = os.stat(self.ruta).st_mtime_ns
+        except OSError:
+            return None
+
+        local = self._local
+        if getattr(local, 'firma', None) != firma:
+            if getattr(local, 'conn', None) is not None:
+                local.conn.close()
+            conn = sqlite3.connect(f'file:{self.ruta}?mode=ro', uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {KB_SNAPSHOT_MMAP_MB * 1024 * 1024}")
+            local.conn = conn
+            local.firma = firma
+            local.marca = dict(conn.execute("SELECT clave, valor FROM metadata").fetchall())
+        return local.conn
+
+    def marca_agua(self) -> Optional[Dict[str, Any]]:
+        """generado_en, edad_horas y vigencia del snapshot, o None si no existe"""
+        if not self.habilitado:
+            return None
+        try:
+            if self._conexion() is None:
+                return None
+            marca = self._local.marca
+            generado_en = datetime.fromisoformat(marca['generado_en'])
+        except (sqlite3.Error, KeyError, ValueError) as e:
+            logger.warning(f"⚠️ Snapshot KB ilegible ({self.ruta}): {e}")
+            return None
+
+        edad_horas = (datetime.now() - generado_en).total_seconds() / 3600
+        return {
+            'generado_en': marca['generado_en'],
+            'edad_horas': round(edad_horas, 2),
+            'vigente': edad_horas <= self.max_horas,
+            'fecha_limite': int(marca['fecha_limite']),
+            'siniestros': int(marca['siniestros'])
+        }
+
+    def vigente(self) -> bool:
+        marca = self.marca_agua()
+        if marca is None:
+            return False
+        if not marca['vigente']:
+            METRICAS.kb_snapshot.inc(operacion='vigencia', resultado='vencido')
+        return marca['vigente']
+
+    def buscar_asegurado(self, nombre_asegurado: str) -> Optional[int]:
+        """Misma búsqueda que DIM_INSURED remota; None ante miss"""
+        patron = f'%{nombre_asegurado}%'
+        fila = self._conexion().execute(
+            "SELECT insured_key FROM asegurados "
+            "WHERE insured_name LIKE ? OR insured_short_name LIKE ? OR cedant_name LIKE ? "
+            "ORDER BY insured_key DESC LIMIT 1", (patron, patron, patron)).fetchone()
+        METRICAS.kb_snapshot.inc(operacion='buscar_asegurado', resultado='hit' if fila else 'miss')
+        return int(fila[0]) if fila else None
+
+    def consultar_historico(self, insured_key: int, fecha_limite: int) -> Optional[pd.DataFrame]:
+        """
+        Histórico con las columnas de consultar_historico_siniestros
+
+        Returns:
+            DataFrame (vacío si el asegurado no tiene siniestros), o None si el
+            snapshot no cubre el período pedido
+        """
+        conn = self._conexion()
+        if fecha_limite < int(self._local.marca['fecha_limite']):
+            METRICAS.kb_snapshot.inc(operacion='consultar_historico', resultado='miss')
+            return None
+
+        df = pd.read_sql(
+            f"SELECT {', '.join(COLUMNAS_SNAPSHOT_SINIESTROS)} FROM siniestros "
+            "WHERE insured_key = ? AND occurrence_date_key >= ? ORDER BY occurrence_date_key DESC",
+            conn, params=(insured_key, fecha_limite))
+        fechas = pd.to_datetime(df['occurrence_date_key'].astype(str), format='%Y%m%d')
+        df['año'] = fechas.dt.year
+        df['mes'] = fechas.dt.month
+        df['fecha_siniestro'] = fechas.dt.date
+        METRICAS.kb_snapshot.inc(operacion='consultar_historico', resultado='hit')
+        return df
+
+    def preparar(self, exportar: bool = False) -> Dict[str, Any]:
+        """
+        Carga el snapshot existente - usado por el warm-up
+
+        Args:
+            exportar: Exportarlo si falta o está vencido (solo el calentamiento de
+                arranque; /api/warmup es anónimo y no dispara exports de FACT_CLAIMS)
+        """
+        if not self.habilitado:
+            return {'habilitado': False}
+        marca = self.marca_agua()
+        if marca is None and not exportar:
+            return {'conectado': False, 'marca_agua': None}
+        if exportar and (marca is None or not marca['vigente']):
+            resultado = exportar_snapshot_kb(self.ruta)
+            if not resultado.get('exportado'):
+                return {'conectado': False, 'marca_agua': marca}
+            marca = self.marca_agua()
+        # Tocar las páginas del índice para dejarlas en el page cache
+        self._conexion().execute("SELECT COUNT(*) FROM siniestros INDEXED BY ix_siniestros_insured").fetchone()
+        return {'conectado': True, 'marca_agua': marca}
+
+
+SNAPSHOT_KB = SnapshotKB(KB_SNAPSHOT_PATH, KB_SNAPSHOT_MAX_HORAS, KB_SNAPSHOT_HABILITADO)
+
+
+# ============================================
+# RESÚMENES MATERIALIZADOS POR ASEGURADO
+# ============================================
+# Conteos e incurrido por año, desglose por peril, severidad p95 / máxima y
+# reservas de cada insured_key de FACT_CLAIMS, agregados en SQL por el timer
+# materializar_resumenes_kb_timer y guardados en un SQLite local con clave
+# primaria por asegurado. Con parametros.historico_kb = 'resumen' la
+# renovación lee esas filas en lugar de traer los siniestros de la KB.
+# Con KB_COLUMNA_MODIFICACION el refresco es incremental: solo se vuelven a
+# agregar los asegurados con siniestros modificados después de la marca de agua.
+
+KB_RESUMENES_HABILITADO = _env_bool('KB_RESUMENES_HABILITADO')
+KB_RESUMENES_PATH = os.getenv('KB_RESUMENES_PATH', os.path.join(tempfile.gettempdir(), 'kb_resumenes.sqlite'))
+KB_RESUMENES_MAX_HORAS = float(os.getenv('KB_RESUMENES_MAX_HORAS', '26'))
+KB_RESUMENES_AÑOS = int(os.getenv('KB_RESUMENES_AÑOS', '5'))
+KB_RESUMENES_CRON = os.getenv('KB_RESUMENES_CRON', '0 30 3 * * *')
+# Columna de FACT_CLAIMS con la última modificación de cada fila; vacío = refresco completo
+KB_COLUMNA_MODIFICACION = os.getenv('KB_COLUMNA_MODIFICACION', '')
+HISTORICO_KB_MODOS = ('detalle', 'resumen')
+
+ESQUEMA_RESUMENES_KB = [
+    """CREATE TABLE IF NOT EXISTS resumen_asegurado (
+        insured_key INTEGER PRIMARY KEY, n_siniestros INTEGER, incurrido_usd REAL, pagado_usd REAL,
+        reservado_usd REAL, severidad_p95_usd REAL, severidad_maxima_usd REAL)""",
+    """CREATE TABLE IF NOT EXISTS resumen_anual (
+        insured_key INTEGER, año INTEGER, n_siniestros INTEGER, incurrido_usd REAL, pagado_usd REAL,
+        reservado_usd REAL, PRIMARY KEY (insured_key, año))""",
+    """CREATE TABLE IF NOT EXISTS resumen_peril (
+        insured_key INTEGER, peril_categoria TEXT, n_siniestros INTEGER, incurrido_usd REAL,
+        PRIMARY KEY (insured_key, peril_categoria))""",
+    "CREATE TABLE IF NOT EXISTS metadata (clave TEXT PRIMARY KEY, valor TEXT)"
+]
+
+
+def normalizar_historico_kb(valor: Any) -> str:
+    """parametros.historico_kb: 'detalle' (default) o 'resumen' (ValueError si no)"""
+    modo = 'detalle' if valor is None else str(valor).strip().lower()
+    if modo not in HISTORICO_KB_MODOS:
+        raise ValueError(f"historico_kb debe ser uno de {list(HISTORICO_KB_MODOS)}")
+    return modo
+
+
+def agregar_resumenes_kb(agregados: pd.DataFrame, severidades: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    Tablas del store a partir de los agregados SQL
+
+    Args:
+        agregados: Una fila por (insured_key, año, causa_siniestro) con n_siniestros,
+            incurrido_usd, pagado_usd, reservado_usd y severidad_maxima_usd
+        severidades: insured_key, severidad_p95_usd
+
+    Returns:
+        Diccionario tabla -> DataFrame (resumen_asegurado, resumen_anual, resumen_peril)
+    """
+    montos = ['n_siniestros', 'incurrido_usd', 'pagado_usd', 'reservado_usd']
+    agregados = agregados.copy()
+    causas = agregados['causa_siniestro'].fillna('').astype(str)
+    agregados['peril_categoria'] = causas.map({causa: clasificar_peril(causa)[0] for causa in causas.unique()})
+
+    anual = agregados.groupby(['insured_key', 'año'], as_index=False)[montos].sum()
+    peril = agregados.groupby(['insured_key', 'peril_categoria'], as_index=False)[['n_siniestros', 'incurrido_usd']].sum()
+    asegurado = agregados.groupby('insured_key', as_index=False).agg(
+        n_siniestros=('n_siniestros', 'sum'), incurrido_usd=('incurrido_usd', 'sum'),
+        pagado_usd=('pagado_usd', 'sum'), reservado_usd=('reservado_usd', 'sum'),
+        severidad_maxima_usd=('severidad_maxima_usd', 'max'))
+    asegurado = asegurado.merge(severidades[['insured_key', 'severidad_p95_usd']], on='insured_key', how='left')
+
+    return {
+        'resumen_asegurado': asegurado[['insured_key', 'n_siniestros', 'incurrido_usd', 'pagado_usd', 'reservado_usd',
+                                        'severidad_p95_usd', 'severidad_maxima_usd']],
+        'resumen_anual': anual,
+        'resumen_peril': peril
+    }
+
+
+def escribir_resumenes_kb(ruta: str, tablas: Dict[str, pd.DataFrame], marca: Dict[str, Any],
+                          claves: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    Escribe el store de resúmenes y lo publica con un reemplazo atómico
+
+    Args:
+        ruta: Archivo SQLite destino
+        tablas: Salida de agregar_resumenes_kb
+        marca: Metadata a registrar (fecha_limite, marca_modificacion)
+        claves: Asegurados re-agregados en un refresco incremental (se parte del
+            store actual y solo se reemplazan sus filas); None = refresco completo
+
+    Returns:
+        Marca de agua del store escrito
+    """
+    directorio = os.path.dirname(os.path.abspath(ruta))
+    os.makedirs(directorio, exist_ok=True)
+    fd, temporal = tempfile.mkstemp(prefix='.kb_resumenes_', suffix='.sqlite', dir=directorio)
+    os.close(fd)
+
+    try:
+        with closing(sqlite3.connect(temporal)) as conn:
+            if claves is not None and os.path.exists(ruta):
+                with closing(sqlite3.connect(ruta)) as actual:
+                    actual.backup(conn)
+            for sentencia in ESQUEMA_RESUMENES_KB:
+                conn.execute(sentencia)
+            for tabla, df in tablas.items():
+                if claves is not None:
+                    conn.executemany(f"DELETE FROM {tabla} WHERE insured_key = ?", [(int(k),) for k in claves])
+                df.to_sql(tabla, conn, if_exists='append', index=False)
+
+            asegurados, siniestros = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(n_siniestros), 0) FROM resumen_asegurado").fetchone()
+            marca = {
+                **marca,
+                'generado_en': datetime.now().isoformat(timespec='seconds'),
+                'asegurados': asegurados,
+                'siniestros': siniestros,
+                'refresco': 'incremental' if claves is not None else 'completo'
+            }
+            conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", [(k, str(v)) for k, v in marca.items()])
+            conn.commit()
+        os.replace(temporal, ruta)
+    except Exception:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+    logger.info(f"📦 Resúmenes KB ({marca['refresco']}) escritos en {ruta}: {asegurados} asegurados, "
+                f"{siniestros} siniestros")
+    return marca
+
+
+def _marca_modificacion_a_texto(valor: Any) -> Optional[str]:
+    """
+    Marca de agua como ISO con milisegundos: DATETIME de SQL Server no acepta más
+    de 3 decimales al convertir texto. Trunca (no redondea), así que en el peor
+    caso un refresco vuelve a agregar filas del mismo milisegundo.
+    """
+    if valor is None or pd.isna(valor):
+        return None
+    return pd.Timestamp(valor).floor('ms').to_pydatetime().isoformat(timespec='milliseconds')
+
+
+def _metadata_resumenes(ruta: str) -> Dict[str, str]:
+    """Metadata del store actual ({} si no existe o está ilegible)"""
+    if not os.path.exists(ruta):
+        return {}
+    try:
+        with closing(sqlite3.connect(f'file:{ruta}?mode=ro', uri=True)) as conn:
+            return dict(conn.execute("SELECT clave, valor FROM metadata").fetchall())
+    except sqlite3.Error:
+        return {}
+
+
+@etapa_instrumentada('kb.materializar_resumenes')
+def materializar_resumenes_kb(ruta: Optional[str] = None, años: int = KB_RESUMENES_AÑOS) -> Dict[str, Any]:
+    """
+    Agrega en SQL los últimos `años` de FACT_CLAIMS por asegurado y actualiza el store
+
+    Returns:
+        Marca de agua del store, o {'materializado': False} si no hay conexión
+    """
+    ruta = ruta or RESUMENES_KB.ruta
+    conn = get_azure_sql_connection()
+    if not conn:
+        return {'materializado': False}
+
+    fecha_limite = (datetime.now().year - años) * 10000 + 101
+    columna = KB_COLUMNA_MODIFICACION if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', KB_COLUMNA_MODIFICACION) else ''
+    previa = _metadata_resumenes(ruta)
+    # Incremental solo si el store cubre la misma ventana (cambia cada 1 de enero)
+    marca_previa = previa.get('marca_modificacion') \
+        if columna and previa.get('fecha_limite') == str(fecha_limite) else None
+    if marca_previa:
+        # Se bindea como datetime: el texto guardado por un store anterior puede traer 6+ decimales
+        marca_previa = pd.Timestamp(marca_previa).floor('ms').to_pydatetime()
+
+    try:
+        marca_nueva = None
+        if columna:
+            marca_nueva = _marca_modificacion_a_texto(pd.read_sql(
+                f"SELECT MAX(fc.{columna}) AS marca FROM consumption.FACT_CLAIMS fc", conn)['marca'].iloc[0])
+
+        filtro, params, claves = '', [fecha_limite], None
+        if marca_previa:
+            filtro = (f"AND fc.insured_key IN (SELECT m.insured_key FROM consumption.FACT_CLAIMS m "
+                      f"WHERE m.{columna} > ?)")
+            params.append(marca_previa)
+            claves = pd.read_sql(
+                f"SELECT DISTINCT fc.insured_key FROM consumption.FACT_CLAIMS fc WHERE fc.{columna} > ?",
+                conn, params=(marca_previa,))['insured_key'].tolist()
+
+        agregados = pd.read_sql(f"""
+        SELECT
+            fc.insured_key,
+            fc.occurrence_date_key / 10000 AS año,
+            fc.loss_cause_summary AS causa_siniestro,
+            COUNT(*) AS n_siniestros,
+            SUM(fc.total_incurred_dynamic_usd) AS incurrido_usd,
+            SUM(fc.total_paid_dynamic_usd) AS pagado_usd,
+            SUM(fc.net_reserve_dynamic_usd) AS reservado_usd,
+            MAX(fc.total_incurred_dynamic_usd) AS severidad_maxima_usd
+        FROM consumption.FACT_CLAIMS fc
+        WHERE fc.occurrence_date_key >= ? {filtro}
+        GROUP BY fc.insured_key, fc.occurrence_date_key / 10000, fc.loss_cause_summary
+        """, conn, params=params)
+        severidades = pd.read_sql(f"""
+        SELECT DISTINCT
+            fc.insured_key,
+            PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY fc.total_incurred_dynamic_usd)
+                OVER (PARTITION BY fc.insured_key) AS severidad_p95_usd
+        FROM consumption.FACT_CLAIMS fc
+        WHERE fc.occurrence_date_key >= ? {filtro}
+        """, conn, params=params)
+
+        marca = {'fecha_limite': fecha_limite}
+        if marca_nueva is not None:
+            marca['marca_modificacion'] = marca_nueva
+        marca = escribir_resumenes_kb(ruta, agregar_resumenes_kb(agregados, severidades), marca, claves)
+        return {'materializado': True, **marca}
+    finally:
+        conn.close()
+
+
+class ResumenesKB(SnapshotKB):
+    """
+    Lector del store de resúmenes por asegurado
+
+    Misma apertura por hilo con mmap, reapertura ante un nuevo archivo y
+    vigencia por antigüedad que el snapshot de la KB.
+    """
+
+    def obtener(self, insured_key: int, años_historico: int) -> Optional[Dict[str, Any]]:
+        """
+        Resumen del asegurado (en USD), o None si el store no está vigente o
+        cubre otra ventana de años (se carga el detalle de la KB)
+        """
+        if not self.vigente():
+            return None
+        conn = self._conexion()
+        marca = self._local.marca
+        fecha_limite = (datetime.now().year - años_historico) * 10000 + 101
+        if int(marca['fecha_limite']) != fecha_limite:
+            METRICAS.kb_snapshot.inc(operacion='resumen_asegurado', resultado='miss')
+            return None
+
+        fila = conn.execute(
+            "SELECT n_siniestros, incurrido_usd, pagado_usd, reservado_usd, severidad_p95_usd, severidad_maxima_usd "
+            "FROM resumen_asegurado WHERE insured_key = ?", (insured_key,)).fetchone()
+        anual = conn.execute(
+            "SELECT año, n_siniestros, incurrido_usd, pagado_usd, reservado_usd FROM resumen_anual "
+            "WHERE insured_key = ? ORDER BY año", (insured_key,)).fetchall()
+        perils = conn.execute(
+            "SELECT peril_categoria, n_siniestros, incurrido_usd FROM resumen_peril "
+            "WHERE insured_key = ? ORDER BY incurrido_usd DESC", (insured_key,)).fetchall()
+        METRICAS.kb_snapshot.inc(operacion='resumen_asegurado', resultado='hit')
+
+        n_siniestros, incurrido, pagado, reservado, p95, maxima = fila or (0, 0.0, 0.0, 0.0, None, None)
+        return {
+            'insured_key': insured_key,
+            'desde_año': fecha_limite // 10000,
+            'n_siniestros': int(n_siniestros),
+            'incurrido_total_usd': round(incurrido, 2),
+            'pagado_total_usd': round(pagado, 2),
+            'reservado_total_usd': round(reservado, 2),
+            'ratio_reservas': round(reservado / incurrido, 4) if incurrido else None,
+            'severidad_promedio_usd': round(incurrido / n_siniestros, 2) if n_siniestros else None,
+            'severidad_p95_usd': round(p95, 2) if p95 is not None else None,
+            'severidad_maxima_usd': round(maxima, 2) if maxima is not None else None,
+            'por_anio': [
+                {'año': int(año), 'n_siniestros': int(n), 'incurrido_usd': round(inc, 2), 'pagado_usd': round(pag, 2),
+                 'reservado_usd': round(res, 2), 'ratio_reservas': round(res / inc, 4) if inc else None}
+                for año, n, inc, pag, res in anual
+            ],
+            'por_peril': [
+                {'peril_categoria': peril, 'n_siniestros': int(n), 'incurrido_usd': round(inc, 2),
+                 'participacion': round(inc / incurrido, 4) if incurrido else None}
+                for peril, n, inc in perils
+            ],
+            'generado_en': marca['generado_en']
+        }
+
+    def preparar(self, exportar: bool = False) -> Dict[str, Any]:
+        """Abre el store existente (y lo materializa si falta o venció cuando exportar=True)"""
+        if not self.habilitado:
+            return {'habilitado': False}
+        marca = self.marca_agua()
+        if marca is None and not exportar:
+            return {'conectado': False, 'marca_agua': None}
+        if exportar and (marca is None or not marca['vigente']):
+            resultado = materializar_resumenes_kb(self.ruta)
+            if not resultado.get('materializado'):
+                return {'conectado': False, 'marca_agua': marca}
+            marca = self.marca_agua()
+        return {'conectado': True, 'marca_agua': marca}
+
+
+RESUMENES_KB = ResumenesKB(KB_RESUMENES_PATH, KB_RESUMENES_MAX_HORAS, KB_RESUMENES_HABILITADO)
+
+
+# ============================================
+# DETECCIÓN DE CONTENIDO Y LECTURA RÁPIDA DE CSV
+# ============================================
+
+FIRMA_ZIP = b'PK\x03\x04'                           # .xlsx / .xlsm (OOXML)
+FIRMA_OLE2 = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'    # .xls (BIFF)
+BOM_UTF8 = b'\xef\xbb\xbf'
+BYTES_MUESTRA_CSV = 64 * 1024
+DELIMITADORES_CSV = ';,\t|'
+
+# Columnas que el pipeline usa de un archivo de siniestros (nombres normalizados)
+COLUMNAS_ESTANDAR_SINIESTROS = {
+    'fecha_siniestro', 'monto_incurrido', 'monto_pagado', 'monto_reservado', 'causa_siniestro',
+    'año', 'mes', 'estado', 'num_poliza', 'numero_siniestro', 'subcategoria', 'es_catastrofico',
+    'id_ubicacion', 'codigo_ubicacion', 'ubicacion'
+}
+
+
+def normalizar_columna(nombre: Any) -> str:
+    """Misma normalización que columns.str.strip().str.lower().str.replace(' ', '_')"""
+    return str(nombre).strip().lower().replace(' ', '_')
+
+
+def detectar_tipo_contenido(archivo: bytes) -> str:
+    """
+    Identifica el tipo de archivo por sus magic bytes (sin confiar en la extensión)
+
+    Returns:
+        'xlsx', 'xls', 'csv' (texto) o 'binario'
+    """
+    if archivo.startswith(FIRMA_ZIP):
+        return 'xlsx'
+    if archivo.startswith(FIRMA_OLE2):
+        return 'xls'
+    if b'\x00' in archivo[:BYTES_MUESTRA_CSV]:
+        return 'binario'
+    return 'csv'
+
+
+def detectar_formato_csv(archivo: bytes) -> Tuple[str, str]:
+    """
+    Detecta encoding y delimitador con una muestra del inicio del archivo
+
+    Returns:
+        (encoding, delimitador) - por defecto ('latin-1', ';') como el flujo original
+    """
+    muestra = archivo[:BYTES_MUESTRA_CSV]
+
+    if muestra.startswith(BOM_UTF8):
+        encoding = 'utf-8-sig'
+        texto = muestra[len(BOM_UTF8):].decode('utf-8', errors='ignore')
+    else:
+        try:
+            texto = muestra.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError as e:
+            # Un carácter multibyte cortado al final de la muestra no descarta UTF-8
+            if e.start >= len(muestra) - 3 and len(archivo) > len(muestra):
+                texto = muestra[:e.start].decode('utf-8')
+                encoding = 'utf-8'
+            else:
+                texto = muestra.decode('latin-1')
+                encoding = 'latin-1'
+
+    lineas = texto.splitlines()[:20]
+    try:
+        delimitador = csv.Sniffer().sniff('\n'.join(lineas), delimiters=DELIMITADORES_CSV).delimiter
+    except csv.Error:
+        encabezado = lineas[0] if lineas else ''
+        conteos = {d: encabezado.count(d) for d in DELIMITADORES_CSV}
+        delimitador = max(conteos, key=conteos.get) if any(conteos.values()) else ';'
+
+    return encoding, delimitador
+
+
+def leer_csv(archivo: bytes, columnas: Optional[set] = None) -> pd.DataFrame:
+    """
+    Lee un CSV en una sola pasada con encoding y delimitador detectados
+
+    Usa el motor multihilo de pyarrow si está disponible (si no, el motor C de
+    pandas) y, si se pasan `columnas` (nombres normalizados), lee solo esas.
+    """
+    encoding, delimitador = detectar_formato_csv(archivo)
+    opciones = {'sep': delimitador, 'encoding': encoding}
+
+    if columnas:
+        encabezado = pd.read_csv(io.BytesIO(archivo), nrows=0, **opciones).columns
+        usecols = [c for c in encabezado if normalizar_columna(c) in columnas]
+        if usecols:
+            opciones['usecols'] = usecols
+
+    logger.info(f"CSV detectado: encoding={encoding}, delimitador={delimitador!r}, "
+                f"columnas={len(opciones.get('usecols', [])) or 'todas'}")
+
+    if pa is not None:
+        try:
+            return pd.read_csv(io.BytesIO(archivo), engine='pyarrow', **opciones)
+        except Exception as e:
+            logger.debug(f"Motor pyarrow no pudo leer el CSV, se usa el motor C: {e}")
+    return pd.read_csv(io.BytesIO(archivo), **opciones)
+
+
+# ============================================
+# MONTOS Y FECHAS EN FORMATOS LATINOAMERICANOS
+# ============================================
+# Conversión por columna: el patrón (separador decimal, orden día/mes, serial
+# de Excel) se detecta una vez sobre una muestra y la columna completa se
+# convierte con operaciones vectorizadas de pandas, sin parseo por elemento.
+
+MUESTRA_DETECCION = 500
+# Seriales de Excel aceptados como fecha: 1927-05-18 a 2201-03-01
+SERIAL_EXCEL_MIN, SERIAL_EXCEL_MAX = 10000, 110000
+ORIGEN_SERIAL_EXCEL = '1899-12-30'
+MESES_ABREVIADOS = {
+    'ene': 1, 'jan': 1, 'feb': 2, 'mar': 3, 'abr': 4, 'apr': 4, 'may': 5, 'jun': 6, 'jul': 7,
+    'ago': 8, 'aug': 8, 'sep': 9, 'set': 9, 'oct': 10, 'nov': 11, 'dic': 12, 'dec': 12
+}
+
+_PATRON_NO_NUMERICO = r'[^0-9,.\-]'
+_PATRON_FECHA_NUMERICA = r'^(\d{1,2})[/.\-](\d{1,2})[/.\-](\d{4}|\d{2})(?!\d)'
+_PATRON_FECHA_MES_TEXTO = r'^(\d{1,2})[\s/.\-]+([A-Za-z]{3})[A-Za-z]*\.?[\s/.\-]+(\d{4}|\d{2})(?!\d)'
+
+
+def detectar_separador_decimal(muestra: pd.Series) -> str:
+    """
+    ',' o '.' según la mayoría de los valores decisivos de la muestra
+
+    '1.234.567,89' y '1.234' (grupos de 3) votan por coma decimal; '1,234.50' y
+    '12.5' por punto. Sin votos decisivos se asume punto.
+    """
+    texto = muestra.str.replace(_PATRON_NO_NUMERICO, '', regex=True)
+    punto, coma = texto.str.rfind('.'), texto.str.rfind(',')
+    ambos = (punto >= 0) & (coma >= 0)
+    solo_punto = (punto >= 0) & (coma < 0)
+    solo_coma = (coma >= 0) & (punto < 0)
+
+    # Un solo separador seguido de exactamente 3 dígitos, o repetido, es de miles
+    miles_punto = solo_punto & (texto.str.count(r'\.').gt(1) | texto.str.match(r'^-?\d{1,3}\.\d{3}$'))
+    miles_coma = solo_coma & (texto.str.count(',').gt(1) | texto.str.match(r'^-?\d{1,3},\d{3}$'))
+
+    votos_coma = int((ambos & (coma > punto)).sum() + miles_punto.sum() + (solo_coma & ~miles_coma).sum())
+    votos_punto = int((ambos & (punto > coma)).sum() + miles_coma.sum() + (solo_punto & ~miles_punto).sum())
+    return ',' if votos_coma > votos_punto else '.'
+
+
+def convertir_montos(valores: pd.Series) -> pd.Series:
+    """
+    Montos de loss runs a float ('$ 1.234.567,89', '1,234.50', '(1.500)', 'COP 2.000')
+
+    Los números ya tipados pasan sin cambios; el texto se limpia según el
+    separador decimal detectado en la columna. Lo que no es un monto queda NaN.
+    """
+    if pd.api.types.is_numeric_dtype(valores):
+        return valores.astype(float)
+
+    # .str solo sobre las celdas de texto: openpyxl y pyarrow dejan números, bools o Decimal en columnas object
+    texto = valores.where(valores.map(lambda v: isinstance(v, str))).str.strip()
+    es_texto = texto.notna() & (texto != '')
+    montos = pd.to_numeric(valores.where(~es_texto), errors='coerce').astype(float)
+    if not es_texto.any():
+        return montos
+
+    texto = texto[es_texto]
+    decimal = detectar_separador_decimal(texto.iloc[:MUESTRA_DETECCION])
+    miles = '.' if decimal == ',' else ','
+    negativo = texto.str.startswith('(') & texto.str.endswith(')') | texto.str.endswith('-')
+    limpio = (texto.str.replace(_PATRON_NO_NUMERICO, '', regex=True)
+              .str.replace(miles, '', regex=False)
+              .str.rstrip('-'))
+    if decimal == ',':
+        limpio = limpio.str.replace(',', '.', regex=False)
+    numeros = pd.to_numeric(limpio, errors='coerce')
+    montos[es_texto] = numeros.where(~negativo, -numeros.abs())
+    return montos
+
+
+def _fechas_numericas(numeros: pd.Series) -> pd.Series:
+    """Seriales de Excel (45000 = 2023-03-15) o enteros YYYYMMDD a fecha"""
+    fechas = pd.Series(pd.NaT, index=numeros.index, dtype='datetime64[ns]')
+    serial = numeros.between(SERIAL_EXCEL_MIN, SERIAL_EXCEL_MAX)
+    if serial.any():
+        fechas[serial] = pd.to_datetime(numeros[serial], unit='D', origin=ORIGEN_SERIAL_EXCEL)
+    clave = numeros.between(19000101, 21001231) & (numeros % 1 == 0)
+    if clave.any():
+        fechas[clave] = pd.to_datetime(numeros[clave].astype(np.int64).astype(str), format='%Y%m%d', errors='coerce')
+    return fechas
+
+
+def _fechas_por_partes(partes: pd.DataFrame, dia: int, mes: int) -> pd.Series:
+    """Columnas extraídas (día, mes, año) a fecha; años de 2 dígitos: <50 -> 20xx"""
+    año = pd.to_numeric(partes[2], errors='coerce')
+    año = año.where(año >= 100, año + np.where(año < 50, 2000, 1900))
+    return pd.to_datetime(pd.DataFrame({'year': año, 'month': pd.to_numeric(partes[mes], errors='coerce'),
+                                        'day': pd.to_numeric(partes[dia], errors='coerce')}),
+                          errors='coerce')
+
+
+def _fechas_texto(texto: pd.Series) -> pd.Series:
+    """Texto a fecha con el patrón dominante de la muestra; el resto por inferencia"""
+    muestra = texto.iloc[:MUESTRA_DETECCION]
+    fechas = pd.Series(pd.NaT, index=texto.index, dtype='datetime64[ns]')
+
+    if muestra.str.fullmatch(r'\d+(\.\d+)?').mean() > 0.5:
+        fechas = _fechas_numericas(pd.to_numeric(texto, errors='coerce'))
+    elif muestra.str.match(r'^\d{4}-\d{1,2}-\d{1,2}').mean() > 0.5:
+        fechas = pd.to_datetime(texto, errors='coerce', format='ISO8601')
+    elif muestra.str.match(_PATRON_FECHA_NUMERICA).mean() > 0.5:
+        partes = muestra.str.extract(_PATRON_FECHA_NUMERICA)
+        primero = pd.to_numeric(partes[0], errors='coerce')
+        segundo = pd.to_numeric(partes[1], errors='coerce')
+        # Día primero (LatAm) salvo que la muestra solo tenga sentido como mes/día
+        mes_primero = (segundo > 12).any() and not (primero > 12).any()
+        dia, mes = (1, 0) if mes_primero else (0, 1)
+        # Camino rápido (strptime en C) cuando la muestra es d/m/aaaa con un solo separador
+        separador = muestra.str.extract(r'^\d{1,2}([/.\-])')[0].dropna().unique()
+        if len(separador) == 1 and muestra.str.fullmatch(r'\d{1,2}[/.\-]\d{1,2}[/.\-]\d{4}').all():
+            formato = separador[0].join(['%m', '%d', '%Y'] if mes_primero else ['%d', '%m', '%Y'])
+            fechas = pd.to_datetime(texto, format=formato, errors='coerce')
+        otras = fechas.isna()
+        if otras.any():
+            fechas[otras] = _fechas_por_partes(texto[otras].str.extract(_PATRON_FECHA_NUMERICA), dia=dia, mes=mes)
+    elif muestra.str.match(_PATRON_FECHA_MES_TEXTO).mean() > 0.5:
+        partes = texto.str.extract(_PATRON_FECHA_MES_TEXTO)
+        partes[1] = partes[1].str.lower().map(MESES_ABREVIADOS)
+        fechas = _fechas_por_partes(partes, dia=0, mes=1)
+
+    pendientes = fechas.isna()
+    if pendientes.any():
+        resto = texto[pendientes]
+        inferidas = pd.to_datetime(resto, errors='coerce', format='ISO8601')
+        faltan = inferidas.isna()
+        if faltan.any():
+            inferidas[faltan] = pd.to_datetime(resto[faltan], errors='coerce', dayfirst=True, format='mixed')
+        fechas[pendientes] = inferidas
+    return fechas
+
+
+def convertir_fechas(valores: pd.Series) -> pd.Series:
+    """
+    Fechas de loss runs: datetime, serial de Excel, YYYYMMDD, ISO, dd/mm/aaaa
+    (mm/dd/aaaa si la columna lo indica) o '15-ene-2023'
+    """
+    if pd.api.types.is_datetime64_any_dtype(valores):
+        return valores
+    if pd.api.types.is_numeric_dtype(valores):
+        return _fechas_numericas(valores.astype(float))
+
+    fechas = pd.Series(pd.NaT, index=valores.index, dtype='datetime64[ns]')
+    # .str solo sobre las celdas de texto: pyarrow entrega las fechas ISO de un CSV como datetime.date
+    texto = valores.where(valores.map(lambda v: isinstance(v, str))).str.strip()
+    es_texto = texto.notna() & (texto != '')
+    otros = valores.notna() & ~es_texto
+    if otros.any():
+        # Celdas de Excel ya tipadas: números (seriales), datetime o date
+        numeros = pd.to_numeric(valores.where(otros), errors='coerce')
+        es_numero = numeros.notna()
+        if es_numero.any():
+            fechas[es_numero] = _fechas_numericas(numeros[es_numero])
+        es_fecha = otros & ~es_numero
+        if es_fecha.any():
+            fechas[es_fecha] = pd.to_datetime(valores[es_fecha], errors='coerce')
+    if es_texto.any():
+        fechas[es_texto] = _fechas_texto(texto[es_texto])
+    return fechas
+
+
+# ============================================
+# LECTURA DE CELDAS XLSX POR DIRECCIÓN
+# ============================================
+# Lee celdas puntuales (ej. Resumen!G24, W18) recorriendo el XML de la hoja
+# en streaming y cortando en la última fila pedida, sin cargar la hoja entera.
+
+_PATRON_CELDA = re.compile(r'^([A-Z]{1,3})(\d+)$')
+
+
+def _etiqueta_local(tag: str) -> str:
+    """Nombre del elemento sin namespace (OOXML transitional o strict)"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _columna_a_indice(letras: str) -> int:
+    """'A' -> 0, 'W' -> 22, 'AA' -> 26"""
+    indice = 0
+    for letra in letras:
+        indice = indice * 26 + (ord(letra) - 64)
+    return indice - 1
+
+
+def _indice_a_columna(indice: int) -> str:
+    letras = ''
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+
+def expandir_celdas(celdas: List[str]) -> Dict[str, Tuple[int, int]]:
+    """Referencias ('G24') y rangos ('G20:H30') -> {ref: (fila, columna)} en base 0"""
+    resultado = {}
+    for celda in celdas:
+        inicio, _, fin = celda.upper().partition(':')
+        m_ini, m_fin = _PATRON_CELDA.match(inicio), _PATRON_CELDA.match(fin or inicio)
+        if not m_ini or not m_fin:
+            raise ValueError(f"Referencia de celda inválida: {celda}")
+        filas = range(int(m_ini.group(2)) - 1, int(m_fin.group(2)))
+        columnas = range(_columna_a_indice(m_ini.group(1)), _columna_a_indice(m_fin.group(1)) + 1)
+        for fila in filas:
+            for columna in columnas:
+                resultado[f'{_indice_a_columna(columna)}{fila + 1}'] = (fila, columna)
+    return resultado
+
+
+def hojas_xlsx(archivo: bytes) -> List[str]:
+    """Nombres de hoja de un .xlsx leyendo solo xl/workbook.xml"""
+    with zipfile.ZipFile(io.BytesIO(archivo)) as zf:
+        return [nombre for nombre, _ in _hojas_y_rutas(zf)]
+
+
+def _hojas_y_rutas(zf: zipfile.ZipFile) -> List[Tuple[str, str]]:
+    relaciones = {}
+    for _, elem in ET.iterparse(zf.open('xl/_rels/workbook.xml.rels')):
+        if _etiqueta_local(elem.tag) == 'Relationship':
+            destino = elem.get('Target', '')
+            relaciones[elem.get('Id')] = destino.lstrip('/') if destino.startswith('/') else f'xl/{destino}'
+
+    hojas = []
+    for _, elem in ET.iterparse(zf.open('xl/workbook.xml')):
+        if _etiqueta_local(elem.tag) == 'sheet':
+            id_relacion = next((v for k, v in elem.attrib.items() if _etiqueta_local(k) == 'id'), None)
+            hojas.append((elem.get('name'), relaciones.get(id_relacion)))
+    return hojas
+
+
+def _cadenas_compartidas(zf: zipfile.ZipFile, indices: set) -> Dict[int, str]:
+    """Solo los sharedStrings pedidos; corta al pasar el mayor índice"""
+    if not indices or 'xl/sharedStrings.xml' not in zf.namelist():
+        return {}
+    maximo = max(indices)
+    cadenas, actual, partes = {}, -1, []
+    for evento, elem in ET.iterparse(zf.open('xl/sharedStrings.xml'), events=('start', 'end')):
+        etiqueta = _etiqueta_local(elem.tag)
+        if evento == 'start' and etiqueta == 'si':
+            actual += 1
+            partes = []
+        elif evento == 'end' and etiqueta == 't':
+            partes.append(elem.text or '')
+        elif evento == 'end' and etiqueta == 'si':
+            if actual in indices:
+                cadenas[actual] = ''.join(partes)
+            elem.clear()
+            if actual >= maximo:
+                break
+    return cadenas
+
+
+def _ruta_hoja(zf: zipfile.ZipFile, hoja) -> str:
+    """Ruta del XML de una hoja por nombre o índice (0 = primera)"""
+    hojas = _hojas_y_rutas(zf)
+    if isinstance(hoja, int):
+        return hojas[hoja][1]
+    ruta = next((r for nombre, r in hojas if nombre == hoja), None)
+    if ruta is None:
+        raise KeyError(f"Hoja '{hoja}' no existe")
+    return ruta
+
+
+class TextoCompartido:
+    """Celda de texto aún no decodificada: índice en xl/sharedStrings.xml"""
+    __slots__ = ('indice',)
+
+    def __init__(self, indice: int):
+        self.indice = indice
+
+    def __eq__(self, otro: Any) -> bool:
+        return isinstance(otro, TextoCompartido) and otro.indice == self.indice
+
+    def __hash__(self) -> int:
+        return hash(('sharedStrings', self.indice))
+
+
+def _valor_celda(tipo: Optional[str], texto: Optional[str]) -> Any:
+    if texto is None or tipo == 'e':
+        return None
+    if tipo == 's':
+        return TextoCompartido(int(texto))
+    if tipo in ('str', 'inlineStr'):
+        return texto
+    if tipo == 'b':
+        return texto == '1'
+    if tipo == 'd':
+        # Fecha ISO 8601 (openpyxl iso_dates y algunos exportadores); si no se reconoce, el texto
+        try:
+            return datetime.fromisoformat(texto)
+        except ValueError:
+            return texto
+    return float(texto)
+
+
+class _LectorFilasXlsx:
+    """Target de ET.XMLParser para una hoja: junta (fila, {columna: valor}) sin armar el árbol"""
+
+    def __init__(self, columnas: Optional[set], hasta_fila: Optional[int]):
+        self.columnas = columnas
+        self.hasta_fila = hasta_fila
+        self.filas: List[Tuple[int, Dict[int, Any]]] = []
+        self.terminado = False
+        self._locales: Dict[str, str] = {}
+        self._fila, self._columna = -1, -1
+        self._valores: Dict[int, Any] = {}
+        self._tipo = None
+        self._incluir = False
+        self._capturar = False
+        self._partes: List[str] = []
+
+    def _local(self, tag: str) -> str:
+        local = self._locales.get(tag)
+        if local is None:
+            local = self._locales[tag] = _etiqueta_local(tag)
+        return local
+
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
+        local = self._local(tag)
+        if local == 'c':
+            referencia = attrib.get('r')
+            self._columna = (_columna_a_indice(_PATRON_CELDA.match(referencia).group(1))
+                             if referencia else self._columna + 1)
+            self._incluir = self.columnas is None or self._columna in self.columnas
+            self._tipo = attrib.get('t')
+            self._partes = []
+        elif local == 'row':
+            referencia = attrib.get('r')
+            self._fila = int(referencia) - 1 if referencia else self._fila + 1
+            self._columna = -1
+            self._valores = {}
+            if self.hasta_fila is not None and self._fila > self.hasta_fila:
+                self.terminado = True
+        elif (local == 'v' or local == 't') and self._incluir:
+            self._capturar = True
+
+    def data(self, texto: str) -> None:
+        if self._capturar:
+            self._partes.append(texto)
+
+    def end(self, tag: str) -> None:
+        local = self._local(tag)
+        if local == 'v' or local == 't':
+            self._capturar = False
+        elif local == 'c':
+            if self._incluir and self._partes:
+                valor = _valor_celda(self._tipo, ''.join(self._partes))
+                if valor is not None:
+                    self._valores[self._columna] = valor
+            self._incluir = False
+        elif local == 'row' and not self.terminado:
+            self.filas.append((self._fila, self._valores))
+
+    def close(self) -> None:
+        return None
+
+
+def _iterar_filas_hoja(zf: zipfile.ZipFile, ruta: str, columnas: Optional[set] = None,
+                       hasta_fila: Optional[int] = None) -> Iterator[Tuple[int, Dict[int, Any]]]:
+    """
+    Recorre una hoja .xlsx fila a fila: (fila, {columna: valor}) en base 0
+
+    Los textos compartidos salen como TextoCompartido (ver resolver_textos).
+    El XML se parsea por bloques sin construir elementos: la memoria no crece
+    con la hoja.
+
+    Args:
+        columnas: Índices de columna a convertir (None = todas)
+        hasta_fila: Última fila a recorrer (None = toda la hoja)
+    """
+    lector = _LectorFilasXlsx(columnas, hasta_fila)
+    parser = ET.XMLParser(target=lector)
+    with zf.open(ruta) as flujo:
+        while not lector.terminado:
+            bloque = flujo.read(1 << 16)
+            if bloque:
+                parser.feed(bloque)
+            else:
+                parser.close()
+            filas, lector.filas = lector.filas, []
+            yield from filas
+            if not bloque:
+                break
+
+
+def resolver_textos(zf: zipfile.ZipFile, valores: List[Dict[Any, Any]]) -> None:
+    """Reemplaza en sitio los TextoCompartido de los diccionarios por su texto"""
+    compartidas = _cadenas_compartidas(
+        zf, {v.indice for d in valores for v in d.values() if isinstance(v, TextoCompartido)})
+    for d in valores:
+        for clave, v in d.items():
+            if isinstance(v, TextoCompartido):
+                d[clave] = compartidas.get(v.indice)
+
+
+def leer_celdas_xlsx(archivo: bytes, hoja, celdas: List[str]) -> Dict[str, Any]:
+    """
+    Lee celdas de una hoja .xlsx en streaming, hasta la última fila pedida
+
+    Args:
+        archivo: Contenido del .xlsx
+        hoja: Nombre de la hoja o índice (0 = primera)
+        celdas: Referencias o rangos ('G24', 'W18', 'A1:C5')
+
+    Returns:
+        {ref: valor} con float para números, str para texto, bool para booleanos
+        y None para celdas vacías o con error
+    """
+    pedidas = expandir_celdas(celdas)
+    filas_pedidas = {fila for fila, _ in pedidas.values()}
+    columnas = {columna for _, columna in pedidas.values()}
+    por_fila: Dict[int, Dict[int, Any]] = {}
+
+    with zipfile.ZipFile(io.BytesIO(archivo)) as zf:
+        filas = _iterar_filas_hoja(zf, _ruta_hoja(zf, hoja), columnas, hasta_fila=max(filas_pedidas))
+        with closing(filas):
+            for fila, valores in filas:
+                if fila in filas_pedidas:
+                    por_fila[fila] = valores
+        valores = {ref: por_fila.get(fila, {}).get(columna) for ref, (fila, columna) in pedidas.items()}
+        resolver_textos(zf, [valores])
+    return valores
+
+
+def celdas_contienen(archivo: bytes, hoja, celdas: List[str], terminos: List[str]) -> bool:
+    """True si algún texto de las celdas, normalizado como nombre de columna, contiene un término"""
+    for valor in leer_celdas_xlsx(archivo, hoja, celdas).values():
+        if isinstance(valor, str) and any(t in normalizar_columna(valor) for t in terminos):
+            return True
+    return False
+
+
+def hojas_libro(archivo: bytes) -> List[str]:
+    """Nombres de hoja: workbook.xml para .xlsx, pandas para otros formatos"""
+    if detectar_tipo_contenido(archivo) == 'xlsx':
+        return hojas_xlsx(archivo)
+    return pd.ExcelFile(io.BytesIO(archivo)).sheet_names
+
+
+def leer_celdas(archivo: bytes, hoja, celdas: List[str]) -> Dict[str, Any]:
+    """
+    Celdas puntuales de un libro Excel: streaming para .xlsx y, para otros
+    formatos (.xls), pandas limitado a las filas necesarias
+    """
+    if detectar_tipo_contenido(archivo) == 'xlsx':
+        return leer_celdas_xlsx(archivo, hoja, celdas)
+
+    pedidas = expandir_celdas(celdas)
+    ultima_fila = max(fila for fila, _ in pedidas.values())
+    df = pd.read_excel(io.BytesIO(archivo), sheet_name=hoja, header=None, nrows=ultima_fila + 1)
+    valores = {}
+    for ref, (fila, columna) in pedidas.items():
+        valor = df.iloc[fila, columna] if fila < df.shape[0] and columna < df.shape[1] else None
+        valores[ref] = None if valor is None or pd.isna(valor) else valor
+    return valores
+
+
+# ============================================
+# AGREGACIÓN DEL TIV EN STREAMING
+# ============================================
+# Relaciones de valores con cientos de miles de ubicaciones: el TIV, el
+# desglose por componente y las estadísticas por ubicación se calculan en una
+# pasada sobre el XML de la hoja, sin armar la tabla en memoria.
+
+TIV_STREAMING_MIN_FILAS = int(os.getenv('TIV_STREAMING_MIN_FILAS', '50000'))
+TIV_TOP_UBICACIONES = 10
+COMPONENTES_TIV_LA_COSTENA = ['EDIFICIOS', 'INVENTARIO', 'CONTENIDOS', 'PERDIDAS CONSEC']
+COMPONENTES_TIV_CONAGUA = ['Edificio', 'Contenidos']
+# Columnas de la relación de valores por rol (nombres normalizados, en orden de preferencia)
+COLUMNAS_UBICACION = {
+    'id': ['id_ubicacion', 'codigo_ubicacion', 'no', 'item', 'id'],
+    'ubicacion': ['ubicacion', 'ubicación', 'nombre', 'sede', 'inmueble', 'predio', 'direccion', 'dirección'],
+    'estado': ['estado', 'departamento', 'provincia'],
+    'municipio': ['municipio', 'ciudad', 'localidad'],
+}
+COLUMNAS_VALOR_UBICACION = ['suma_asegurada_clean', 'suma_asegurada', 'valor_asegurado', 'valores_totales',
+                            'total_insured_value', 'tiv']
+DIMENSIONES_CONCENTRACION = ('estado', 'municipio')
+LOTE_TEXTOS_PENDIENTES = 50000
+BYTES_POR_FILA_XLSX = 256
+
+
+def filas_estimadas_xlsx(archivo: bytes, hoja) -> int:
+    """
+    Filas de una hoja .xlsx sin recorrerla: la última fila de <dimension ref>
+    o, si la hoja no la declara (ej. openpyxl write-only), el tamaño del XML
+    descomprimido / BYTES_POR_FILA_XLSX
+    """
+    with zipfile.ZipFile(io.BytesIO(archivo)) as zf:
+        ruta = _ruta_hoja(zf, hoja)
+        for _, elem in ET.iterparse(zf.open(ruta), events=('start',)):
+            etiqueta = _etiqueta_local(elem.tag)
+            if etiqueta == 'dimension':
+                inicio, _, fin = elem.get('ref', '').upper().replace('$', '').partition(':')
+                m = _PATRON_CELDA.match(fin or inicio)
+                if m and (fin or int(m.group(2)) > 1):
+                    return int(m.group(2))
+                break
+            if etiqueta == 'sheetData':
+                break
+        return zf.getinfo(ruta).file_size // BYTES_POR_FILA_XLSX
+
+
+def _a_numero(valor: Any) -> float:
+    """Un valor suelto como pd.to_numeric(errors='coerce').fillna(0)"""
+    if valor is None:
+        return 0.0
+    if isinstance(valor, str):
+        try:
+            numero = float(valor.strip())
+        except ValueError:
+            return 0.0
+    else:
+        numero = float(valor)
+    return 0.0 if math.isnan(numero) else numero
+
+
+def columnas_ubicacion(nombres: List[Any]) -> Dict[str, Any]:
+    """
+    Columnas de la relación de valores por rol (id, ubicacion, estado,
+    municipio), comparando nombres normalizados; la primera que coincide gana
+    """
+    normalizados = [(normalizar_columna(nombre), nombre) for nombre in nombres if isinstance(nombre, str)]
+    roles = {}
+    for rol, candidatos in COLUMNAS_UBICACION.items():
+        for candidato in candidatos:
+            nombre = next((original for norm, original in normalizados if norm == candidato), None)
+            if nombre is not None:
+                roles[rol] = nombre
+                break
+    return roles
+
+
+def _texto_celda(valor: Any) -> Optional[str]:
+    """Texto de una celda para mostrar o agrupar: 12.0 -> '12', vacío -> None"""
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return None
+    if isinstance(valor, (float, np.floating)) and float(valor).is_integer():
+        return str(int(valor))
+    return str(valor)
+
+
+def _factorizar_textos(serie: pd.Series) -> Tuple[np.ndarray, List[Optional[str]]]:
+    """pd.factorize sobre _texto_celda, convirtiendo solo los valores distintos"""
+    codigos, distintos = pd.factorize(serie)
+    codigos_texto, claves = pd.factorize(pd.Series([_texto_celda(v) for v in distintos], dtype=object))
+    codigos_texto = np.append(codigos_texto, -1)  # código -1 (vacío) sigue siendo -1
+    return codigos_texto[codigos], list(claves)
+
+
+def _top_k(valores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Posiciones de los k mayores, de mayor a menor, con selección parcial
+    (np.partition) en vez de ordenar todo; empates por posición, como nlargest
+    """
+    n = len(valores)
+    if n > k:
+        umbral = np.partition(valores, n - k)[n - k]
+        mayores = np.flatnonzero(valores > umbral)
+        iguales = np.flatnonzero(valores == umbral)[:k - len(mayores)]
+        seleccion = np.concatenate([mayores, iguales])
+    else:
+        seleccion = np.arange(n)
+    return seleccion[np.lexsort((seleccion, -valores[seleccion]))]
+
+
+def _indicadores_concentracion(total: float, suma_cuadrados: float, top: List[float]) -> Dict[str, Any]:
+    """HHI, número equivalente de ubicaciones y participación de las mayores"""
+    if total <= 0:
+        return {'hhi': None, 'n_equivalente': None, 'pct_top_1': None, 'pct_top_5': None, 'pct_top_10': None}
+    hhi = suma_cuadrados / total ** 2
+    return {
+        'hhi': hhi,
+        'n_equivalente': 1 / hhi if hhi > 0 else None,
+        'pct_top_1': sum(top[:1]) / total * 100,
+        'pct_top_5': sum(top[:5]) / total * 100,
+        'pct_top_10': sum(top[:10]) / total * 100
+    }
+
+
+class AcumuladorTIV:
+    """Estadísticas de suma asegurada por ubicación en una pasada, con memoria constante"""
+
+    def __init__(self, componentes: List[str], top_n: int = TIV_TOP_UBICACIONES):
+        self.componentes = {c: 0.0 for c in componentes}
+        self.top_n = top_n
+        self.top: List[Tuple[float, int, Dict[str, Any]]] = []  # min-heap (suma, -fila, atributos)
+        # Suma y ubicaciones por estado / municipio: crece con los valores distintos, no con las filas
+        self.grupos: Dict[str, Dict[Any, List[float]]] = {d: {} for d in DIMENSIONES_CONCENTRACION}
+        self.n = 0
+        self.total = 0.0
+        self.suma_cuadrados = 0.0
+        self.media = 0.0
+        self.m2 = 0.0
+        self.minimo = math.inf
+        self.maximo = -math.inf
+
+    def agregar(self, fila: int, suma: float, componentes: Dict[str, float],
+                atributos: Optional[Dict[str, Any]] = None) -> None:
+        """Suma una ubicación; las de suma asegurada <= 0 se descartan como en la tabla"""
+        if not suma > 0:
+            return
+        atributos = atributos or {}
+        self.n += 1
+        self.total += suma
+        self.suma_cuadrados += suma * suma
+        # Welford: media y varianza sin guardar los valores
+        delta = suma - self.media
+        self.media += delta / self.n
+        self.m2 += delta * (suma - self.media)
+        self.minimo = min(self.minimo, suma)
+        self.maximo = max(self.maximo, suma)
+        for componente, valor in componentes.items():
+            self.componentes[componente] += valor
+        for dimension, grupos in self.grupos.items():
+            clave = atributos.get(dimension)
+            if clave is not None:
+                acumulado = grupos.setdefault(clave, [0.0, 0])
+                acumulado[0] += suma
+                acumulado[1] += 1
+
+        # Empates: queda la primera fila, como DataFrame.nlargest
+        entrada = (suma, -fila, atributos)
+        if len(self.top) < self.top_n:
+            heapq.heappush(self.top, entrada)
+        elif entrada[:2] > self.top[0][:2]:
+            heapq.heapreplace(self.top, entrada)
+
+    def textos_pendientes(self) -> set:
+        """Índices de sharedStrings usados por claves de grupo y ubicaciones del top"""
+        valores = [v for _, _, atributos in self.top for v in atributos.values()]
+        valores += [clave for grupos in self.grupos.values() for clave in grupos]
+        return {v.indice for v in valores if isinstance(v, TextoCompartido)}
+
+    def resultado(self, textos: Optional[Dict[int, str]] = None) -> Dict[str, Any]:
+        """Estadísticas finales; textos resuelve los TextoCompartido pendientes"""
+        textos = textos or {}
+
+        def texto(valor: Any) -> Optional[str]:
+            return _texto_celda(textos.get(valor.indice) if isinstance(valor, TextoCompartido) else valor)
+
+        top = sorted(self.top, key=lambda e: e[:2], reverse=True)
+        grupos = {}
+        for dimension, acumulados in self.grupos.items():
+            # Claves distintas que resultan en el mismo texto (ej. 12 y '12') se suman
+            por_texto: Dict[str, List[float]] = {}
+            for clave, (suma, n) in acumulados.items():
+                acumulado = por_texto.setdefault(texto(clave), [0.0, 0])
+                acumulado[0] += suma
+                acumulado[1] += n
+            mayores = heapq.nlargest(self.top_n, por_texto.items(), key=lambda item: item[1][0])
+            grupos[dimension] = [
+                {'valor': clave, 'suma_asegurada': suma, 'n_ubicaciones': n,
+                 'pct_tiv': suma / self.total * 100 if self.total else None}
+                for clave, (suma, n) in mayores
+            ]
+
+        return {
+            'modo': 'streaming',
+            'n_ubicaciones': self.n,
+            'tiv_total': self.total,
+            'componentes': dict(self.componentes),
+            'suma_asegurada': {
+                'minimo': self.minimo if self.n else None,
+                'maximo': self.maximo if self.n else None,
+                'promedio': self.media if self.n else None,
+                'desviacion': math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else None
+            },
+            'concentracion': _indicadores_concentracion(self.total, self.suma_cuadrados, [e[0] for e in top]),
+            'grupos': grupos,
+            'top_ubicaciones': [
+                {'fila': -menos_fila + 1, **{rol: texto(atributos.get(rol)) for rol in COLUMNAS_UBICACION},
+                 'suma_asegurada': suma}
+                for suma, menos_fila, atributos in top
+            ]
+        }
+
+
+def agregar_tiv_streaming(archivo: bytes, hoja, fila_encabezado: int, col_clave: str,
+                          cols_suma: List[str], componentes: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    TIV y estadísticas por ubicación de una hoja .xlsx en una sola pasada
+
+    Replica la lectura tabular de las estrategias 4 y 5: filas con col_clave
+    no vacía, componentes numéricos (texto no numérico = 0), suma asegurada
+    desde la primera de cols_suma presente (o la suma de componentes) y solo
+    ubicaciones con suma > 0.
+
+    Args:
+        fila_encabezado: Fila del encabezado en base 0 (header= de pandas)
+
+    Returns:
+        Estadísticas (ver AcumuladorTIV.resultado), o None si esa fila no es
+        un encabezado con col_clave (usar la lectura tabular)
+    """
+    with zipfile.ZipFile(io.BytesIO(archivo)) as zf:
+        ruta = _ruta_hoja(zf, hoja)
+        encabezado = dict(_iterar_filas_hoja(zf, ruta, hasta_fila=fila_encabezado)).get(fila_encabezado)
+        if not encabezado:
+            return None
+        resolver_textos(zf, [encabezado])
+
+        posiciones: Dict[str, int] = {}
+        for columna, nombre in sorted(encabezado.items()):
+            if isinstance(nombre, str):
+                posiciones.setdefault(nombre, columna)
+        if col_clave not in posiciones:
+            return None
+
+        idx_clave = posiciones[col_clave]
+        idx_suma = next((posiciones[c] for c in cols_suma if c in posiciones), None)
+        idx_componentes = {c: posiciones[c] for c in componentes if c in posiciones}
+        idx_atributos = {rol: posiciones[nombre] for rol, nombre in columnas_ubicacion(list(posiciones)).items()}
+        numericas = set(idx_componentes.values()) | ({idx_suma} if idx_suma is not None else set())
+        acumulador = AcumuladorTIV(list(idx_componentes))
+
+        def agregar(fila: int, valores: Dict[int, Any]) -> None:
+            montos = {c: _a_numero(valores.get(i)) for c, i in idx_componentes.items()}
+            suma = _a_numero(valores.get(idx_suma)) if idx_suma is not None else sum(montos.values())
+            acumulador.agregar(fila, suma, montos, {rol: valores.get(i) for rol, i in idx_atributos.items()})
+
+        # Montos guardados como texto: se decodifican por lotes para no releer
+        # sharedStrings.xml por cada fila
+        pendientes: List[Tuple[int, Dict[int, Any]]] = []
+        # Solo se convierten las celdas de las columnas usadas
+        usadas = numericas | {idx_clave} | set(idx_atributos.values())
+        for fila, valores in _iterar_filas_hoja(zf, ruta, usadas):
+            if fila <= fila_encabezado or valores.get(idx_clave) is None:
+                continue
+            if any(isinstance(valores.get(i), TextoCompartido) for i in numericas):
+                pendientes.append((fila, valores))
+                if len(pendientes) >= LOTE_TEXTOS_PENDIENTES:
+                    _resolver_montos(zf, pendientes, numericas)
+                    for pendiente in pendientes:
+                        agregar(*pendiente)
+                    pendientes.clear()
+                continue
+            agregar(fila, valores)
+
+        _resolver_montos(zf, pendientes, numericas)
+        for pendiente in pendientes:
+            agregar(*pendiente)
+
+        return acumulador.resultado(_cadenas_compartidas(zf, acumulador.textos_pendientes()))
+
+
+def _resolver_montos(zf: zipfile.ZipFile, pendientes: List[Tuple[int, Dict[int, Any]]], numericas: set) -> None:
+    """Decodifica solo las celdas de montos: estado/municipio siguen como TextoCompartido para agrupar"""
+    montos = [{i: valores[i] for i in numericas if i in valores} for _, valores in pendientes]
+    resolver_textos(zf, montos)
+    for (_, valores), resueltos in zip(pendientes, montos):
+        valores.update(resueltos)
+
+
+def estadisticas_tiv(df_tiv: pd.DataFrame, componentes: List[str], fila_encabezado: int,
+                     top_n: int = TIV_TOP_UBICACIONES) -> Optional[Dict[str, Any]]:
+    """
+    Las estadísticas de AcumuladorTIV sobre una tabla de ubicaciones, vectorizadas
+
+    Usa la primera columna de COLUMNAS_VALOR_UBICACION presente y solo las
+    ubicaciones con valor > 0. None si la tabla no tiene columna de valor.
+    """
+    normalizadas = {normalizar_columna(c): c for c in df_tiv.columns}
+    col_valor = next((normalizadas[c] for c in COLUMNAS_VALOR_UBICACION if c in normalizadas), None)
+    if col_valor is None:
+        return None
+
+    valores = pd.to_numeric(df_tiv[col_valor], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    validas = valores > 0
+    df = df_tiv[validas]
+    valores = valores[validas]
+    n = len(valores)
+    total = float(valores.sum())
+    roles = columnas_ubicacion(list(df.columns))
+
+    top = _top_k(valores, top_n)
+    top_ubicaciones = [
+        {
+            # Fila de Excel: índice de datos + encabezado + 1 (base 1)
+            'fila': int(df.index[i]) + fila_encabezado + 2,
+            **{rol: _texto_celda(df[roles[rol]].iat[i]) if rol in roles else None for rol in COLUMNAS_UBICACION},
+            'suma_asegurada': float(valores[i])
+        }
+        for i in top
+    ]
+
+    grupos = {}
+    for dimension in DIMENSIONES_CONCENTRACION:
+        if dimension not in roles:
+            grupos[dimension] = []
+            continue
+        codigos, claves = _factorizar_textos(df[roles[dimension]])
+        con_clave = codigos >= 0
+        sumas = np.bincount(codigos[con_clave], weights=valores[con_clave], minlength=len(claves))
+        conteos = np.bincount(codigos[con_clave], minlength=len(claves))
+        grupos[dimension] = [
+            {'valor': claves[i], 'suma_asegurada': float(sumas[i]), 'n_ubicaciones': int(conteos[i]),
+             'pct_tiv': float(sumas[i]) / total * 100 if total else None}
+            for i in _top_k(sumas, top_n)
+        ]
+
+    return {
+        'modo': 'tabla',
+        'n_ubicaciones': n,
+        'tiv_total': total,
+        'componentes': {
+            c: float(pd.to_numeric(df[c], errors='coerce').fillna(0).sum())
+            for c in componentes if c in df.columns
+        },
+        'suma_asegurada': {
+            'minimo': float(valores.min()) if n else None,
+            'maximo': float(valores.max()) if n else None,
+            'promedio': float(valores.mean()) if n else None,
+            'desviacion': float(valores.std(ddof=1)) if n > 1 else None
+        },
+        'concentracion': _indicadores_concentracion(total, float(np.dot(valores, valores)),
+                                                    [u['suma_asegurada'] for u in top_ubicaciones]),
+        'grupos': grupos,
+        'top_ubicaciones': top_ubicaciones
+    }
+
+
+# ============================================
+# UBICACIÓN DEL ENCABEZADO
+# ============================================
+# Las planillas de cedentes traen filas de título antes del encabezado y su
+# número cambia entre entregas. Se leen en streaming solo las primeras filas,
+# cada una se puntúa contra el vocabulario de columnas esperado del formato y
+# la hoja se parsea una sola vez desde la fila ganadora.
+
+FILAS_BUSQUEDA_ENCABEZADO = 50
+ENCABEZADO_MIN_COINCIDENCIAS = 2
+# Columnas esperadas por formato (se comparan normalizadas, ver normalizar_columna)
+ENCABEZADOS_ESPERADOS = {
+    'grupo_i': ['Nom. Procucto', 'Fec. Sini', 'Nom. Exp.', 'Liquidado', 'Rva. Actual', 'Total Incurrido'],
+    'la_costena_siniestros': ['SINIESTRO', 'DESCRIPCIÓN', 'fechasin', 'PERDIDA', 'SINPAGADO',
+                              'RESERVA_INDEMNIZA', 'RESERVA_GASTOS'],
+    'conagua_siniestros': ['Fecha Ocurrencia', 'Causa', 'Cat / No Cat', 'Pérdida Pagada Neta', 'Reserva Bruta'],
+    'excel_generico_siniestros': sorted(COLUMNAS_ESTANDAR_SINIESTROS),
+    'antioquia_tiv': [n for nombres in COLUMNAS_UBICACION.values() for n in nombres] +
+                     COLUMNAS_VALOR_UBICACION + ['valor_asegurado', 'total'],
+    'la_costena_tiv': ['No', 'UBICACION', 'ESTADO', 'MUNICIPIO', 'VALORES TOTALES'] + COMPONENTES_TIV_LA_COSTENA,
+    'conagua_tiv': ['No', 'Nombre', 'Estado', 'Municipio'] + COMPONENTES_TIV_CONAGUA,
+    'excel_generico_tiv': [n for nombres in COLUMNAS_UBICACION.values() for n in nombres] +
+                          COLUMNAS_VALOR_UBICACION,
+}
+
+
+def filas_iniciales(archivo: bytes, hoja, n_filas: int = FILAS_BUSQUEDA_ENCABEZADO) -> Dict[int, Dict[int, Any]]:
+    """
+    Primeras filas de una hoja: {fila: {columna: valor}} en base 0
+
+    .xlsx en streaming (corta en la fila n_filas); otros formatos con pandas
+    limitado a n_filas filas.
+    """
+    if detectar_tipo_contenido(archivo) == 'xlsx':
+        with zipfile.ZipFile(io.BytesIO(archivo)) as zf:
+            filas = _iterar_filas_hoja(zf, _ruta_hoja(zf, hoja), hasta_fila=n_filas - 1)
+            with closing(filas):
+                por_fila = dict(filas)
+            resolver_textos(zf, list(por_fila.values()))
+        return por_fila
+
+    df = pd.read_excel(io.BytesIO(archivo), sheet_name=hoja, header=None, nrows=n_filas)
+    return {fila: {c: v for c, v in enumerate(valores) if not pd.isna(v)}
+            for fila, valores in enumerate(df.itertuples(index=False))}
+
+
+def ubicar_encabezado(archivo: bytes, hoja, formato: str, por_defecto: int) -> int:
+    """
+    Fila del encabezado (header= de pandas) de una hoja según el vocabulario del formato
+
+    Gana la fila con más columnas esperadas (la fila por defecto ante empate);
+    con menos de ENCABEZADO_MIN_COINCIDENCIAS o si la hoja no se puede leer
+    se devuelve por_defecto.
+    """
+    terminos = {normalizar_columna(t) for t in ENCABEZADOS_ESPERADOS[formato]}
+    try:
+        filas = filas_iniciales(archivo, hoja)
+    except Exception as e:
+        logger.debug(f"No se pudo ubicar el encabezado de {hoja}: {e}")
+        return por_defecto
+
+    puntajes = {
+        fila: len(terminos & {normalizar_columna(v) for v in valores.values() if isinstance(v, str)})
+        for fila, valores in filas.items()
+    }
+    mejor = max(puntajes.values(), default=0)
+    if mejor < min(ENCABEZADO_MIN_COINCIDENCIAS, len(terminos)) or puntajes.get(por_defecto) == mejor:
+        return por_defecto
+
+    fila = min(f for f, p in puntajes.items() if p == mejor)
+    logger.info(f"📍 Encabezado de '{hoja}' ({formato}) en la fila {fila + 1} en lugar de la {por_defecto + 1}")
+    return fila
+
+
+# ============================================
+# PARSEO DE ARCHIVOS DE SINIESTRALIDAD
+# ============================================
+
+def _parsear_archivo_siniestros(filename: str, archivo: bytes) -> Optional[pd.DataFrame]:
+    """
+    Parsea un archivo de siniestralidad y lo mapea a las columnas estándar
+
+    Args:
+        filename: Nombre del archivo (se usa para detectar el formato)
+        archivo: Contenido del archivo
+
+    Returns:
+        DataFrame con fecha_siniestro, monto_incurrido, etc. o None si no se pudo procesar
+    """
+    df = None
+    formato = None
+
+    # CSV identificado por contenido: una sola lectura, sin pasar por pd.ExcelFile
+    if detectar_tipo_contenido(archivo) == 'csv':
+        try:
+            df = leer_csv(archivo, COLUMNAS_ESTANDAR_SINIESTROS)
+            df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
+            formato = 'csv_siniestros'
+        except Exception as e:
+            logger.error(f"No se pudo leer {filename} como CSV: {e}")
+        return _completar_siniestros(df, filename, formato)
+
+    # Intentar leer como Excel con hoja GRUPO I
+    try:
+        excel_file = pd.ExcelFile(io.BytesIO(archivo))
+        if 'GRUPO I' in excel_file.sheet_names:
+            logger.info(f"Archivo {filename}: Detectada hoja GRUPO I")
+            formato = 'grupo_i'
+            df = pd.read_excel(io.BytesIO(archivo), sheet_name='GRUPO I',
+                               header=ubicar_encabezado(archivo, 'GRUPO I', formato, 1))
+
+            # Filtrar solo TRDM
+            if 'Nom. Procucto' in df.columns:
+                df = df[df['Nom. Procucto'].str.contains('TODO RIESGO', case=False, na=False)].copy()
+                logger.info(f"Filtrados registros TRDM: {len(df)}")
+
+            # Mapear columnas
+            if 'Fec. Sini' in df.columns:
+                df['fecha_siniestro'] = convertir_fechas(df['Fec. Sini'])
+            if 'Liquidado' in df.columns:
+                df['monto_pagado'] = convertir_montos(df['Liquidado']).fillna(0)
+            if 'Rva. Actual' in df.columns:
+                df['monto_reservado'] = convertir_montos(df['Rva. Actual']).fillna(0)
+            if 'Total Incurrido' in df.columns:
+                df['monto_incurrido'] = convertir_montos(df['Total Incurrido']).fillna(0)
+            else:
+                df['monto_incurrido'] = df['monto_pagado'] + df['monto_reservado']
+
+            # Mapear causa del siniestro desde Nom. Exp.
+            if 'Nom. Exp.' in df.columns:
+                df['causa_siniestro'] = df['Nom. Exp.']
+            else:
+                df['causa_siniestro'] = 'No especificada'
+
+        # ============================================
+        # LA COSTEÑA - SINIESTROS
+        # ============================================
+        elif es_formato_la_costena_siniestros(archivo, filename):
+            logger.info(f"Procesando archivo La Costeña - Siniestros: {filename}")
+            formato = 'la_costena_siniestros'
+
+            df = pd.read_excel(io.BytesIO(archivo), sheet_name='SIN_AGOSTO',
+                               header=ubicar_encabezado(archivo, 'SIN_AGOSTO', formato, 8))
+            df = df.dropna(how='all')
+            df = df[df['SINIESTRO'].notna()].copy()
+
+            logger.info(f"Total registros La Costeña: {len(df)}")
+
+            if len(df) < 3:
+                logger.warning(f"CRÍTICO: Solo {len(df)} siniestro(s) - Muestra insuficiente")
+
+            df_mapped = pd.DataFrame()
+            df_mapped['numero_siniestro'] = df['SINIESTRO'].astype(str)
+            df_mapped['causa_siniestro'] = df['DESCRIPCIÓN']
+
+            if len(df.columns) > 2:
+                df_mapped['subcategoria'] = df.iloc[:, 2]
+
+            df_mapped['fecha_siniestro'] = convertir_fechas(df['fechasin'])
+            df_mapped['monto_incurrido'] = convertir_montos(df['PERDIDA']).fillna(0)
+            df_mapped['monto_pagado'] = convertir_montos(df['SINPAGADO']).fillna(0)
+
+            if 'RESERVA_INDEMNIZA' in df.columns and 'RESERVA_GASTOS' in df.columns:
+                reserva_indem = convertir_montos(df['RESERVA_INDEMNIZA']).fillna(0)
+                reserva_gastos = convertir_montos(df['RESERVA_GASTOS']).fillna(0)
+                df_mapped['monto_reservado'] = reserva_indem + reserva_gastos
+            else:
+                df_mapped['monto_reservado'] = (df_mapped['monto_incurrido'] - df_mapped['monto_pagado']).clip(lower=0)
+
+            df = df_mapped
+            logger.info(f"Siniestros La Costeña mapeados: {len(df)} registros")
+
+        # ============================================
+        # CONAGUA - SINIESTROS
+        # ============================================
+        elif es_formato_conagua_siniestros(archivo, filename):
+            logger.info(f"Procesando archivo CONAGUA - Siniestros: {filename}")
+            formato = 'conagua_siniestros'
+
+            df = pd.read_excel(io.BytesIO(archivo), sheet_name='Detail',
+                               header=ubicar_encabezado(archivo, 'Detail', formato, 1))
+            df = df.dropna(how='all')
+            df = df[df['Fecha Ocurrencia '].notna()].copy()
+
+            logger.info(f"Total registros CONAGUA: {len(df)}")
+
+            df_mapped = pd.DataFrame()
+            df_mapped['fecha_siniestro'] = convertir_fechas(df['Fecha Ocurrencia '])
+            df_mapped['causa_siniestro'] = df['Causa']
+            df_mapped['monto_pagado'] = convertir_montos(df['Pérdida Pagada Neta']).fillna(0)
+            df_mapped['monto_reservado'] = convertir_montos(df['Reserva Bruta']).fillna(0)
+            df_mapped['monto_incurrido'] = df_mapped['monto_pagado'] + df_mapped['monto_reservado']
+
+            if 'Cat / No Cat' in df.columns:
+                df_mapped['es_catastrofico'] = df['Cat / No Cat']
+
+            df = df_mapped
+            logger.info(f"Siniestros CONAGUA mapeados: {len(df)} registros")
+
+        else:
+            formato = 'excel_generico_siniestros'
+            df = pd.read_excel(io.BytesIO(archivo), engine='openpyxl',
+                               header=ubicar_encabezado(archivo, 0, formato, 0))
+            df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
+
+    except Exception as e:
+        logger.error(f"No se pudo leer {filename} como Excel: {e}")
+        df = None
+
+    return _completar_siniestros(df, filename, formato)
+
+
+def _completar_siniestros(df: Optional[pd.DataFrame], filename: str,
+                          formato: Optional[str]) -> Optional[pd.DataFrame]:
+    """Valida las columnas mínimas, tipa fechas y montos de formatos genéricos y agrega año"""
+    if df is None:
+        logger.error(f"No se pudo procesar {filename}")
+        return None
+
+    if 'fecha_siniestro' not in df.columns or 'monto_incurrido' not in df.columns:
+        logger.warning(f"Archivo {filename} no tiene columnas esperadas.")
+        return None
+
+    # CSV / Excel genérico: fechas y montos pueden venir como texto
+    if not pd.api.types.is_datetime64_any_dtype(df['fecha_siniestro']):
+        df['fecha_siniestro'] = convertir_fechas(df['fecha_siniestro'])
+    for col in ('monto_incurrido', 'monto_pagado', 'monto_reservado'):
+        if col in df.columns and not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = convertir_montos(df[col]).fillna(0)
+
+    # Agregar año si no existe
+    if 'año' not in df.columns and 'fecha_siniestro' in df.columns:
+        df['año'] = pd.to_datetime(df['fecha_siniestro'], errors='coerce').dt.year
+
+    df.attrs['formato'] = formato
+    return df
+
+
+# ============================================
+# CACHE DE LIBROS PARSEADOS
+# ============================================
+# Guarda la salida normalizada de cada archivo (DataFrame de siniestros o de
+# TIV + formato detectado + tiv_total) en Arrow IPC sin compresión, indexada por
+# el SHA-256 del contenido. Re-analizar el mismo archivo con otros parámetros
+# se lee con memory map y no pasa por openpyxl.
+
+# Subir al cambiar cualquier parser: invalida las entradas existentes
+VERSION_PARSERS = '3.3.6'
+
+CACHE_LIBROS_HABILITADO = _env_bool('CACHE_LIBROS_HABILITADO', default=True)
+CACHE_LIBROS_DIR = os.getenv('CACHE_LIBROS_DIR', os.path.join(tempfile.gettempdir(), 'cache_libros'))
+CACHE_LIBROS_MAX_MB = float(os.getenv('CACHE_LIBROS_MAX_MB', '512'))
+
+
+class CacheLibros:
+    """
+    Cache LRU en disco de libros parseados
+
+    La antigüedad de uso se lleva en el mtime de cada archivo (se actualiza en
+    cada hit); al superar max_mb se eliminan los menos usados.
+    """
+
+    def __init__(self, directorio: str, max_mb: float, habilitado: bool = True):
+        self.directorio = directorio
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.habilitado = habilitado and pa is not None
+        self._lock = threading.Lock()
+        if habilitado and pa is None:
+            logger.warning("⚠️ pyarrow no disponible - cache de libros parseados deshabilitada")
+
+    @staticmethod
+    def clave(rol: str, contenido: bytes) -> str:
+        digest = hashlib.sha256(contenido).hexdigest()
+        return f'{rol}_{VERSION_PARSERS}_{digest}'
+
+    def _ruta(self, clave: str) -> str:
+        return os.path.join(self.directorio, f'{clave}.arrow')
+
+    def obtener(self, rol: str, contenido: bytes) -> Optional[Tuple[pd.DataFrame, Dict[str, Any]]]:
+        """(DataFrame, metadata) si el archivo ya fue parseado, None si no"""
+        if not self.habilitado:
+            return None
+        ruta = self._ruta(self.clave(rol, contenido))
+        try:
+            with pa.memory_map(ruta, 'r') as fuente:
+                tabla = pa.ipc.open_file(fuente).read_all()
+            os.utime(ruta)
+        except FileNotFoundError:
+            METRICAS.cache_libros.inc(rol=rol, resultado='miss')
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Entrada de cache ilegible, se descarta: {e}")
+            METRICAS.cache_libros.inc(rol=rol, resultado='error')
+            with suppress(OSError):
+                os.remove(ruta)
+            return None
+
+        metadata = json.loads(tabla.schema.metadata[b'cache_libros'])
+        df = tabla.to_pandas()
+        df.attrs['formato'] = metadata.get('formato')
+        METRICAS.cache_libros.inc(rol=rol, resultado='hit')
+        return df, metadata
+
+    def guardar(self, rol: str, contenido: bytes, df: pd.DataFrame, metadata: Dict[str, Any]) -> bool:
+        """Escribe la entrada; los DataFrames no convertibles a Arrow (tipos mezclados) no se cachean"""
+        if not self.habilitado or df is None:
+            return False
+        try:
+            tabla = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            logger.info(f"Libro no cacheable en Arrow ({e}); se re-parseará en el próximo análisis")
+            return False
+
+        tabla = tabla.replace_schema_metadata({
+            **(tabla.schema.metadata or {}),
+            b'cache_libros': json.dumps(metadata, cls=NumpyEncoder).encode()
+        })
+        ruta = self._ruta(self.clave(rol, contenido))
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            fd, temporal = tempfile.mkstemp(prefix='.tmp_', suffix='.arrow', dir=self.directorio)
+            with os.fdopen(fd, 'wb') as destino, pa.ipc.new_file(destino, tabla.schema) as escritor:
+                escritor.write_table(tabla)
+            os.replace(temporal, ruta)
+        except OSError as e:
+            logger.warning(f"⚠️ No se pudo escribir la cache de libros: {e}")
+            return False
+
+        self._desalojar()
+        return True
+
+    def _desalojar(self):
+        """Elimina las entradas menos usadas hasta quedar bajo max_bytes"""
+        with self._lock:
+            entradas = []
+            for entrada in os.scandir(self.directorio):
+                if entrada.name.endswith('.arrow') and not entrada.name.startswith('.'):
+                    with suppress(OSError):
+                        estado = entrada.stat()
+                        entradas.append((estado.st_mtime, estado.st_size, entrada.path))
+
+            total = sum(tamano for _, tamano, _ in entradas)
+            for _, tamano, ruta in sorted(entradas):
+                if total <= self.max_bytes:
+                    break
+                with suppress(OSError):
+                    os.remove(ruta)
+                    total -= tamano
+                    METRICAS.cache_libros.inc(rol='todos', resultado='desalojo')
+
+
+CACHE_LIBROS = CacheLibros(CACHE_LIBROS_DIR, CACHE_LIBROS_MAX_MB, CACHE_LIBROS_HABILITADO)
+
+
+def leer_archivo_siniestros(filename: str, archivo: bytes, usar_cache: bool = True) -> Optional[pd.DataFrame]:
+    """
+    Lee un archivo de siniestralidad desde la cache de libros o parseándolo
+
+    Returns:
+        DataFrame estándar (attrs 'formato' y 'cache_hit') o None si no se pudo procesar
+    """
+    if usar_cache:
+        cacheado = CACHE_LIBROS.obtener('siniestralidad', archivo)
+        if cacheado is not None:
+            df, _ = cacheado
+            logger.info(f"⚡ Archivo {filename}: siniestros desde cache de libros ({len(df)} registros)")
+            df.attrs['cache_hit'] = True
+            return df
+
+    df = parsear_siniestros(filename, archivo)
+    if df is not None:
+        if usar_cache:
+            CACHE_LIBROS.guardar('siniestralidad', archivo, df, {'formato': df.attrs.get('formato')})
+        df.attrs['cache_hit'] = False
+    return df
+
+
+# ============================================
+# AGRUPACIÓN DE SINIESTROS EN EVENTOS
+# ============================================
+# Agrupa siniestros en eventos (ocurrencias) según la cláusula horaria de cada
+# peril: los siniestros de un mismo peril dentro de un período de N horas
+# consecutivas desde el primero forman un evento. Ordena una vez y marca los
+# inicios de evento con operaciones vectorizadas, sin comparar pares.
+
+# Horas consecutivas de un evento por peril (ver clasificar_peril); los perils
+# sin cláusula no se agrupan: cada siniestro es su propio evento
+HORAS_CLAUSULA_EVENTO = {'Terremoto': 72, 'Vientos': 72, 'Inundación': 168, 'Daños Maliciosos': 72}
+HORAS_CLAUSULA_EVENTO.update(json.loads(os.getenv('EVENTOS_HORAS_CLAUSULA', '{}')))
+# Cláusula para siniestros marcados como catastróficos en el archivo (ej. CONAGUA 'Cat / No Cat')
+# cuyo peril no tiene una propia
+HORAS_CLAUSULA_CAT_DEFAULT = float(os.getenv('EVENTOS_HORAS_CAT', '72'))
+EVENTOS_TOP_N = 10
+
+
+def bandera_catastrofica(valores: pd.Series) -> pd.Series:
+    """Columna es_catastrofico del archivo ('Cat' / 'No Cat', 1 / 0, Sí / No) a booleano con nulos"""
+    texto = valores.astype(str).str.strip().str.lower()
+    bandera = pd.Series(pd.NA, index=valores.index, dtype='boolean')
+    bandera[texto.str.startswith('no') | texto.isin(['0', '0.0', 'false', 'n'])] = False
+    bandera[(texto.str.contains('cat') & ~texto.str.startswith('no')) |
+            texto.isin(['1', '1.0', 'true', 's', 'si', 'sí', 'y', 'yes'])] = True
+    return bandera
+
+
+def marcar_catastroficos(df: pd.DataFrame, umbral: float) -> pd.Series:
+    """
+    Siniestro catastrófico: la marca del archivo cuando existe (CONAGUA
+    'Cat / No Cat') y, si no, monto_incurrido por encima del umbral (P95)
+    """
+    por_monto = df['monto_incurrido'] > umbral
+    if 'es_catastrofico' not in df.columns:
+        return por_monto
+    return bandera_catastrofica(df['es_catastrofico']).fillna(por_monto).astype(bool)
+
+
+def asignar_eventos(fechas: pd.Series, perils: pd.Series, horas: np.ndarray) -> np.ndarray:
+    """
+    Id de evento por siniestro (mismo orden que la entrada), en O(n log n)
+
+    Args:
+        fechas: Fecha de ocurrencia (NaT = evento propio)
+        perils: Peril de cada siniestro
+        horas: Cláusula horaria por siniestro (0 o NaN = no se agrupa)
+
+    Los siniestros se ordenan por (peril, se agrupa, fecha): los que no se agrupan
+    son un evento cada uno y no interrumpen la cadena de los demás del mismo
+    peril. Un hueco mayor a la cláusula o un cambio de peril siempre abre
+    evento (vectorizado); solo los tramos
+    continuos más largos que la cláusula se parten con búsqueda binaria desde
+    el inicio de cada período.
+    """
+    n = len(fechas)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    horas_ts = fechas.to_numpy(dtype='datetime64[ns]').astype(np.int64) / 3.6e12
+    sin_fecha = fechas.isna().to_numpy()
+    codigos, _ = pd.factorize(perils)
+    ventana = np.where(sin_fecha, 0.0, np.nan_to_num(np.asarray(horas, dtype=float)))
+
+    # Los que no se agrupan (No Cat, sin fecha) van aparte dentro del peril para no
+    # cortar la cadena de los que sí se agrupan
+    agrupa = ventana > 0
+    orden = np.lexsort((horas_ts, agrupa, codigos))
+    t, p, w, g = horas_ts[orden], codigos[orden], ventana[orden], agrupa[orden]
+
+    inicio = np.ones(n, dtype=bool)
+    inicio[1:] = (p[1:] != p[:-1]) | ~g[1:] | ~g[:-1] | (t[1:] - t[:-1] > w[1:])
+
+    # Tramos continuos más largos que la cláusula: un período de N horas desde el
+    # primer siniestro del evento, el siguiente evento empieza después
+    tramos = np.flatnonzero(inicio)
+    fines = np.append(tramos[1:], n)
+    largos = np.flatnonzero(t[fines - 1] - t[tramos] > w[tramos])
+    for k in largos:
+        desde, hasta = tramos[k], fines[k]
+        i = desde
+        while i < hasta:
+            inicio[i] = True
+            i = desde + int(np.searchsorted(t[desde:hasta], t[i] + w[i], side='right'))
+
+    eventos = np.empty(n, dtype=np.int64)
+    eventos[orden] = np.cumsum(inicio) - 1
+    return eventos
+
+
+def resumir_eventos(df: pd.DataFrame, horas_por_peril: Dict[str, float],
+                    top_n: int = EVENTOS_TOP_N) -> Dict[str, Any]:
+    """Pérdida por evento, top eventos y máximo anual (insumo del análisis XL)"""
+    eventos = df.groupby('evento_id', sort=False).agg(
+        peril=('peril_categoria', 'first'),
+        desde=('fecha_siniestro', 'min'),
+        hasta=('fecha_siniestro', 'max'),
+        n_siniestros=('monto_incurrido', 'size'),
+        perdida=('monto_incurrido', 'sum')
+    )
+    eventos['año'] = eventos['desde'].dt.year
+    perdidas = eventos['perdida'].to_numpy(dtype=float)
+    multiples = eventos[eventos['n_siniestros'] > 1]
+
+    top = eventos.iloc[_top_k(perdidas, top_n)]
+    por_anio = eventos.dropna(subset=['año']).groupby('año').agg(
+        n_eventos=('perdida', 'size'), perdida_total=('perdida', 'sum'), perdida_maxima_evento=('perdida', 'max'))
+    por_peril = eventos.groupby('peril').agg(
+        n_eventos=('perdida', 'size'), n_siniestros=('n_siniestros', 'sum'), perdida_maxima_evento=('perdida', 'max'))
+
+    return {
+        'n_siniestros': len(df),
+        'n_eventos': len(eventos),
+        'eventos_multisiniestro': len(multiples),
+        'siniestros_en_eventos_multiples': int(multiples['n_siniestros'].sum()),
+        'perdida_evento': {
+            'p50': float(np.percentile(perdidas, 50)),
+            'p90': float(np.percentile(perdidas, 90)),
+            'p99': float(np.percentile(perdidas, 99)),
+            'maxima': float(perdidas.max())
+        },
+        'top_eventos': [
+            {
+                'evento_id': int(evento_id),
+                'peril': fila['peril'],
+                'desde': fila['desde'].strftime('%Y-%m-%d') if pd.notna(fila['desde']) else None,
+                'hasta': fila['hasta'].strftime('%Y-%m-%d') if pd.notna(fila['hasta']) else None,
+                'n_siniestros': int(fila['n_siniestros']),
+                'perdida': float(fila['perdida'])
+            }
+            for evento_id, fila in top.iterrows()
+        ],
+        'por_anio': [
+            {'año': int(año), 'n_eventos': int(fila['n_eventos']), 'perdida_total': float(fila['perdida_total']),
+             'perdida_maxima_evento': float(fila['perdida_maxima_evento'])}
+            for año, fila in por_anio.iterrows()
+        ],
+        'por_peril': [
+            {'peril': peril, 'horas_clausula': horas_por_peril.get(peril), 'n_eventos': int(fila['n_eventos']),
+             'n_siniestros': int(fila['n_siniestros']), 'perdida_maxima_evento': float(fila['perdida_maxima_evento'])}
+            for peril, fila in por_peril.iterrows()
+        ]
+    }
+
+
+# ============================================
+# GRILLA DE PRICING (TASAS × DEDUCIBLES × CAPAS XL)
+# ============================================
+# Evalúa todas las combinaciones de deducible, capa de exceso de pérdida
+# (prioridad / límite) y tasa candidata en un solo broadcast de NumPy sobre la
+# matriz pérdidas × capas, en lugar de un punto por combinación.
+
+TASA_SLIP_DEFAULT_POR_MIL = 1.50
+FACTOR_SEMAFORO_AMARILLO = 0.8  # BC sobre el 80% de la tasa = AJUSTADA
+GRILLA_MAX_COMBINACIONES = int(os.getenv('GRILLA_MAX_COMBINACIONES', '5000'))
+# Elementos por bloque de la matriz deducibles × capas × pérdidas (acota la memoria)
+GRILLA_ELEMENTOS_BLOQUE = 4_000_000
+
+
+def clasificar_suficiencia(burning_cost_por_mil, tasa_por_mil) -> Tuple[np.ndarray, np.ndarray]:
+    """Semáforo y suficiencia del burning cost frente a la tasa (escalares o arrays)"""
+    burning_cost, tasa = np.broadcast_arrays(np.asarray(burning_cost_por_mil, dtype=float),
+                                             np.asarray(tasa_por_mil, dtype=float))
+    condiciones = [burning_cost > tasa, burning_cost > tasa * FACTOR_SEMAFORO_AMARILLO]
+    semaforo = np.select(condiciones, ['ROJO', 'AMARILLO'], 'VERDE')
+    suficiencia = np.select(condiciones, ['INSUFICIENTE', 'AJUSTADA'], 'ADECUADA')
+    return semaforo, suficiencia
+
+
+def _lista_montos(grilla: Dict, clave: str, defecto: List[float]) -> List[float]:
+    valores = grilla.get(clave, defecto)
+    if not isinstance(valores, list) or not valores:
+        raise ValueError(f"grilla_pricing.{clave} debe ser una lista no vacía")
+    try:
+        numeros = [float(v) for v in valores]
+    except (TypeError, ValueError):
+        raise ValueError(f"grilla_pricing.{clave} debe contener solo números")
+    if any(not math.isfinite(v) or v < 0 for v in numeros):
+        raise ValueError(f"grilla_pricing.{clave} debe contener montos finitos no negativos")
+    return numeros
+
+
+def normalizar_grilla_pricing(grilla: Any) -> Dict[str, Any]:
+    """
+    Valida parametros.grilla_pricing y completa los valores por defecto
+
+    Raises:
+        ValueError: Grilla mal formada o con más de GRILLA_MAX_COMBINACIONES combinaciones
+    """
+    if not isinstance(grilla, dict):
+        raise ValueError("grilla_pricing debe ser un objeto")
+
+    capas = grilla.get('capas', [{'prioridad_usd': 0, 'limite_usd': None}])
+    if not isinstance(capas, list) or not capas or not all(isinstance(c, dict) for c in capas):
+        raise ValueError("grilla_pricing.capas debe ser una lista de {prioridad_usd, limite_usd}")
+    prioridades, limites = [], []
+    for capa in capas:
+        try:
+            prioridad = float(capa.get('prioridad_usd', 0))
+            limite = math.inf if capa.get('limite_usd') is None else float(capa['limite_usd'])
+        except (TypeError, ValueError):
+            raise ValueError("grilla_pricing.capas: prioridad_usd y limite_usd deben ser números")
+        if not (math.isfinite(prioridad) and prioridad >= 0 and limite > 0):
+            raise ValueError("grilla_pricing.capas: prioridad_usd >= 0 y limite_usd > 0 (null = ilimitado)")
+        prioridades.append(prioridad)
+        limites.append(limite)
+
+    base = grilla.get('base', 'evento')
+    if base not in ('evento', 'siniestro'):
+        raise ValueError("grilla_pricing.base debe ser 'evento' o 'siniestro'")
+
+    normalizada = {
+        'tasas_por_mil': _lista_montos(grilla, 'tasas_por_mil', [TASA_SLIP_DEFAULT_POR_MIL]),
+        'deducibles_usd': _lista_montos(grilla, 'deducibles_usd', [0]),
+        'prioridades_usd': prioridades,
+        'limites_usd': limites,
+        'base': base
+    }
+    combinaciones = (len(normalizada['tasas_por_mil']) * len(normalizada['deducibles_usd'])
+                     * len(normalizada['prioridades_usd']))
+    if combinaciones > GRILLA_MAX_COMBINACIONES:
+        raise ValueError(f"grilla_pricing tiene {combinaciones} combinaciones (máximo {GRILLA_MAX_COMBINACIONES})")
+    return normalizada
+
+
+def calcular_grilla_pricing(perdidas: np.ndarray, eventos: Optional[np.ndarray], años: int,
+                            tiv: float, grilla: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Burning cost, margen y semáforo de cada deducible × capa × tasa
+
+    Args:
+        perdidas: Monto incurrido por siniestro en USD
+        eventos: Id de evento por siniestro; None = cada siniestro es una ocurrencia
+        años: Años del histórico (la pérdida de la capa se anualiza)
+        tiv: Valor total asegurado en USD
+        grilla: Salida de normalizar_grilla_pricing
+
+    El deducible se aplica por siniestro; las pérdidas netas se suman por
+    evento y la capa (prioridad, límite) se aplica por ocurrencia.
+    """
+    deducibles = np.asarray(grilla['deducibles_usd'], dtype=float)
+    prioridades = np.asarray(grilla['prioridades_usd'], dtype=float)
+    limites = np.asarray(grilla['limites_usd'], dtype=float)
+    tasas = np.asarray(grilla['tasas_por_mil'], dtype=float)
+
+    # Deducibles × siniestros, sumado por ocurrencia
+    netas = np.maximum(np.asarray(perdidas, dtype=float)[None, :] - deducibles[:, None], 0.0)
+    if eventos is not None and len(eventos):
+        orden = np.argsort(eventos, kind='stable')
+        ordenados = np.asarray(eventos)[orden]
+        cortes = np.flatnonzero(np.r_[True, ordenados[1:] != ordenados[:-1]])
+        netas = np.add.reduceat(netas[:, orden], cortes, axis=1)
+
+    # Deducibles × capas × ocurrencias, por bloques de ocurrencias
+    n_d, n_c, n_o = len(deducibles), len(prioridades), netas.shape[1]
+    perdida_capa = np.zeros((n_d, n_c))
+    ocurrencias_capa = np.zeros((n_d, n_c), dtype=np.int64)
+    bloque = max(1, GRILLA_ELEMENTOS_BLOQUE // (n_d * n_c))
+    for desde in range(0, n_o, bloque):
+        capa = np.clip(netas[:, None, desde:desde + bloque] - prioridades[None, :, None], 0.0,
+                       limites[None, :, None])
+        perdida_capa += capa.sum(axis=2)
+        ocurrencias_capa += (capa > 0).sum(axis=2)
+
+    años = max(años, 1)
+    perdida_anual = perdida_capa / años
+    burning_cost = perdida_anual / tiv * 1000 if tiv > 0 else np.full_like(perdida_anual, np.nan)
+
+    # Deducibles × capas × tasas
+    margen = tasas[None, None, :] - burning_cost[:, :, None]
+    margen_pct = np.divide(margen * 100, tasas[None, None, :], out=np.zeros_like(margen),
+                           where=tasas[None, None, :] > 0)
+    semaforo, suficiencia = clasificar_suficiencia(burning_cost[:, :, None], tasas[None, None, :])
+    primas = tiv * tasas / 1000
+
+    combinaciones = []
+    for i, deducible in enumerate(deducibles):
+        for j in range(n_c):
+            combinaciones.append({
+                'deducible_usd': float(deducible),
+                'prioridad_usd': float(prioridades[j]),
+                'limite_usd': float(limites[j]) if np.isfinite(limites[j]) else None,
+                'perdida_anual_usd': round(float(perdida_anual[i, j]), 2),
+                'ocurrencias_por_anio': round(float(ocurrencias_capa[i, j]) / años, 4),
+                'burning_cost_por_mil': round(float(burning_cost[i, j]), 4),
+                'tasas': [
+                    {
+                        'tasa_por_mil': float(tasas[k]),
+                        'prima_usd': round(float(primas[k]), 2),
+                        'margen_por_mil': round(float(margen[i, j, k]), 4),
+                        'margen_pct': round(float(margen_pct[i, j, k]), 2),
+                        'semaforo': str(semaforo[i, j, k]),
+                        'suficiencia': str(suficiencia[i, j, k])
+                    }
+                    for k in range(len(tasas))
+                ]
+            })
+
+    return {
+        'base': 'evento' if eventos is not None else 'siniestro',
+        'n_ocurrencias': int(n_o),
+        'años_historico': años,
+        'n_combinaciones': int(n_d * n_c * len(tasas)),
+        'combinaciones': combinaciones
+    }
+
+
+# ============================================
+# INTERVALOS DE CONFIANZA POR BOOTSTRAP
+# ============================================
+# Remuestreo de años (frecuencia anual) y de siniestros (severidad promedio);
+# el burning cost sale del producto frecuencia × severidad de cada remuestra.
+# Las remuestras se generan por bloques con generadores derivados de una
+# semilla, así el resultado no depende del tamaño del bloque ni de los hilos.
+
+BOOTSTRAP_REMUESTRAS_DEFAULT = int(os.getenv('BOOTSTRAP_REMUESTRAS', '10000'))
+BOOTSTRAP_MAX_REMUESTRAS = 200_000
+BOOTSTRAP_SEMILLA_DEFAULT = int(os.getenv('BOOTSTRAP_SEMILLA', '20241230'))
+BOOTSTRAP_HILOS = int(os.getenv('BOOTSTRAP_HILOS', '1'))
+BOOTSTRAP_REMUESTRAS_BLOQUE = 10_000
+# Hasta este número de siniestros la severidad se remuestrea siniestro a siniestro;
+# por encima, los más grandes uno a uno y el resto como suma normal
+BOOTSTRAP_SINIESTROS_EXACTO = 128
+BOOTSTRAP_COLA_EXACTA = 32
+
+
+def normalizar_bootstrap(valor: Any) -> Optional[Dict[str, Any]]:
+    """
+    Valida parametros.bootstrap (true u objeto); None si no se pidió
+
+    Raises:
+        ValueError: Remuestras, semilla o nivel de confianza inválidos
+    """
+    if valor is None or valor is False:
+        return None
+    config = {} if valor is True else valor
+    if not isinstance(config, dict):
+        raise ValueError("bootstrap debe ser true o un objeto {remuestras, semilla, nivel_confianza}")
+
+    try:
+        remuestras = int(config.get('remuestras', BOOTSTRAP_REMUESTRAS_DEFAULT))
+        semilla = int(config.get('semilla', BOOTSTRAP_SEMILLA_DEFAULT))
+        nivel_confianza = float(config.get('nivel_confianza', 0.90))
+    except (TypeError, ValueError):
+        raise ValueError("bootstrap: remuestras, semilla y nivel_confianza deben ser números")
+
+    if not 100 <= remuestras <= BOOTSTRAP_MAX_REMUESTRAS:
+        raise ValueError(f"bootstrap.remuestras debe estar entre 100 y {BOOTSTRAP_MAX_REMUESTRAS}")
+    if not 0.5 <= nivel_confianza < 1:
+        raise ValueError("bootstrap.nivel_confianza debe estar entre 0.5 y 1")
+    return {'remuestras': remuestras, 'semilla': semilla, 'nivel_confianza': nivel_confianza}
+
+
+def _cuerpo_y_cola(montos: np.ndarray) -> Tuple[float, float, np.ndarray]:
+    """Media y desviación del cuerpo y los BOOTSTRAP_COLA_EXACTA siniestros más grandes"""
+    ordenados = np.sort(montos)
+    cuerpo, cola = ordenados[:-BOOTSTRAP_COLA_EXACTA], ordenados[-BOOTSTRAP_COLA_EXACTA:]
+    return float(cuerpo.mean()), float(cuerpo.std()), cola
+
+
+def _bloque_bootstrap(semilla: np.random.SeedSequence, remuestras: int, conteos_anuales: np.ndarray,
+                      montos: np.ndarray, cuerpo_y_cola: Optional[Tuple]) -> Tuple[np.ndarray, np.ndarray]:
+    """Frecuencia anual y severidad promedio de un bloque de remuestras"""
+    rng = np.random.default_rng(semilla)
+    años = len(conteos_anuales)
+    frecuencia = conteos_anuales[rng.integers(0, años, size=(remuestras, años))].mean(axis=1)
+
+    n = len(montos)
+    if cuerpo_y_cola is None:
+        severidad = np.empty(remuestras)
+        filas = max(1, (BOOTSTRAP_REMUESTRAS_BLOQUE * 64) // n)
+        for desde in range(0, remuestras, filas):
+            hasta = min(desde + filas, remuestras)
+            severidad[desde:hasta] = montos[rng.integers(0, n, size=(hasta - desde, n))].mean(axis=1)
+    else:
+        # Cada siniestro de la cola aparece Poisson(1) veces; los n - T restantes
+        # salen del cuerpo y su suma es normal (teorema central del límite)
+        media, desviacion, cola = cuerpo_y_cola
+        conteos = rng.poisson(1.0, size=(remuestras, len(cola))).astype(float)
+        del_cuerpo = np.maximum(n - conteos.sum(axis=1), 0)
+        sumas = (conteos @ cola + del_cuerpo * media
+                 + np.sqrt(del_cuerpo) * desviacion * rng.standard_normal(remuestras))
+        severidad = sumas / n
+    return frecuencia, severidad
+
+
+def _intervalo(muestras: np.ndarray, estimacion: float, nivel_confianza: float,
+               decimales: int = 2) -> Dict[str, float]:
+    alfa = (1 - nivel_confianza) / 2
+    inferior, superior = np.percentile(muestras, [alfa * 100, (1 - alfa) * 100])
+    return {
+        'estimacion': round(float(estimacion), decimales),
+        'ic_inferior': round(float(inferior), decimales),
+        'ic_superior': round(float(superior), decimales),
+        'error_estandar': round(float(muestras.std(ddof=1)), decimales)
+    }
+
+
+def bootstrap_siniestralidad(montos: np.ndarray, años: np.ndarray, tiv: float,
+                             config: Dict[str, Any], hilos: int = BOOTSTRAP_HILOS) -> Dict[str, Any]:
+    """
+    Intervalos de confianza de frecuencia anual, severidad promedio y burning cost
+
+    Args:
+        montos: Monto incurrido por siniestro
+        años: Año de cada siniestro
+        tiv: Valor total asegurado (misma moneda que montos)
+        config: Salida de normalizar_bootstrap
+        hilos: Hilos para repartir los bloques de remuestras
+    """
+    montos = np.asarray(montos, dtype=float)
+    _, conteos_anuales = np.unique(años, return_counts=True)
+    conteos_anuales = conteos_anuales.astype(float)
+    cuerpo_y_cola = _cuerpo_y_cola(montos) if len(montos) > BOOTSTRAP_SINIESTROS_EXACTO else None
+
+    remuestras = config['remuestras']
+    tamaños = [min(BOOTSTRAP_REMUESTRAS_BLOQUE, remuestras - desde)
+               for desde in range(0, remuestras, BOOTSTRAP_REMUESTRAS_BLOQUE)]
+    semillas = np.random.SeedSequence(config['semilla']).spawn(len(tamaños))
+    tareas = [(semilla, tamaño, conteos_anuales, montos, cuerpo_y_cola) for semilla, tamaño in zip(semillas, tamaños)]
+
+    if hilos > 1 and len(tareas) > 1:
+        with ThreadPoolExecutor(max_workers=hilos) as pool:
+            bloques = list(pool.map(lambda tarea: _bloque_bootstrap(*tarea), tareas))
+    else:
+        bloques = [_bloque_bootstrap(*tarea) for tarea in tareas]
+
+    frecuencia = np.concatenate([b[0] for b in bloques])
+    severidad = np.concatenate([b[1] for b in bloques])
+    frecuencia_media = len(montos) / len(conteos_anuales)
+    severidad_media = float(montos.mean())
+    nivel = config['nivel_confianza']
+
+    resultado = {
+        **config,
+        # Con cuerpo_y_cola la severidad es aproximada: solo la cola se remuestrea exacta
+        'metodo_severidad': 'aprox_normal' if cuerpo_y_cola is not None else 'exacto',
+        'frecuencia_anual': _intervalo(frecuencia, frecuencia_media, nivel),
+        'severidad_promedio': _intervalo(severidad, severidad_media, nivel),
+        'burning_cost_por_mil': None,
+        'advertencias': []
+    }
+    if tiv > 0:
+        resultado['burning_cost_por_mil'] = _intervalo(frecuencia * severidad / tiv * 1000,
+                                                       frecuencia_media * severidad_media / tiv * 1000, nivel, 4)
+    if len(conteos_anuales) < 3:
+        resultado['advertencias'].append(
+            f"Solo {len(conteos_anuales)} año(s): el intervalo de frecuencia no refleja la variación entre años")
+    return resultado
+
+
+# ============================================
+# TRIÁNGULOS DE DESARROLLO Y CHAIN-LADDER
+# ============================================
+# Triángulos año de ocurrencia × período de desarrollo (años) como matrices
+# NumPy. Cada evaluación (loss run anual o corte anual de la KB) aporta una
+# diagonal de montos acumulados; los factores chain-ladder salen de sumas
+# enmascaradas por columna, sin recorrer celdas.
+
+TRIANGULO_FACTOR_COLA = float(os.getenv('TRIANGULO_FACTOR_COLA', '1.0'))
+TRIANGULO_BASES = ('incurrido', 'pagado')
+
+
+def año_evaluacion_archivo(nombre: str, df: pd.DataFrame) -> Optional[int]:
+    """
+    Año de corte de un loss run: el año del nombre del archivo (ej.
+    'Siniestralidad 2023.xlsx') si no es anterior al último siniestro; si no,
+    el año del último siniestro
+    """
+    ultimo = pd.to_datetime(df['fecha_siniestro'], errors='coerce').dt.year.max()
+    if pd.isna(ultimo):
+        return None
+    en_nombre = [int(a) for a in re.findall(r'(?<!\d)(?:19|20)\d{2}(?!\d)', nombre)]
+    candidatos = [a for a in en_nombre if a >= ultimo]
+    return min(candidatos) if candidatos else int(ultimo)
+
+
+def construir_triangulo(origen: np.ndarray, desarrollo: np.ndarray,
+                        montos: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Triángulo acumulado (años de ocurrencia, matriz) desde montos por celda
+
+    Args:
+        origen: Año de ocurrencia de cada monto
+        desarrollo: Años entre ocurrencia y evaluación (0 = mismo año)
+        montos: Monto acumulado a la fecha de evaluación
+
+    Una celda es observada si su año calendario (origen + desarrollo) es una
+    evaluación que cubre ese año de ocurrencia; observada sin montos vale 0 y
+    no observada NaN.
+    """
+    origen = np.asarray(origen, dtype=np.int64)
+    desarrollo = np.asarray(desarrollo, dtype=np.int64)
+    montos = np.asarray(montos, dtype=float)
+    validos = desarrollo >= 0
+    origen, desarrollo, montos = origen[validos], desarrollo[validos], montos[validos]
+
+    años = np.arange(origen.min(), origen.max() + 1)
+    n_desarrollo = int(desarrollo.max()) + 1
+    celdas = (origen - años[0]) * n_desarrollo + desarrollo
+    matriz = np.bincount(celdas, weights=montos, minlength=len(años) * n_desarrollo)
+    matriz = matriz.reshape(len(años), n_desarrollo)
+
+    # Primer año de ocurrencia que cubre cada evaluación (año calendario)
+    calendario = origen + desarrollo
+    primer_origen = np.full(int(calendario.max()) - años[0] + 1, np.iinfo(np.int64).max)
+    np.minimum.at(primer_origen, calendario - años[0], origen)
+
+    celda_calendario = años[:, None] + np.arange(n_desarrollo)[None, :] - años[0]
+    dentro = celda_calendario < len(primer_origen)
+    observado = dentro & (años[:, None] >= primer_origen[np.minimum(celda_calendario, len(primer_origen) - 1)])
+    matriz[~observado] = np.nan
+    return años, matriz
+
+
+def chain_ladder(matriz: np.ndarray, factor_cola: float = TRIANGULO_FACTOR_COLA) -> Dict[str, np.ndarray]:
+    """
+    Factores de desarrollo ponderados por volumen, último estimado e IBNR por año
+
+    Los factores usan solo los años con ambos períodos observados; un factor
+    sin datos vale 1 y se marca como no estimable.
+    """
+    n_años, n_desarrollo = matriz.shape
+    actual, siguiente = matriz[:, :-1], matriz[:, 1:]
+    pares = ~np.isnan(actual) & ~np.isnan(siguiente)
+    numerador = np.where(pares, siguiente, 0.0).sum(axis=0)
+    denominador = np.where(pares, actual, 0.0).sum(axis=0)
+    factores = np.divide(numerador, denominador, out=np.ones_like(numerador), where=denominador > 0)
+
+    # Factor a último desde cada período: producto de los factores restantes × cola
+    a_ultimo = np.r_[np.cumprod(factores[::-1])[::-1], 1.0] * factor_cola
+
+    observados = ~np.isnan(matriz)
+    periodo_actual = n_desarrollo - 1 - np.argmax(observados[:, ::-1], axis=1)
+    valor_actual = np.nan_to_num(matriz[np.arange(n_años), periodo_actual])
+    ultimo = valor_actual * a_ultimo[periodo_actual]
+    return {
+        'factores': factores,
+        'factores_estimables': denominador > 0,
+        'factor_a_ultimo': a_ultimo,
+        'periodo_actual': periodo_actual,
+        'valor_actual': valor_actual,
+        'ultimo': ultimo,
+        'ibnr': ultimo - valor_actual
+    }
+
+
+def resumir_chain_ladder(años: np.ndarray, matriz: np.ndarray, base: str) -> Dict[str, Any]:
+    """Triángulo, factores e IBNR por año de ocurrencia listos para JSON"""
+    resultado = chain_ladder(matriz)
+    return {
+        'base': base,
+        'años_ocurrencia': [int(a) for a in años],
+        'periodos_desarrollo': list(range(matriz.shape[1])),
+        'triangulo': [[None if np.isnan(v) else round(float(v), 2) for v in fila] for fila in matriz],
+        'factores': [round(float(f), 4) for f in resultado['factores']],
+        'factores_estimables': [bool(e) for e in resultado['factores_estimables']],
+        'factor_cola': TRIANGULO_FACTOR_COLA,
+        'por_año': [
+            {
+                'año': int(años[i]),
+                'periodo_actual': int(resultado['periodo_actual'][i]),
+                'valor_actual': round(float(resultado['valor_actual'][i]), 2),
+                'factor_a_ultimo': round(float(resultado['factor_a_ultimo'][resultado['periodo_actual'][i]]), 4),
+                'ultimo': round(float(resultado['ultimo'][i]), 2),
+                'ibnr': round(float(resultado['ibnr'][i]), 2)
+            }
+            for i in range(len(años))
+        ],
+        'valor_actual_total': round(float(resultado['valor_actual'].sum()), 2),
+        'ultimo_total': round(float(resultado['ultimo'].sum()), 2),
+        'ibnr_total': round(float(resultado['ibnr'].sum()), 2)
+    }
+
+
+# ============================================
+# DEDUPLICACIÓN KB × LOSS RUNS CARGADOS
+# ============================================
+# Un siniestro del histórico de la KB que también viene en un loss run cargado
+# se cuenta una sola vez. Las claves normalizadas de ambos lados se reducen a
+# un hash de 64 bits y se cruzan con un índice hash (pd.Index.get_indexer), en
+# tiempo lineal. Dentro de una misma clave los siniestros se emparejan uno a
+# uno por orden de aparición.
+
+# Niveles de coincidencia, del más al menos específico
+NIVELES_DEDUPLICACION = {
+    'referencia': ['fecha', 'referencia'],
+    'fecha_peril_monto': ['fecha', 'peril', 'monto']
+}
+COLUMNAS_REFERENCIA_ARCHIVO = ['numero_siniestro', 'num_poliza']
+
+
+def _referencia_normalizada(valores: pd.Series) -> pd.Series:
+    """Referencia en mayúsculas y solo alfanuméricos ('sin-2023/001' -> 'SIN2023001'); vacía = None"""
+    texto = valores.astype('string').str.upper().str.replace(r'[^0-9A-Z]', '', regex=True)
+    return texto.where(texto.str.len() > 0)
+
+
+def claves_deduplicacion(df: pd.DataFrame, columna_monto: str,
+                         columnas_referencia: List[str]) -> pd.DataFrame:
+    """Fecha (día), referencia, peril y monto redondeado de cada siniestro"""
+    causas = df['causa_siniestro'].fillna('').astype(str) if 'causa_siniestro' in df.columns \
+        else pd.Series('', index=df.index)
+    codigos, unicas = pd.factorize(causas)
+    perils = np.array([clasificar_peril(c)[0] for c in unicas], dtype=object)
+
+    columna_referencia = next((c for c in columnas_referencia if c in df.columns), None)
+    montos = pd.to_numeric(df[columna_monto], errors='coerce') if columna_monto in df.columns \
+        else pd.Series(np.nan, index=df.index)
+    return pd.DataFrame({
+        'fecha': pd.to_datetime(df['fecha_siniestro'], errors='coerce').dt.normalize().astype('datetime64[ns]'),
+        'referencia': _referencia_normalizada(df[columna_referencia]) if columna_referencia
+        else pd.Series(None, index=df.index, dtype='string'),
+        'peril': perils[codigos] if len(unicas) else np.array([], dtype=object),
+        'monto': montos.round(0)
+    }, index=df.index)
+
+
+def _hash_claves(claves: pd.DataFrame, columnas: List[str]) -> np.ndarray:
+    """Hash de 64 bits de (columnas, orden dentro de la clave)"""
+    claves = claves[columnas].assign(_orden=claves.groupby(columnas, sort=False, dropna=False).cumcount())
+    return pd.util.hash_pandas_object(claves, index=False).to_numpy()
+
+
+def deduplicar_siniestros(df_archivos: pd.DataFrame, df_kb: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """
+    Quita del histórico KB los siniestros que ya vienen en los loss runs
+
+    La KB guarda el incurrido en USD y solo el pagado en moneda original
+    (loss_paid_dynamic_oc), así que el monto de la clave es el pagado.
+
+    Returns:
+        (histórico KB sin duplicados, reporte de coincidencias por nivel)
+    """
+    claves_archivo = claves_deduplicacion(df_archivos, 'monto_pagado', COLUMNAS_REFERENCIA_ARCHIVO)
+    claves_kb = claves_deduplicacion(df_kb, 'monto_pagado_cop', ['num_poliza'])
+
+    libre_archivo = np.ones(len(claves_archivo), dtype=bool)
+    duplicado_kb = np.zeros(len(claves_kb), dtype=bool)
+    por_nivel = {}
+
+    for nivel, columnas in NIVELES_DEDUPLICACION.items():
+        usable_archivo = libre_archivo & claves_archivo[columnas].notna().all(axis=1).to_numpy()
+        usable_kb = ~duplicado_kb & claves_kb[columnas].notna().all(axis=1).to_numpy()
+        if not usable_archivo.any() or not usable_kb.any():
+            por_nivel[nivel] = 0
+            continue
+
+        filas_kb = np.flatnonzero(usable_kb)
+        indice_kb = pd.Index(_hash_claves(claves_kb.iloc[filas_kb], columnas))
+        filas_archivo = np.flatnonzero(usable_archivo)
+        posiciones = indice_kb.get_indexer(_hash_claves(claves_archivo.iloc[filas_archivo], columnas))
+
+        coincide = posiciones >= 0
+        duplicado_kb[filas_kb[posiciones[coincide]]] = True
+        libre_archivo[filas_archivo[coincide]] = False
+        por_nivel[nivel] = int(coincide.sum())
+
+    reporte = {
+        'siniestros_archivo': len(df_archivos),
+        'siniestros_kb': len(df_kb),
+        'duplicados': int(duplicado_kb.sum()),
+        'por_nivel': por_nivel,
+        'siniestros_kb_agregados': int((~duplicado_kb).sum())
+    }
+    return df_kb[~duplicado_kb], reporte
+
+
+class AnalizadorTecnico:
+    """Clase principal para el análisis técnico de reaseguros con Knowledge Base"""
+
+    def __init__(self, asegurado_nombre: Optional[str] = None):
+        self.datos_consolidados = {
+            'siniestralidad': None,
+            'tiv': None,
+            'tiv_total': 0,
+            'slip': {},
+            'asegurado_nombre': asegurado_nombre or 'Desconocido',
+            'insured_key': None,
+            'tiene_historico_kb': False,
+            'origen_kb': None,
+            'archivos_procesados': [],
+            'formato_tiv': None,
+            'formatos_siniestros': [],
+            'cache_libros': [],
+            'tiv_estadisticas': None,
+            'eventos': None,
+            'incertidumbre': None,
+            'chain_ladder': None,
+            'deduplicacion_kb': None,
+            'resumen_kb': None
+        }
+        self.usar_cache_libros = True
+        # Relación de valores: None = streaming según tamaño, True/False = forzar
+        self.tiv_streaming: Optional[bool] = None
+        self.tiv_conservar_ubicaciones = False
+        # Cláusula horaria por peril de este request (sobre HORAS_CLAUSULA_EVENTO)
+        self.horas_clausula_evento: Dict[str, float] = {}
+        # Tasa propuesta del slip y grilla de pricing opcional (normalizar_grilla_pricing)
+        self.tasa_slip_por_mil = TASA_SLIP_DEFAULT_POR_MIL
+        self.grilla_pricing: Optional[Dict[str, Any]] = None
+        # Intervalos de confianza por bootstrap (normalizar_bootstrap), opcional
+        self.bootstrap: Optional[Dict[str, Any]] = None
+        self.api_cotizacion = CotizacionDolar()
+        self.moneda_local = None
+        self.tasa_cambio = None
+        # Siniestros normalizados por archivo y el histórico KB tal como llegó: consolidar
+        # los combina, y una sesión solo vuelve a parsear los archivos que cambian
+        self.siniestros_por_archivo: Dict[str, pd.DataFrame] = {}
+        self.historico_kb: Optional[pd.DataFrame] = None
+        logger.info(f"Analizador Técnico v{VERSION} inicializado con API de cotizaciones.")
+
+    def preparar_reanalisis(self, archivos_a_quitar: List[str]):
+        """Descarta los resultados derivados del análisis anterior (sesión) y los archivos quitados"""
+        for nombre in archivos_a_quitar:
+            if self.siniestros_por_archivo.pop(nombre, None) is not None:
+                logger.info(f"🗑️ Sesión: se quita {nombre}")
+            if nombre in self.datos_consolidados['archivos_procesados']:
+                self.datos_consolidados['archivos_procesados'].remove(nombre)
+        self.datos_consolidados.update({'cache_libros': [], 'eventos': None, 'incertidumbre': None,
+                                        'chain_ladder': None, 'deduplicacion_kb': None})
+
+    def cargar_historico_desde_kb(self, años_historico: int = 5, solo_resumen: bool = False) -> bool:
+        """
+        Intenta cargar histórico de siniestros desde Azure SQL KB
+
+        Args:
+            años_historico: Años de histórico a considerar
+            solo_resumen: La renovación no necesita el detalle de siniestros: se usa el
+                resumen materializado del asegurado (RESUMENES_KB) si está vigente
+
+        Returns:
+            True si se encontró y cargó histórico, False si no
+        """
+        asegurado = self.datos_consolidados['asegurado_nombre']
+
+        # Buscar asegurado en KB
+        insured_key = buscar_asegurado_en_kb(asegurado)
+
+        if not insured_key:
+            logger.info("📊 Cliente SIN histórico en KB - análisis solo con archivos")
+            return False
+
+        # Guardar insured_key
+        self.datos_consolidados['insured_key'] = insured_key
+
+        # Resumen materializado: una lectura por clave primaria, sin traer siniestros
+        if solo_resumen and RESUMENES_KB.habilitado:
+            resumen = RESUMENES_KB.obtener(insured_key, años_historico)
+            if resumen is not None:
+                self.datos_consolidados['resumen_kb'] = resumen
+                self.datos_consolidados['origen_kb'] = 'resumenes'
+                self.datos_consolidados['tiene_historico_kb'] = resumen['n_siniestros'] > 0
+                logger.info(f"✅ Resumen KB cargado: {resumen['n_siniestros']} siniestros "
+                            f"({len(resumen['por_anio'])} años) sin consultar el detalle")
+                return resumen['n_siniestros'] > 0
+
+        # Consultar siniestros históricos
+        df_historico = consultar_historico_siniestros(insured_key, años_historico)
+        self.datos_consolidados['origen_kb'] = df_historico.attrs.get('origen_kb')
+
+        if df_historico.empty:
+            logger.info("📊 Asegurado encontrado en KB pero SIN siniestros históricos")
+            return False
+
+        # Marcar que tiene histórico
+        self.datos_consolidados['tiene_historico_kb'] = True
+        self.datos_consolidados['siniestralidad'] = df_historico
+        self.historico_kb = df_historico
+
+        logger.info(f"✅ Histórico KB cargado: {len(df_historico)} siniestros")
+        return True
+
+    def consolidar_siniestralidad(self, archivos_bytes: List[tuple]) -> pd.DataFrame:
+        """
+        Consolida siniestralidad desde archivos Excel
+        Si ya existe histórico de KB, lo combina
+
+        Cada archivo normalizado queda en siniestros_por_archivo (un nombre que
+        ya estaba lo reemplaza), así en una sesión solo se parsean los nuevos.
+        """
+        try:
+            if not archivos_bytes and not self.siniestros_por_archivo:
+                logger.warning("No se proporcionaron archivos de siniestralidad.")
+                return self._siniestralidad_solo_kb()
+
+            def leer(filename: str, archivo: bytes) -> Optional[pd.DataFrame]:
+                with medir_etapa('siniestros.archivo', archivo=filename):
+                    return leer_archivo_siniestros(filename, archivo, usar_cache=self.usar_cache_libros)
+
+            # Con pool de procesos, varios archivos se parsean en paralelo
+            if pool_parseo() is not None and len(archivos_bytes) > 1:
+                lecturas = [enviar_io(leer, filename, archivo) for filename, archivo in archivos_bytes]
+            else:
+                lecturas = [None] * len(archivos_bytes)
+
+            for (filename, archivo), lectura in zip(archivos_bytes, lecturas):
+                # Registrar nombres de archivos procesados para detección de moneda
+                if filename not in self.datos_consolidados['archivos_procesados']:
+                    self.datos_consolidados['archivos_procesados'].append(filename)
+
+                df = lectura.result() if lectura is not None else leer(filename, archivo)
+
+                if df is not None:
+                    # Cada loss run es una evaluación: una diagonal del triángulo de desarrollo
+                    df['año_evaluacion'] = año_evaluacion_archivo(filename, df) if 'fecha_siniestro' in df.columns else None
+                    self.datos_consolidados['cache_libros'].append(
+                        {'archivo': filename, 'rol': 'siniestralidad', 'hit': df.attrs.get('cache_hit', False)})
+                    METRICAS.archivos.inc(rol='siniestralidad', formato=df.attrs.get('formato') or 'desconocido')
+                    METRICAS.siniestros.inc(len(df), fuente='archivo')
+                    self.siniestros_por_archivo[filename] = df
+
+            return self.combinar_siniestralidad()
+
+        except Exception as e:
+            logger.exception(f"Error consolidando siniestralidad: {str(e)}")
+            return self._siniestralidad_solo_kb()
+
+    def combinar_siniestralidad(self) -> pd.DataFrame:
+        """Une los siniestros de cada archivo con el histórico KB (sin volver a parsear)"""
+        dataframes = list(self.siniestros_por_archivo.values())
+        self.datos_consolidados['formatos_siniestros'] = [df.attrs.get('formato') for df in dataframes]
+
+        if not dataframes:
+            logger.warning("No se procesaron archivos válidos.")
+            return self._siniestralidad_solo_kb()
+
+        df_consolidado = pd.concat(dataframes, ignore_index=True)
+
+        # Si tenemos histórico de KB, combinarlo sin contar dos veces los siniestros repetidos
+        if self.datos_consolidados.get('tiene_historico_kb'):
+            df_kb = self.historico_kb
+            with medir_etapa('siniestros.deduplicacion_kb', filas=len(df_consolidado) + len(df_kb)):
+                df_kb, reporte = deduplicar_siniestros(df_consolidado, df_kb)
+            self.datos_consolidados['deduplicacion_kb'] = reporte
+            logger.info(f"📊 Combinando: {len(df_consolidado)} siniestros archivo + {len(df_kb)} KB "
+                        f"({reporte['duplicados']} duplicados descartados)")
+            df_consolidado = pd.concat([df_consolidado, df_kb], ignore_index=True)
+
+        # Limpieza y normalización
+        df_consolidado = df_consolidado[df_consolidado['monto_incurrido'] > 0].copy()
+        df_consolidado = df_consolidado.sort_values('fecha_siniestro', ascending=False).reset_index(drop=True)
+
+        self.datos_consolidados['siniestralidad'] = df_consolidado
+        logger.info(f"✅ Siniestralidad consolidada: {len(df_consolidado)} registros")
+        return df_consolidado
+
+    def _siniestralidad_solo_kb(self) -> pd.DataFrame:
+        """Sin archivos válidos: el histórico de KB si existe, si no un DataFrame vacío"""
+        if self.datos_consolidados.get('tiene_historico_kb'):
+            self.datos_consolidados['siniestralidad'] = self.historico_kb
+            return self.historico_kb
+        self.datos_consolidados['siniestralidad'] = pd.DataFrame()
+        return pd.DataFrame()
+
+    @property
+    def modo_tiv(self) -> str:
+        """'tabla', 'streaming' o 'auto' (streaming desde TIV_STREAMING_MIN_FILAS)"""
+        if self.tiv_conservar_ubicaciones or self.tiv_streaming is False:
+            return 'tabla'
+        return 'streaming' if self.tiv_streaming else 'auto'
+
+    def procesar_tiv(self, archivo_bytes: bytes, filename: str) -> pd.DataFrame:
+        """Procesa el archivo TIV, desde la cache de libros si ya fue parseado"""
+        # El resultado depende del modo pedido: cada modo tiene su propia entrada
+        rol = 'tiv' if self.modo_tiv == 'auto' else f'tiv_{self.modo_tiv}'
+        if self.usar_cache_libros:
+            cacheado = CACHE_LIBROS.obtener(rol, archivo_bytes)
+            if cacheado is not None:
+                df_tiv, metadata = cacheado
+                logger.info(f"⚡ TIV desde cache de libros: {filename} (Total: {metadata['tiv_total'] or 0:,.2f})")
+                self.datos_consolidados['formato_tiv'] = metadata['formato']
+                self.datos_consolidados['tiv_total'] = metadata['tiv_total']
+                self.datos_consolidados['tiv_estadisticas'] = metadata.get('estadisticas')
+                self.datos_consolidados['tiv'] = df_tiv
+                self.datos_consolidados['cache_libros'].append({'archivo': filename, 'rol': 'tiv', 'hit': True})
+                return df_tiv
+
+        df_tiv = self._extraer_tiv(archivo_bytes, filename)
+
+        if self.usar_cache_libros:
+            CACHE_LIBROS.guardar(rol, archivo_bytes, df_tiv, {
+                'formato': self.datos_consolidados['formato_tiv'],
+                'tiv_total': self.datos_consolidados['tiv_total'],
+                'estadisticas': self.datos_consolidados['tiv_estadisticas']
+            })
+            self.datos_consolidados['cache_libros'].append({'archivo': filename, 'rol': 'tiv', 'hit': False})
+        return df_tiv
+
+    def _usar_streaming_tiv(self, archivo_bytes: bytes, hoja: str) -> bool:
+        """Agregar la hoja en streaming en vez de cargar la tabla de ubicaciones"""
+        if self.modo_tiv == 'tabla' or detectar_tipo_contenido(archivo_bytes) != 'xlsx':
+            return False
+        if self.modo_tiv == 'streaming':
+            return True
+        return filas_estimadas_xlsx(archivo_bytes, hoja) >= TIV_STREAMING_MIN_FILAS
+
+    def _registrar_tiv_streaming(self, estadisticas: Dict[str, Any], hoja: str, formato: str) -> pd.DataFrame:
+        """Resumen de una fila (la tabla de ubicaciones no se conserva en streaming)"""
+        df_tiv = pd.DataFrame([{
+            'tiv_total': estadisticas['tiv_total'],
+            'n_ubicaciones': estadisticas['n_ubicaciones'],
+            **estadisticas['componentes'],
+            'fuente': f'{hoja} (streaming)'
+        }])
+        self.datos_consolidados['formato_tiv'] = formato
+        self.datos_consolidados['tiv'] = df_tiv
+        self.datos_consolidados['tiv_total'] = estadisticas['tiv_total']
+        self.datos_consolidados['tiv_estadisticas'] = estadisticas
+        return df_tiv
+
+    def _extraer_tiv(self, archivo_bytes: bytes, filename: str) -> pd.DataFrame:
+        """Extrae el TIV con múltiples estrategias de extracción"""
         try:
             df_tiv = None
             tiv_total = None
 
             # ESTRATEGIA 1: Buscar en hoja "Resumen" celda G24 (Río Magdalena)
-            try:
-                excel_file = pd.ExcelFile(io.BytesIO(archivo_bytes), engine='openpyxl')
-                if 'Resumen' in excel_file.sheet_names or 'RESUMEN' in excel_file.sheet_names:
-                    sheet_name = 'Resumen' if 'Resumen' in excel_file.sheet_names else 'RESUMEN'
-                    df_resumen = pd.read_excel(io.BytesIO(archivo_bytes), sheet_name=sheet_name, header=None, engine='openpyxl')
-
-                    # Intentar celda G24 (fila 23, columna 6 en zero-indexed)
-                    if df_resumen.shape[0] > 23 and df_resumen.shape[1] > 6:
-                        valor_g24 = df_resumen.iloc[23, 6]
+            with medir_etapa('tiv.estrategia_1_resumen_g24'):
+                try:
+                    sheet_names = hojas_libro(archivo_bytes)
+                    if 'Resumen' in sheet_names or 'RESUMEN' in sheet_names:
+                        sheet_name = 'Resumen' if 'Resumen' in sheet_names else 'RESUMEN'
+
+                        # Solo la celda G24: la hoja se lee en streaming hasta la fila 24
+                        valor_g24 = leer_celdas(archivo_bytes, sheet_name, ['G24'])['G24']
                         # Ya viene como float, solo convertir
-                        if pd.notna(valor_g24):
+                        if valor_g24 is not None:
                             tiv_total = float(valor_g24)
                             if tiv_total > 1000000000:
                                 logger.info(f"✅ TIV: Detectada estructura Resumen G24 (Río Magdalena)")
@@ -677,147 +4123,207 @@ class AnalizadorTecnico:
 
                                 # Crear DataFrame básico
                                 df_tiv = pd.DataFrame([{'tiv_total': tiv_total, 'fuente': 'Resumen!G24'}])
+                                self.datos_consolidados['formato_tiv'] = 'rio_magdalena_tiv'
                                 self.datos_consolidados['tiv'] = df_tiv
                                 self.datos_consolidados['tiv_total'] = tiv_total
                                 return df_tiv
-            except Exception as e:
-                logger.debug(f"Estrategia 1 (Resumen G24) no aplicó: {e}")
+                except Exception as e:
+                    logger.debug(f"Estrategia 1 (Resumen G24) no aplicó: {e}")
 
             # ESTRATEGIA 2: Estructura Antioquia (celda W18)
-            try:
-                df_raw = pd.read_excel(io.BytesIO(archivo_bytes), header=None, engine='openpyxl')
+            with medir_etapa('tiv.estrategia_2_antioquia_w18'):
+                try:
+                    # Solo la celda W18 de la primera hoja; la tabla se lee si la estrategia aplica.
+                    # W18 está 10 filas bajo el encabezado: con filas de título extra se desplaza
+                    fila_encabezado = max(ubicar_encabezado(archivo_bytes, 0, 'antioquia_tiv', 7), 7)
+                    celda_total = f'W{fila_encabezado + 11}'
+                    valor_w18 = leer_celdas(archivo_bytes, 0, [celda_total])[celda_total]
 
-                if df_raw.shape[1] >= 23:
-                    try:
-                        valor_test = pd.to_numeric(df_raw.iloc[17, 22], errors='coerce')
-                        if pd.notna(valor_test) and valor_test > 1000000000:
-                            logger.info("✅ TIV: Detectada estructura tipo Antioquia (W18)")
-                            tiv_total = valor_test
-                            logger.info(f"TIV Total extraído desde W18: {tiv_total:,.2f}")
-                            df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), header=7, engine='openpyxl')
-                            self.datos_consolidados['tiv'] = df_tiv
-                            self.datos_consolidados['tiv_total'] = tiv_total
-                            return df_tiv
-                    except Exception as e:
-                        logger.debug(f"Estrategia 2 (Antioquia W18) no aplicó: {e}")
+                    if valor_w18 is not None:
+                        try:
+                            valor_test = pd.to_numeric(valor_w18, errors='coerce')
+                            if pd.notna(valor_test) and valor_test > 1000000000:
+                                logger.info("✅ TIV: Detectada estructura tipo Antioquia (W18)")
+                                tiv_total = valor_test
+                                logger.info(f"TIV Total extraído desde {celda_total}: {tiv_total:,.2f}")
+                                df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), header=fila_encabezado,
+                                                       engine='openpyxl')
+                                self.datos_consolidados['formato_tiv'] = 'antioquia_tiv'
+                                self.datos_consolidados['tiv'] = df_tiv
+                                self.datos_consolidados['tiv_total'] = tiv_total
+                                self.datos_consolidados['tiv_estadisticas'] = estadisticas_tiv(
+                                    df_tiv, [], fila_encabezado)
+                                return df_tiv
+                        except Exception as e:
+                            logger.debug(f"Estrategia 2 (Antioquia W18) no aplicó: {e}")
 
-            except Exception as e:
-                logger.debug(f"Estrategia 2 falló al leer Excel: {e}")
+                except Exception as e:
+                    logger.debug(f"Estrategia 2 falló al leer Excel: {e}")
 
             # ESTRATEGIA 3: Buscar columna suma_asegurada en cualquier hoja
-            try:
-                df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), engine='openpyxl')
-            except Exception:
-                # Intentar CSV
-                for encoding in ['utf-8', 'latin-1']:
-                    try:
-                        df_tiv = pd.read_csv(io.BytesIO(archivo_bytes), encoding=encoding, delimiter=';')
-                        break
-                    except Exception:
-                        continue
+            with medir_etapa('tiv.estrategia_3_columna_suma'):
+                formato_estrategia_3 = 'excel_generico_tiv'
+                fila_encabezado_3 = 0
+                posibles = ['suma_asegurada', 'valor_asegurado', 'tiv', 'total_insured_value']
+                tabla_omitida = False
+                try:
+                    tipo_contenido = detectar_tipo_contenido(archivo_bytes)
+                    if tipo_contenido == 'csv':
+                        df_tiv = leer_csv(archivo_bytes)
+                        formato_estrategia_3 = 'csv_tiv'
+                    elif tipo_contenido == 'xlsx' and not celdas_contienen(archivo_bytes, 0, ['A1:AZ50'], posibles):
+                        # Sin columna de suma asegurada en el encabezado: la tabla se lee solo si hace falta
+                        df_tiv = pd.DataFrame(columns=pd.Index([], dtype=object))
+                        tabla_omitida = True
+                    else:
+                        fila_encabezado_3 = ubicar_encabezado(archivo_bytes, 0, formato_estrategia_3, 0)
+                        df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), header=fila_encabezado_3,
+                                               engine='openpyxl')
+                except Exception as e:
+                    logger.warning(f"No se pudo leer el TIV {filename}: {e}")
 
-            if df_tiv is None:
-                raise Exception("No se pudo decodificar el archivo TIV con ninguna estrategia")
+                if df_tiv is None:
+                    raise Exception("No se pudo decodificar el archivo TIV con ninguna estrategia")
 
-            df_tiv.columns = df_tiv.columns.str.strip().str.lower().str.replace(' ', '_')
+                df_tiv.columns = df_tiv.columns.str.strip().str.lower().str.replace(' ', '_')
 
-            # Buscar columna suma asegurada
-            posibles = ['suma_asegurada', 'valor_asegurado', 'tiv', 'total_insured_value']
-            col_suma = None
-            for nombre in posibles:
-                cols_match = [c for c in df_tiv.columns if nombre in str(c).lower()]
-                if cols_match:
-                    col_suma = cols_match[-1]
-                    break
+                # Buscar columna suma asegurada
+                col_suma = None
+                for nombre in posibles:
+                    cols_match = [c for c in df_tiv.columns if nombre in str(c).lower()]
+                    if cols_match:
+                        col_suma = cols_match[-1]
+                        break
 
-            if col_suma:
-                df_tiv['suma_asegurada_clean'] = pd.to_numeric(df_tiv[col_suma], errors='coerce').fillna(0)
-                if tiv_total is None:
-                    tiv_total = df_tiv['suma_asegurada_clean'].sum()
-                    logger.info(f"✅ TIV: Extraído desde columna '{col_suma}' (Estrategia 3)")
-                    self.datos_consolidados['tiv_total'] = tiv_total
+                if col_suma:
+                    df_tiv['suma_asegurada_clean'] = pd.to_numeric(df_tiv[col_suma], errors='coerce').fillna(0)
+                    if tiv_total is None:
+                        tiv_total = df_tiv['suma_asegurada_clean'].sum()
+                        logger.info(f"✅ TIV: Extraído desde columna '{col_suma}' (Estrategia 3)")
+                        self.datos_consolidados['formato_tiv'] = formato_estrategia_3
+                        self.datos_consolidados['tiv_total'] = tiv_total
+                        self.datos_consolidados['tiv_estadisticas'] = estadisticas_tiv(df_tiv, [], fila_encabezado_3)
 
             # ============================================
             # ESTRATEGIA 4: La Costeña - Hoja SUM ASEG
             # ============================================
             if tiv_total == 0 or tiv_total is None:
-                try:
-                    logger.info("Intentando ESTRATEGIA 4: La Costeña (hoja SUM ASEG)")
-
-                    excel_file = pd.ExcelFile(io.BytesIO(archivo_bytes))
-
-                    if 'SUM ASEG' in excel_file.sheet_names:
-                        df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), sheet_name='SUM ASEG', header=3)
-
-                        logger.info(f"Columnas detectadas: {list(df_tiv.columns)}")
-
-                        df_tiv = df_tiv.dropna(how='all')
-                        df_tiv = df_tiv[df_tiv['No'].notna()].copy()
-
-                        for col in ['EDIFICIOS', 'INVENTARIO', 'CONTENIDOS', 'PERDIDAS CONSEC']:
-                            if col in df_tiv.columns:
-                                df_tiv[col] = pd.to_numeric(df_tiv[col], errors='coerce').fillna(0)
-
-                        col_total = 'VALORES TOTALES' if 'VALORES TOTALES' in df_tiv.columns else 'VALORES TOTALES '
-                        if col_total in df_tiv.columns:
-                            df_tiv['suma_asegurada'] = pd.to_numeric(df_tiv[col_total], errors='coerce').fillna(0)
-                        else:
-                            df_tiv['suma_asegurada'] = (
-                                df_tiv.get('EDIFICIOS', 0) +
-                                df_tiv.get('INVENTARIO', 0) +
-                                df_tiv.get('CONTENIDOS', 0) +
-                                df_tiv.get('PERDIDAS CONSEC', 0)
-                            )
-
-                        df_tiv = df_tiv[df_tiv['suma_asegurada'] > 0].copy()
-                        tiv_total = df_tiv['suma_asegurada'].sum()
-
-                        logger.info(f"✅ ESTRATEGIA 4 exitosa: TIV Total = ${tiv_total:,.2f}")
+                with medir_etapa('tiv.estrategia_4_la_costena'):
+                    try:
+                        logger.info("Intentando ESTRATEGIA 4: La Costeña (hoja SUM ASEG)")
+
+                        sheet_names = hojas_libro(archivo_bytes)
+
+                        estadisticas = None
+                        if 'SUM ASEG' in sheet_names:
+                            fila_encabezado = ubicar_encabezado(archivo_bytes, 'SUM ASEG', 'la_costena_tiv', 3)
+                        if 'SUM ASEG' in sheet_names and self._usar_streaming_tiv(archivo_bytes, 'SUM ASEG'):
+                            estadisticas = agregar_tiv_streaming(
+                                archivo_bytes, 'SUM ASEG', fila_encabezado, 'No', ['VALORES TOTALES', 'VALORES TOTALES '],
+                                COMPONENTES_TIV_LA_COSTENA)
+
+                        if estadisticas is not None:
+                            df_tiv = self._registrar_tiv_streaming(estadisticas, 'SUM ASEG', 'la_costena_tiv')
+                            tiv_total = estadisticas['tiv_total']
+                            logger.info(f"✅ ESTRATEGIA 4 exitosa (streaming, {estadisticas['n_ubicaciones']} "
+                                        f"ubicaciones): TIV Total = ${tiv_total:,.2f}")
+
+                        elif 'SUM ASEG' in sheet_names:
+                            df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), sheet_name='SUM ASEG',
+                                                   header=fila_encabezado)
+
+                            logger.info(f"Columnas detectadas: {list(df_tiv.columns)}")
+
+                            df_tiv = df_tiv.dropna(how='all')
+                            df_tiv = df_tiv[df_tiv['No'].notna()].copy()
+
+                            for col in COMPONENTES_TIV_LA_COSTENA:
+                                if col in df_tiv.columns:
+                                    df_tiv[col] = pd.to_numeric(df_tiv[col], errors='coerce').fillna(0)
+
+                            col_total = 'VALORES TOTALES' if 'VALORES TOTALES' in df_tiv.columns else 'VALORES TOTALES '
+                            if col_total in df_tiv.columns:
+                                df_tiv['suma_asegurada'] = pd.to_numeric(df_tiv[col_total], errors='coerce').fillna(0)
+                            else:
+                                df_tiv['suma_asegurada'] = (
+                                    df_tiv.get('EDIFICIOS', 0) +
+                                    df_tiv.get('INVENTARIO', 0) +
+                                    df_tiv.get('CONTENIDOS', 0) +
+                                    df_tiv.get('PERDIDAS CONSEC', 0)
+                                )
+
+                            df_tiv = df_tiv[df_tiv['suma_asegurada'] > 0].copy()
+                            tiv_total = df_tiv['suma_asegurada'].sum()
+
+                            logger.info(f"✅ ESTRATEGIA 4 exitosa: TIV Total = ${tiv_total:,.2f}")
+                            self.datos_consolidados['formato_tiv'] = 'la_costena_tiv'
 
-                        self.datos_consolidados['tiv'] = df_tiv
-                        self.datos_consolidados['tiv_total'] = tiv_total
+                            self.datos_consolidados['tiv'] = df_tiv
+                            self.datos_consolidados['tiv_total'] = tiv_total
+                            self.datos_consolidados['tiv_estadisticas'] = estadisticas_tiv(
+                                df_tiv, COMPONENTES_TIV_LA_COSTENA, fila_encabezado)
 
-                except Exception as e:
-                    logger.warning(f"ESTRATEGIA 4 falló: {str(e)}")
+                    except Exception as e:
+                        logger.warning(f"ESTRATEGIA 4 falló: {str(e)}")
 
             # ============================================
             # ESTRATEGIA 5: CONAGUA - Hoja Conagua
             # ============================================
             if tiv_total == 0 or tiv_total is None:
-                try:
-                    logger.info("Intentando ESTRATEGIA 5: CONAGUA")
+                with medir_etapa('tiv.estrategia_5_conagua'):
+                    try:
+                        logger.info("Intentando ESTRATEGIA 5: CONAGUA")
 
-                    excel_file = pd.ExcelFile(io.BytesIO(archivo_bytes))
+                        sheet_conagua = None
+                        for sheet_name in hojas_libro(archivo_bytes):
+                            if sheet_name.lower().startswith('conagua'):
+                                sheet_conagua = sheet_name
+                                break
 
-                    sheet_conagua = None
-                    for sheet_name in excel_file.sheet_names:
-                        if sheet_name.lower().startswith('conagua'):
-                            sheet_conagua = sheet_name
-                            break
+                        estadisticas = None
+                        if sheet_conagua:
+                            fila_encabezado = ubicar_encabezado(archivo_bytes, sheet_conagua, 'conagua_tiv', 11)
+                        if sheet_conagua and self._usar_streaming_tiv(archivo_bytes, sheet_conagua):
+                            estadisticas = agregar_tiv_streaming(
+                                archivo_bytes, sheet_conagua, fila_encabezado, 'Nombre', ['Edificio'],
+                                COMPONENTES_TIV_CONAGUA)
 
-                    if sheet_conagua:
-                        df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), sheet_name=sheet_conagua, header=11)
+                        if estadisticas is not None:
+                            df_tiv = self._registrar_tiv_streaming(estadisticas, sheet_conagua, 'conagua_tiv')
+                            tiv_total = estadisticas['tiv_total']
+                            logger.info(f"✅ ESTRATEGIA 5 exitosa (streaming, {estadisticas['n_ubicaciones']} "
+                                        f"ubicaciones): TIV Total = ${tiv_total:,.2f}")
 
-                        df_tiv = df_tiv.dropna(how='all')
-                        df_tiv = df_tiv[df_tiv['Nombre'].notna()].copy()
+                        elif sheet_conagua:
+                            df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), sheet_name=sheet_conagua,
+                                                   header=fila_encabezado)
 
-                        df_tiv['suma_asegurada'] = pd.to_numeric(df_tiv['Edificio'], errors='coerce').fillna(0)
-                        df_tiv = df_tiv[df_tiv['suma_asegurada'] > 0].copy()
+                            df_tiv = df_tiv.dropna(how='all')
+                            df_tiv = df_tiv[df_tiv['Nombre'].notna()].copy()
 
-                        tiv_total = df_tiv['suma_asegurada'].sum()
+                            df_tiv['suma_asegurada'] = pd.to_numeric(df_tiv['Edificio'], errors='coerce').fillna(0)
+                            df_tiv = df_tiv[df_tiv['suma_asegurada'] > 0].copy()
 
-                        logger.info(f"✅ ESTRATEGIA 5 exitosa: TIV Total = ${tiv_total:,.2f}")
-                        logger.info(f"Total ubicaciones: {len(df_tiv)}")
+                            tiv_total = df_tiv['suma_asegurada'].sum()
 
-                        self.datos_consolidados['tiv'] = df_tiv
-                        self.datos_consolidados['tiv_total'] = tiv_total
+                            logger.info(f"✅ ESTRATEGIA 5 exitosa: TIV Total = ${tiv_total:,.2f}")
+                            self.datos_consolidados['formato_tiv'] = 'conagua_tiv'
+                            logger.info(f"Total ubicaciones: {len(df_tiv)}")
 
-                except Exception as e:
-                    logger.warning(f"ESTRATEGIA 5 falló: {str(e)}")
+                            self.datos_consolidados['tiv'] = df_tiv
+                            self.datos_consolidados['tiv_total'] = tiv_total
+                            self.datos_consolidados['tiv_estadisticas'] = estadisticas_tiv(
+                                df_tiv, COMPONENTES_TIV_CONAGUA, fila_encabezado)
+
+                    except Exception as e:
+                        logger.warning(f"ESTRATEGIA 5 falló: {str(e)}")
 
             if tiv_total is None or tiv_total == 0:
                 logger.warning("⚠️ TIV Total es cero o no se pudo extraer - Burning Cost no será calculable")
 
+            if tabla_omitida and df_tiv.empty:
+                df_tiv = pd.read_excel(io.BytesIO(archivo_bytes), engine='openpyxl')
+
             logger.info(f"✅ TIV procesado: {len(df_tiv)} registros, Total: {tiv_total:,.2f}")
             self.datos_consolidados['tiv'] = df_tiv
             return df_tiv
@@ -863,7 +4369,7 @@ class AnalizadorTecnico:
                 cv = desviacion_std / severidad_promedio if severidad_promedio > 0 else 0
 
             umbral_catastrofico = df['monto_incurrido'].quantile(0.95)
-            num_catastroficos = len(df[df['monto_incurrido'] > umbral_catastrofico])
+            num_catastroficos = int(marcar_catastroficos(df, umbral_catastrofico).sum())
 
             # Clasificación de tipo de siniestralidad
             if cv is not None and cv > 2 or (total_siniestros > 0 and num_catastroficos > (total_siniestros * 0.1)):
@@ -950,11 +4456,15 @@ class AnalizadorTecnico:
         """Cálculo de Burning Cost"""
         try:
             df_sini = self.datos_consolidados['siniestralidad']
-            if df_sini is None or len(df_sini) == 0:
+            resumen_kb = self.datos_consolidados.get('resumen_kb')
+            if df_sini is not None and len(df_sini) > 0:
+                años_unicos = df_sini['año'].nunique()
+                siniestralidad_total = df_sini['monto_incurrido'].sum()
+            elif resumen_kb and resumen_kb['n_siniestros'] > 0:
+                años_unicos = len(resumen_kb['por_anio'])
+                siniestralidad_total = resumen_kb['incurrido_total_usd']
+            else:
                 return {'tiene_burning_cost': False}
-
-            años_unicos = df_sini['año'].nunique()
-            siniestralidad_total = df_sini['monto_incurrido'].sum()
             siniestralidad_promedio_anual = siniestralidad_total / años_unicos if años_unicos > 0 else 0
 
             tiv_total = self.datos_consolidados.get('tiv_total', 0)
@@ -965,20 +4475,12 @@ class AnalizadorTecnico:
             burning_cost_pct = burning_cost * 100
             burning_cost_por_mil = burning_cost * 1000
 
-            tasa_slip_por_mil = 1.50  # Default
+            tasa_slip_por_mil = self.tasa_slip_por_mil
 
             margen_por_mil = tasa_slip_por_mil - burning_cost_por_mil
             margen_pct = (margen_por_mil / tasa_slip_por_mil * 100) if tasa_slip_por_mil > 0 else 0
 
-            if burning_cost_por_mil > tasa_slip_por_mil:
-                semaforo = 'ROJO'
-                suficiencia = 'INSUFICIENTE'
-            elif burning_cost_por_mil > tasa_slip_por_mil * 0.8:
-                semaforo = 'AMARILLO'
-                suficiencia = 'AJUSTADA'
-            else:
-                semaforo = 'VERDE'
-                suficiencia = 'ADECUADA'
+            semaforo, suficiencia = (str(v) for v in clasificar_suficiencia(burning_cost_por_mil, tasa_slip_por_mil))
 
             return {
                 'tiene_burning_cost': True,
@@ -997,6 +4499,58 @@ class AnalizadorTecnico:
             logger.error(f"❌ Error en burning cost: {str(e)}")
             return {'error': str(e)}
 
+    def analizar_incertidumbre(self) -> Dict:
+        """Intervalos de confianza por bootstrap de frecuencia, severidad y burning cost"""
+        try:
+            df = self.datos_consolidados['siniestralidad']
+            resultado = bootstrap_siniestralidad(df['monto_incurrido'].to_numpy(dtype=float),
+                                                 df['año'].to_numpy(),
+                                                 self.datos_consolidados.get('tiv_total', 0),
+                                                 self.bootstrap)
+            self.datos_consolidados['incertidumbre'] = resultado
+            bc = resultado['burning_cost_por_mil']
+            if bc:
+                logger.info(f"🎲 Bootstrap ({resultado['remuestras']} remuestras): BC {bc['estimacion']}‰ "
+                            f"[{bc['ic_inferior']} - {bc['ic_superior']}]")
+            return resultado
+
+        except Exception as e:
+            logger.error(f"❌ Error en bootstrap: {str(e)}")
+            return {'error': str(e)}
+
+    def analizar_eventos(self) -> Dict:
+        """Agrupa los siniestros en eventos según la cláusula horaria de cada peril"""
+        try:
+            df = self.datos_consolidados['siniestralidad']
+            if df is None or len(df) == 0:
+                return {'tiene_eventos': False}
+
+            horas_por_peril = {**HORAS_CLAUSULA_EVENTO, **self.horas_clausula_evento}
+            causas = df['causa_siniestro'].fillna('').astype(str)
+            perils = causas.map({causa: clasificar_peril(causa)[0] for causa in causas.unique()})
+            horas = perils.map(horas_por_peril).astype(float)
+
+            if 'es_catastrofico' in df.columns:
+                bandera = bandera_catastrofica(df['es_catastrofico'])
+                # Marcado Cat sin cláusula propia: cláusula por defecto; marcado No Cat: no se agrupa
+                horas = horas.mask(horas.isna() & bandera.fillna(False).astype(bool), HORAS_CLAUSULA_CAT_DEFAULT)
+                horas = horas.mask(~bandera.fillna(True).astype(bool), np.nan)
+
+            df['peril_categoria'] = perils
+            df['evento_id'] = asignar_eventos(pd.to_datetime(df['fecha_siniestro'], errors='coerce'),
+                                              perils, horas.to_numpy())
+            resumen = resumir_eventos(df, horas_por_peril)
+            resumen['tiene_eventos'] = True
+            self.datos_consolidados['eventos'] = resumen
+
+            logger.info(f"🌪️ Eventos: {resumen['n_siniestros']} siniestros en {resumen['n_eventos']} eventos "
+                        f"({resumen['eventos_multisiniestro']} con más de un siniestro)")
+            return resumen
+
+        except Exception as e:
+            logger.error(f"❌ Error agrupando eventos: {str(e)}")
+            return {'error': str(e)}
+
     def analizar_reservas_ibnr(self) -> Dict:
         """Análisis de Reservas e IBNR (Incurred But Not Reported)"""
         try:
@@ -1056,13 +4610,62 @@ class AnalizadorTecnico:
             logger.error(f"❌ Error en análisis de reservas: {str(e)}")
             return {'error': str(e)}
 
+    def analizar_triangulos(self) -> Dict:
+        """
+        Chain-ladder sobre el triángulo de desarrollo: agregado en SQL si el
+        asegurado está en la KB y hay columna de corte; si no, desde los loss
+        runs cargados (uno por año de evaluación)
+        """
+        try:
+            insured_key = self.datos_consolidados.get('insured_key')
+            celdas = consultar_triangulo_kb(insured_key) if insured_key and KB_COLUMNA_EVALUACION else pd.DataFrame()
+            fuente, moneda = 'kb', 'USD'
+
+            if celdas.empty:
+                fuente, moneda = 'archivos', None
+                df = self.datos_consolidados['siniestralidad']
+                if df is None or df.empty or 'año_evaluacion' not in df.columns:
+                    return {'tiene_triangulo': False, 'motivo': 'Sin loss runs con año de evaluación'}
+                df = df[df['año_evaluacion'].notna()]
+                origen = pd.to_datetime(df['fecha_siniestro'], errors='coerce').dt.year
+                df = df[origen.notna()]
+                origen = origen[origen.notna()].astype(np.int64)
+                celdas = pd.DataFrame({
+                    'año_ocurrencia': origen.to_numpy(),
+                    'desarrollo': df['año_evaluacion'].astype(np.int64).to_numpy() - origen.to_numpy(),
+                    'incurrido': df['monto_incurrido'].to_numpy(dtype=float),
+                    'pagado': df['monto_pagado'].to_numpy(dtype=float)
+                })
+
+            evaluaciones = (celdas['año_ocurrencia'] + celdas['desarrollo']).nunique()
+            if evaluaciones < 2:
+                return {'tiene_triangulo': False, 'fuente': fuente,
+                        'motivo': f'Se necesitan al menos 2 evaluaciones (hay {evaluaciones})'}
+
+            resultado = {'tiene_triangulo': True, 'fuente': fuente, 'moneda': moneda, 'evaluaciones': evaluaciones}
+            for base in TRIANGULO_BASES:
+                años, matriz = construir_triangulo(celdas['año_ocurrencia'].to_numpy(),
+                                                   celdas['desarrollo'].to_numpy(), celdas[base].to_numpy())
+                resultado[base] = resumir_chain_ladder(años, matriz, base)
+            self.datos_consolidados['chain_ladder'] = resultado
+
+            logger.info(f"📐 Chain-ladder ({fuente}): {evaluaciones} evaluaciones, "
+                        f"IBNR incurrido {resultado['incurrido']['ibnr_total']:,.2f}")
+            return resultado
+
+        except Exception as e:
+            logger.error(f"❌ Error en triángulos de desarrollo: {str(e)}")
+            return {'error': str(e)}
+
     def generar_analisis_completo(self) -> Dict:
         """Genera el análisis técnico completo"""
         try:
             logger.info("=== INICIANDO ANÁLISIS TÉCNICO COMPLETO ===")
 
             df = self.datos_consolidados['siniestralidad']
-            tipo_cliente = 'renovacion' if (df is not None and len(df) > 0) else 'nuevo'
+            resumen_kb = self.datos_consolidados.get('resumen_kb')
+            tiene_siniestros = df is not None and len(df) > 0
+            tipo_cliente = 'renovacion' if (tiene_siniestros or (resumen_kb and resumen_kb['n_siniestros'] > 0)) else 'nuevo'
 
             analisis = {
                 'metadata': {
@@ -1074,13 +4677,24 @@ class AnalizadorTecnico:
                 }
             }
 
-            if tipo_cliente == 'renovacion':
+            if tiene_siniestros:
                 analisis.update({
                     'frecuencia_severidad': self.analizar_frecuencia_severidad(),
                     'tendencias': self.analizar_tendencias(),
                     'burning_cost': self.calcular_burning_cost(),
-                    'reservas_ibnr': self.analizar_reservas_ibnr()
+                    'reservas_ibnr': self.analizar_reservas_ibnr(),
+                    'chain_ladder': self.analizar_triangulos(),
+                    'eventos': self.analizar_eventos()
                 })
+                if self.bootstrap is not None and dependencia_disponible('bootstrap'):
+                    with medir_etapa('bootstrap', remuestras=self.bootstrap['remuestras']):
+                        analisis['incertidumbre'] = self.analizar_incertidumbre()
+            elif tipo_cliente == 'renovacion':
+                # Renovación solo con el resumen KB: burning cost desde los agregados
+                analisis['burning_cost'] = self.calcular_burning_cost()
+
+            if resumen_kb is not None:
+                analisis['historico_kb_resumen'] = resumen_kb
 
             logger.info("=== ANÁLISIS COMPLETADO ===")
             return analisis
@@ -1171,6 +4785,242 @@ def generar_analisis_por_peril(df_siniestros: pd.DataFrame, tasa_cambio: float)
     return resultado
 
 
+# Columnas de siniestros que identifican la ubicación afectada
+COLUMNAS_UBICACION_SINIESTROS = ['id_ubicacion', 'codigo_ubicacion', 'ubicacion']
+
+
+def _claves_union(valores: pd.Series) -> pd.Series:
+    """Claves comparables entre siniestros y ubicaciones: texto en mayúsculas, sin '.0' final"""
+    return valores.dropna().astype(str).str.strip().str.upper().str.replace(r'\.0$', '', regex=True)
+
+
+def vincular_siniestros_ubicaciones(estadisticas: Dict[str, Any], df_tiv: Optional[pd.DataFrame],
+                                    df_siniestros: Optional[pd.DataFrame]) -> Optional[Dict[str, Any]]:
+    """
+    Cruza siniestros con ubicaciones por id o nombre de ubicación (hash join)
+
+    Con la tabla de ubicaciones el cruce es contra todas; en modo streaming
+    solo contra las ubicaciones del top. Se usa el rol (id o nombre) que
+    vincula más siniestros.
+
+    Returns:
+        Totales vinculados y (n, incurrido) por ubicación del top, o None si
+        los siniestros no traen columna de ubicación
+    """
+    if df_siniestros is None or df_siniestros.empty:
+        return None
+    col_siniestros = next((c for c in COLUMNAS_UBICACION_SINIESTROS if c in df_siniestros.columns), None)
+    if col_siniestros is None:
+        return None
+
+    claves_siniestros = _claves_union(df_siniestros[col_siniestros])
+    incurrido = pd.to_numeric(df_siniestros.loc[claves_siniestros.index, 'monto_incurrido'],
+                              errors='coerce').fillna(0).to_numpy(dtype=float)
+    top = estadisticas['top_ubicaciones']
+    roles_tabla = columnas_ubicacion(list(df_tiv.columns)) if df_tiv is not None else {}
+
+    mejor = None
+    for rol in ('id', 'ubicacion'):
+        if df_tiv is not None:
+            if rol not in roles_tabla:
+                continue
+            universo = _claves_union(df_tiv[roles_tabla[rol]])
+        else:
+            universo = _claves_union(pd.Series([u[rol] for u in top], dtype=object))
+        indice = pd.Index(universo.unique())
+        posiciones = indice.get_indexer(claves_siniestros.to_numpy())
+        vinculados = posiciones >= 0
+        if mejor is None or vinculados.sum() > mejor[3].sum():
+            mejor = (rol, indice, posiciones, vinculados)
+            if vinculados.all():
+                break
+
+    if mejor is None:
+        return None
+    rol, indice, posiciones, vinculados = mejor
+    n_por_clave = np.bincount(posiciones[vinculados], minlength=len(indice))
+    incurrido_por_clave = np.bincount(posiciones[vinculados], weights=incurrido[vinculados], minlength=len(indice))
+    claves_top = [_claves_union(pd.Series([u[rol]], dtype=object)) for u in top]
+    posiciones_top = [indice.get_indexer(c.to_numpy())[0] if len(c) else -1 for c in claves_top]
+
+    return {
+        'columna_siniestros': col_siniestros,
+        'columna_ubicaciones': rol,
+        'alcance': 'todas' if df_tiv is not None else 'top_ubicaciones',
+        'siniestros_vinculados': int(vinculados.sum()),
+        'pct_siniestros_vinculados': float(vinculados.sum() / len(df_siniestros) * 100),
+        'incurrido_vinculado': float(incurrido[vinculados].sum()),
+        'por_top': [
+            (int(n_por_clave[p]), float(incurrido_por_clave[p])) if p >= 0 else (0, 0.0)
+            for p in posiciones_top
+        ]
+    }
+
+
+def generar_ubicaciones_criticas(analizador: AnalizadorTecnico,
+                                 tasa_cambio: float) -> Tuple[List[Dict], Optional[Dict]]:
+    """
+    Ubicaciones con mayor suma asegurada e indicadores de concentración del TIV
+
+    Parte de tiv_estadisticas (tabla o streaming), así que no vuelve a recorrer
+    la relación de valores; solo el cruce con siniestros usa la tabla.
+
+    Returns:
+        (ubicaciones_criticas, concentracion_tiv); ([], None) sin ubicaciones
+    """
+    estadisticas = analizador.datos_consolidados.get('tiv_estadisticas')
+    if not estadisticas or not estadisticas.get('n_ubicaciones'):
+        return [], None
+
+    total = estadisticas['tiv_total']
+    df_tiv = analizador.datos_consolidados.get('tiv') if estadisticas['modo'] == 'tabla' else None
+    vinculacion = vincular_siniestros_ubicaciones(estadisticas, df_tiv, analizador.datos_consolidados['siniestralidad'])
+
+    ubicaciones_criticas = []
+    acumulado = 0.0
+    for ranking, ubicacion in enumerate(estadisticas['top_ubicaciones'], start=1):
+        acumulado += ubicacion['suma_asegurada']
+        critica = {
+            "ranking": ranking,
+            "id_ubicacion": ubicacion['id'],
+            "ubicacion": ubicacion['ubicacion'],
+            "estado": ubicacion['estado'],
+            "municipio": ubicacion['municipio'],
+            "fila_origen": ubicacion['fila'],
+            "suma_asegurada_usd": round(ubicacion['suma_asegurada'] * tasa_cambio, 2),
+            "pct_tiv": round(ubicacion['suma_asegurada'] / total * 100, 4),
+            "pct_tiv_acumulado": round(acumulado / total * 100, 4)
+        }
+        if vinculacion is not None:
+            n_siniestros, incurrido = vinculacion['por_top'][ranking - 1]
+            critica["siniestros"] = {"n": n_siniestros, "incurrido_usd": round(incurrido * tasa_cambio, 2)}
+        ubicaciones_criticas.append(critica)
+
+    def redondear(valor: Optional[float], decimales: int) -> Optional[float]:
+        return round(valor, decimales) if valor is not None else None
+
+    def por_grupo(dimension: str) -> List[Dict]:
+        return [
+            {
+                dimension: grupo['valor'],
+                "n_ubicaciones": grupo['n_ubicaciones'],
+                "suma_asegurada_usd": round(grupo['suma_asegurada'] * tasa_cambio, 2),
+                "pct_tiv": redondear(grupo['pct_tiv'], 4)
+            }
+            for grupo in estadisticas['grupos'].get(dimension, [])
+        ]
+
+    indicadores = estadisticas['concentracion']
+    concentracion = {
+        "modo": estadisticas['modo'],
+        "n_ubicaciones": estadisticas['n_ubicaciones'],
+        "hhi": redondear(indicadores['hhi'], 6),
+        "n_equivalente": redondear(indicadores['n_equivalente'], 1),
+        "pct_top_1": redondear(indicadores['pct_top_1'], 4),
+        "pct_top_5": redondear(indicadores['pct_top_5'], 4),
+        "pct_top_10": redondear(indicadores['pct_top_10'], 4),
+        "por_estado": por_grupo('estado'),
+        "por_municipio": por_grupo('municipio'),
+        "vinculacion_siniestros": None
+    }
+    if vinculacion is not None:
+        concentracion["vinculacion_siniestros"] = {
+            "columna_siniestros": vinculacion['columna_siniestros'],
+            "columna_ubicaciones": vinculacion['columna_ubicaciones'],
+            "alcance": vinculacion['alcance'],
+            "siniestros_vinculados": vinculacion['siniestros_vinculados'],
+            "pct_siniestros_vinculados": round(vinculacion['pct_siniestros_vinculados'], 2),
+            "incurrido_vinculado_usd": round(vinculacion['incurrido_vinculado'] * tasa_cambio, 2)
+        }
+    return ubicaciones_criticas, concentracion
+
+
+def generar_analisis_eventos(analizador: AnalizadorTecnico, tasa_cambio: float) -> Optional[Dict[str, Any]]:
+    """Resumen de eventos (ver analizar_eventos) con montos en USD"""
+    eventos = analizador.datos_consolidados.get('eventos')
+    if not eventos:
+        return None
+
+    return {
+        "n_siniestros": eventos['n_siniestros'],
+        "n_eventos": eventos['n_eventos'],
+        "eventos_multisiniestro": eventos['eventos_multisiniestro'],
+        "siniestros_en_eventos_multiples": eventos['siniestros_en_eventos_multiples'],
+        "perdida_evento_usd": {k: round(v * tasa_cambio, 2) for k, v in eventos['perdida_evento'].items()},
+        "top_eventos": [
+            {**{k: v for k, v in evento.items() if k != 'perdida'},
+             "perdida_usd": round(evento['perdida'] * tasa_cambio, 2)}
+            for evento in eventos['top_eventos']
+        ],
+        "por_anio": [
+            {"año": anio['año'], "n_eventos": anio['n_eventos'],
+             "perdida_total_usd": round(anio['perdida_total'] * tasa_cambio, 2),
+             "perdida_maxima_evento_usd": round(anio['perdida_maxima_evento'] * tasa_cambio, 2)}
+            for anio in eventos['por_anio']
+        ],
+        "por_peril": [
+            {**{k: v for k, v in peril.items() if k != 'perdida_maxima_evento'},
+             "perdida_maxima_evento_usd": round(peril['perdida_maxima_evento'] * tasa_cambio, 2)}
+            for peril in eventos['por_peril']
+        ]
+    }
+
+
+def generar_chain_ladder_usd(analizador: AnalizadorTecnico, tasa_cambio: float) -> Optional[Dict[str, Any]]:
+    """Factores, último estimado e IBNR del chain-ladder en USD (ver analizar_triangulos)"""
+    chain_ladder = analizador.datos_consolidados.get('chain_ladder')
+    if not chain_ladder or not chain_ladder.get('tiene_triangulo'):
+        return None
+
+    # El triángulo de la KB ya viene en USD
+    tasa = 1.0 if chain_ladder['fuente'] == 'kb' else tasa_cambio
+    resultado = {"fuente": chain_ladder['fuente'], "evaluaciones": chain_ladder['evaluaciones']}
+    for base in TRIANGULO_BASES:
+        triangulo = chain_ladder[base]
+        resultado[base] = {
+            "factores": triangulo['factores'],
+            "factor_cola": triangulo['factor_cola'],
+            "valor_actual_usd": round(triangulo['valor_actual_total'] * tasa, 2),
+            "ultimo_usd": round(triangulo['ultimo_total'] * tasa, 2),
+            "ibnr_usd": round(triangulo['ibnr_total'] * tasa, 2)
+        }
+    return resultado
+
+
+def generar_incertidumbre_usd(analizador: AnalizadorTecnico, tasa_cambio: float) -> Optional[Dict[str, Any]]:
+    """Intervalos del bootstrap con la severidad en USD (None si no se pidió)"""
+    incertidumbre = analizador.datos_consolidados.get('incertidumbre')
+    if not incertidumbre or 'error' in incertidumbre:
+        return None
+
+    resultado = {k: v for k, v in incertidumbre.items() if k != 'severidad_promedio'}
+    resultado['severidad_promedio_usd'] = {k: round(v * tasa_cambio, 2)
+                                           for k, v in incertidumbre['severidad_promedio'].items()}
+    return resultado
+
+
+def generar_grilla_pricing(analizador: AnalizadorTecnico, tasa_cambio: float) -> Optional[Dict[str, Any]]:
+    """Grilla tasas × deducibles × capas XL en USD (ver calcular_grilla_pricing)"""
+    grilla = analizador.grilla_pricing
+    df = analizador.datos_consolidados['siniestralidad']
+    tiv_total = analizador.datos_consolidados.get('tiv_total', 0)
+    if grilla is None or df is None or df.empty or not tiv_total:
+        return None
+
+    eventos = df['evento_id'].to_numpy() if grilla['base'] == 'evento' and 'evento_id' in df.columns else None
+    resultado = calcular_grilla_pricing(
+        df['monto_incurrido'].to_numpy(dtype=float) * tasa_cambio,
+        eventos,
+        df['año'].nunique(),
+        tiv_total * tasa_cambio,
+        grilla
+    )
+    resultado['tiv_total_usd'] = round(tiv_total * tasa_cambio, 2)
+    logger.info(f"🧮 Grilla de pricing: {resultado['n_combinaciones']} combinaciones sobre "
+                f"{resultado['n_ocurrencias']} ocurrencias (base {resultado['base']})")
+    return resultado
+
+
 def generar_seccion_riesgos(analizador: AnalizadorTecnico, tiv_total: float, tasa_cambio: float, burning_cost_por_mil: float) -> List[Dict]:
     """Genera sección completa de riesgos"""
     # Por ahora retornamos un placeholder - esto se completará con info del slip
@@ -1200,8 +5050,86 @@ def generar_seccion_riesgos(analizador: AnalizadorTecnico, tiv_total: float, tas
     }]
 
 
-def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
-    """Genera JSON completo para pricing con conversión automática a USD"""
+def iterar_siniestros_pricing(df_siniestros: pd.DataFrame, moneda_origen: str,
+                              tasa_cambio: float) -> Iterator[Dict[str, Any]]:
+    """Registros de json_pricing.siniestros, uno a la vez (la lista completa o las líneas NDJSON)"""
+    if df_siniestros is None or df_siniestros.empty:
+        return
+
+    umbral_catastrofico = df_siniestros['monto_incurrido'].quantile(0.95)
+    catastroficos = marcar_catastroficos(df_siniestros, umbral_catastrofico).to_numpy()
+    col_ubicacion = next((c for c in COLUMNAS_UBICACION_SINIESTROS if c in df_siniestros.columns), None)
+    tiene_eventos = 'evento_id' in df_siniestros.columns
+
+    for posicion, (idx, row) in enumerate(df_siniestros.iterrows()):
+        fecha_str = row.get('fecha_siniestro').strftime('%d%m%Y') if pd.notna(row.get('fecha_siniestro')) else 'XXXXXXXX'
+        claim_id = f"CLAIM-ARM-{fecha_str}-{hashlib.md5(str(idx).encode()).hexdigest()[:8].upper()}"
+
+        monto_incurrido = float(row.get('monto_incurrido', 0))
+        monto_pagado = float(row.get('monto_pagado', 0))
+        monto_reservado = float(row.get('monto_reservado', 0))
+
+        estado = "cerrado" if monto_pagado > 0 and monto_reservado == 0 else "abierto"
+        es_catastrofico = int(catastroficos[posicion])
+
+        causa = row.get('causa_siniestro', 'No especificada')
+        peril_categoria, peril_subcategoria = clasificar_peril(causa)
+
+        yield {
+            "claim_id": claim_id,
+            "id_ubicacion": _texto_celda(row.get(col_ubicacion)) if col_ubicacion else "U-ARM-001",
+            "fecha_siniestro": row.get('fecha_siniestro').strftime('%Y-%m-%d') if pd.notna(row.get('fecha_siniestro')) else None,
+            "fecha_notificacion": None,
+            "fecha_cierre": None,
+            "estado": estado,
+            "peril_categoria": peril_categoria,
+            "peril_subcategoria": peril_subcategoria,
+            "descripcion": causa,
+            "es_catastrofico": es_catastrofico,
+            "evento_id": int(row['evento_id']) if tiene_eventos else None,
+            "montos": {
+                "moneda_origen": moneda_origen,
+                "tasa_cambio_a_objetivo": tasa_cambio,
+                "pagado": monto_pagado,
+                "pagado_usd": monto_pagado * tasa_cambio,
+                "reservado": monto_reservado,
+                "reservado_usd": monto_reservado * tasa_cambio,
+                "recuperado": 0.0,
+                "gastos_lae": 0.0,
+                "incurrido_bruto": monto_incurrido,
+                "incurrido_bruto_usd": monto_incurrido * tasa_cambio,
+                "incurrido_neto": monto_incurrido,
+                "incurrido_neto_usd": monto_incurrido * tasa_cambio
+            },
+            "coberturas_afectadas": ["Todo Riesgo Construcción"],
+            "deducible_aplicado": {
+                "tipo": "pendiente",
+                "expresion": "Por determinar según Slip",
+                "estimado_en_monedas_objetivo": None
+            },
+            "salvamento_subrogacion": {
+                "salvamento": 0.0,
+                "subrogacion": 0.0
+            },
+            "causa_raiz": causa,
+            "evidencias": [],
+            "origen_extraccion": {
+                "documento_id": "siniestralidad_archivo",
+                "fila_o_pagina": f"siniestro_{idx+1}",
+                "confianza_extraccion": 1.0,
+                "timestamp": datetime.now().isoformat()
+            },
+            "observaciones": f"Estado: {estado}"
+        }
+
+
+def generar_json_pricing(analizador: AnalizadorTecnico, incluir_siniestros: bool = True) -> Dict[str, Any]:
+    """
+    Genera JSON completo para pricing con conversión automática a USD
+
+    Con incluir_siniestros=False json_pricing.siniestros queda vacío (la salida
+    NDJSON los emite después con iterar_siniestros_pricing)
+    """
     df_siniestros = analizador.datos_consolidados['siniestralidad']
     tiv_total = analizador.datos_consolidados['tiv_total']
 
@@ -1227,80 +5155,20 @@ def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
         tasa_cambio = 1.0
         moneda_origen = "USD"
         logger.info("💱 Moneda detectada: USD (sin conversión)")
+    analizador.moneda_local = moneda_origen
+    analizador.tasa_cambio = tasa_cambio
 
     logger.info(f"📊 Generando JSON pricing para {analizador.datos_consolidados.get('asegurado_nombre', 'Desconocido')}")
 
     # ====================
     # 1. SINIESTROS
     # ====================
-    siniestros_list = []
+    siniestros_list = list(iterar_siniestros_pricing(df_siniestros, moneda_origen, tasa_cambio)) \
+        if incluir_siniestros else []
     umbral_catastrofico = 0
-
     if df_siniestros is not None and not df_siniestros.empty:
         umbral_catastrofico = df_siniestros['monto_incurrido'].quantile(0.95)
 
-        for idx, row in df_siniestros.iterrows():
-            año = row.get('año', 'XXXX')
-            fecha_str = row.get('fecha_siniestro').strftime('%d%m%Y') if pd.notna(row.get('fecha_siniestro')) else 'XXXXXXXX'
-            claim_id = f"CLAIM-ARM-{fecha_str}-{hashlib.md5(str(idx).encode()).hexdigest()[:8].upper()}"
-
-            monto_incurrido = float(row.get('monto_incurrido', 0))
-            monto_pagado = float(row.get('monto_pagado', 0))
-            monto_reservado = float(row.get('monto_reservado', 0))
-
-            estado = "cerrado" if monto_pagado > 0 and monto_reservado == 0 else "abierto"
-            es_catastrofico = 1 if monto_incurrido > umbral_catastrofico else 0
-
-            causa = row.get('causa_siniestro', 'No especificada')
-            peril_categoria, peril_subcategoria = clasificar_peril(causa)
-
-            siniestro = {
-                "claim_id": claim_id,
-                "id_ubicacion": "U-ARM-001",
-                "fecha_siniestro": row.get('fecha_siniestro').strftime('%Y-%m-%d') if pd.notna(row.get('fecha_siniestro')) else None,
-                "fecha_notificacion": None,
-                "fecha_cierre": None,
-                "estado": estado,
-                "peril_categoria": peril_categoria,
-                "peril_subcategoria": peril_subcategoria,
-                "descripcion": causa,
-                "es_catastrofico": es_catastrofico,
-                "montos": {
-                    "moneda_origen": moneda_origen,
-                    "tasa_cambio_a_objetivo": tasa_cambio,
-                    "pagado": monto_pagado,
-                    "pagado_usd": monto_pagado * tasa_cambio,
-                    "reservado": monto_reservado,
-                    "reservado_usd": monto_reservado * tasa_cambio,
-                    "recuperado": 0.0,
-                    "gastos_lae": 0.0,
-                    "incurrido_bruto": monto_incurrido,
-                    "incurrido_bruto_usd": monto_incurrido * tasa_cambio,
-                    "incurrido_neto": monto_incurrido,
-                    "incurrido_neto_usd": monto_incurrido * tasa_cambio
-                },
-                "coberturas_afectadas": ["Todo Riesgo Construcción"],
-                "deducible_aplicado": {
-                    "tipo": "pendiente",
-                    "expresion": "Por determinar según Slip",
-                    "estimado_en_monedas_objetivo": None
-                },
-                "salvamento_subrogacion": {
-                    "salvamento": 0.0,
-                    "subrogacion": 0.0
-                },
-                "causa_raiz": causa,
-                "evidencias": [],
-                "origen_extraccion": {
-                    "documento_id": "siniestralidad_archivo",
-                    "fila_o_pagina": f"siniestro_{idx+1}",
-                    "confianza_extraccion": 1.0,
-                    "timestamp": datetime.now().isoformat()
-                },
-                "observaciones": f"Estado: {estado}"
-            }
-            siniestros_list.append(siniestro)
-
     # ====================
     # 2. ANÁLISIS
     # ====================
@@ -1316,6 +5184,19 @@ def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
 
     frecuencia_anual = n_siniestros / años_unicos if años_unicos > 0 else 0
 
+    # Renovación con el resumen KB y sin loss runs: los mismos totales que calcular_burning_cost
+    resumen_kb = analizador.datos_consolidados.get('resumen_kb')
+    n_detalle = n_siniestros
+    if n_detalle == 0 and resumen_kb and resumen_kb['n_siniestros'] > 0:
+        n_siniestros = resumen_kb['n_siniestros']
+        años_unicos = len(resumen_kb['por_anio'])
+        siniestralidad_total = resumen_kb['incurrido_total_usd']
+        siniestralidad_promedio_anual = siniestralidad_total / años_unicos if años_unicos > 0 else 0
+        severidad_promedio = resumen_kb['severidad_promedio_usd'] or 0
+        severidad_mediana = None
+        severidad_p95 = resumen_kb['severidad_p95_usd'] or 0
+        frecuencia_anual = n_siniestros / años_unicos if años_unicos > 0 else 0
+
     # Burning Cost
     burning_cost = siniestralidad_promedio_anual / tiv_total if tiv_total > 0 else 0
     burning_cost_por_mil = burning_cost * 1000
@@ -1342,18 +5223,29 @@ def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
         notas_pricing.append(f"CRÍTICO: Solo {n_siniestros} siniestros - muestra estadísticamente insuficiente")
     elif n_siniestros < 10:
         notas_pricing.append(f"ADVERTENCIA: Solo {n_siniestros} siniestros - análisis con baja confiabilidad")
+    if resumen_kb:
+        notas_pricing.append(f"INFO: Histórico KB desde resúmenes materializados ({resumen_kb['n_siniestros']} siniestros, "
+                             f"generado {resumen_kb['generado_en']}) - ver historico_kb_resumen")
 
-    pct_sin_liquidar = ((df_siniestros['monto_pagado'] == 0).sum() / n_siniestros * 100) if n_siniestros > 0 else 0
+    pct_sin_liquidar = ((df_siniestros['monto_pagado'] == 0).sum() / n_detalle * 100) if n_detalle > 0 else 0
     if pct_sin_liquidar >= 100:
         notas_pricing.append("CRÍTICO: 100% de siniestros sin liquidar - cuantías pueden variar")
     elif pct_sin_liquidar >= 50:
         notas_pricing.append(f"ADVERTENCIA: {pct_sin_liquidar:.0f}% sin liquidar")
 
     # Burning Cost vs referencia
-    tasa_referencia = 1.50
+    tasa_referencia = analizador.tasa_slip_por_mil
     if burning_cost_por_mil > tasa_referencia:
         notas_pricing.append(f"ROJO: BC {burning_cost_por_mil:.4f}‰ > tasa referencia {tasa_referencia}‰")
 
+    # Grilla de pricing (solo si el request la pidió)
+    with medir_etapa('grilla_pricing'):
+        grilla_pricing = generar_grilla_pricing(analizador, tasa_cambio)
+
+    # Ubicaciones críticas y concentración del TIV
+    with medir_etapa('concentracion_ubicaciones'):
+        ubicaciones_criticas, concentracion_tiv = generar_ubicaciones_criticas(analizador, tasa_cambio)
+
     analisis = {
         "resumen_global": {
             "periodo": {
@@ -1366,7 +5258,7 @@ def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
             "frecuencia_promedio_anual": round(frecuencia_anual, 2),
             "incurrido_neto_total_usd": round(siniestralidad_total * tasa_cambio, 2),
             "severidad_promedio_usd": round(severidad_promedio * tasa_cambio, 2),
-            "severidad_mediana_usd": round(severidad_mediana * tasa_cambio, 2),
+            "severidad_mediana_usd": round(severidad_mediana * tasa_cambio, 2) if severidad_mediana is not None else None,
             "severidad_p95_usd": round(severidad_p95 * tasa_cambio, 2),
             f"tiv_total_{moneda_origen.lower()}": tiv_total,
             "tiv_total_usd": round(tiv_total * tasa_cambio, 2),
@@ -1376,7 +5268,13 @@ def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
         },
         "por_anio": generar_analisis_por_anio(df_siniestros, tasa_cambio),
         "por_peril": generar_analisis_por_peril(df_siniestros, tasa_cambio),
-        "ubicaciones_criticas": [],
+        "ubicaciones_criticas": ubicaciones_criticas,
+        "concentracion_tiv": concentracion_tiv,
+        "eventos": generar_analisis_eventos(analizador, tasa_cambio),
+        "grilla_pricing": grilla_pricing,
+        "incertidumbre": generar_incertidumbre_usd(analizador, tasa_cambio),
+        "chain_ladder": generar_chain_ladder_usd(analizador, tasa_cambio),
+        "historico_kb_resumen": resumen_kb,
         "notas_para_pricing": notas_pricing
     }
 
@@ -1407,6 +5305,7 @@ def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
             "moneda_destino": "USD",
             "tasa_promedio_usada": tasa_cambio
         }],
+        "deduplicacion_kb": analizador.datos_consolidados.get('deduplicacion_kb'),
         "limitaciones": limitaciones
     }
 
@@ -1417,7 +5316,18 @@ def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
         "version_pipeline": "3.0-azure-function-con-kb",
         "timestamp_proceso": datetime.now().isoformat(),
         "scripts_ejecutados": ["function_app_v3_con_kb.py - generar_json_pricing()"],
-        "fuente_historico": "knowledge_base" if analizador.datos_consolidados.get('tiene_historico_kb') else "archivos_carga"
+        "fuente_historico": "knowledge_base" if analizador.datos_consolidados.get('tiene_historico_kb') else "archivos_carga",
+        "knowledge_base": {
+            "origen": analizador.datos_consolidados.get('origen_kb'),
+            "snapshot": SNAPSHOT_KB.marca_agua(),
+            "resumenes": RESUMENES_KB.marca_agua()
+        },
+        "formatos_detectados": {
+            "tiv": analizador.datos_consolidados.get('formato_tiv'),
+            "siniestralidad": analizador.datos_consolidados.get('formatos_siniestros', [])
+        },
+        "cache_libros": analizador.datos_consolidados.get('cache_libros', []),
+        "presupuesto": _PRESUPUESTO_ACTUAL.get().resumen() if _PRESUPUESTO_ACTUAL.get() is not None else None
     }
 
     return {
@@ -1429,6 +5339,919 @@ def generar_json_pricing(analizador: AnalizadorTecnico) -> Dict[str, Any]:
     }
 
 
+# ===========================================
+# CALENTAMIENTO DE INSTANCIA
+# ===========================================
+
+# Libros mínimos (5 filas) de cada formato soportado, embebidos en calentamiento/;
+# se regeneran con python -m benchmarks.libros_sinteticos
+DIRECTORIO_CALENTAMIENTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calentamiento')
+# formato -> (rol, archivo)
+LIBROS_CALENTAMIENTO = {
+    'grupo_i': ('siniestralidad', 'siniestralidad_grupo_i.xlsx'),
+    'la_costena_siniestros': ('siniestralidad', 'siniestros_la_costena.xlsx'),
+    'conagua_siniestros': ('siniestralidad', 'conagua_loss_run.xlsx'),
+    'csv_siniestros': ('siniestralidad', 'siniestros.csv'),
+    'rio_magdalena_tiv': ('tiv', 'tiv_rio_magdalena.xlsx'),
+    'antioquia_tiv': ('tiv', 'tiv_antioquia.xlsx'),
+    'la_costena_tiv': ('tiv', 'desglose_valores_la_costena.xlsx'),
+    'conagua_tiv': ('tiv', 'conagua_sov.xlsx'),
+    'csv_tiv': ('tiv', 'tiv.csv'),
+}
+
+_LOCK_CALENTAMIENTO = threading.Lock()
+_ULTIMO_CALENTAMIENTO: Dict[str, Any] = {}
+
+
+def _calentar_parser(formato: str) -> Dict[str, Any]:
+    """Procesa el libro de calentamiento del formato por su ruta de parseo"""
+    rol, filename = LIBROS_CALENTAMIENTO[formato]
+    with open(os.path.join(DIRECTORIO_CALENTAMIENTO, filename), 'rb') as f:
+        contenido = f.read()
+    analizador = AnalizadorTecnico('calentamiento')
+    analizador.usar_cache_libros = False  # el objetivo es ejercitar openpyxl
+
+    if rol == 'tiv':
+        analizador.procesar_tiv(contenido, filename)
+        tiv_total = analizador.datos_consolidados['tiv_total'] or 0
+        if tiv_total <= 0:
+            raise ValueError(f"TIV no extraído del libro sintético {filename}")
+        return {'tiv_total': float(tiv_total)}
+
+    df = analizador.consolidar_siniestralidad([(filename, contenido)])
+    if df is None or df.empty:
+        raise ValueError(f"Sin siniestros en el libro sintético {filename}")
+    analizador.generar_analisis_completo()
+    return {'siniestros': len(df)}
+
+
+def calentar_instancia(incluir_kb: bool = True, incluir_fx: bool = True,
+                       exportar_kb: bool = False) -> Dict[str, Any]:
+    """
+    Precalienta la instancia: pool ODBC de la KB, cotizaciones FX y parsers
+
+    Pensado para llamarse desde el swap de slots (WEBSITE_SWAP_WARMUP_PING_PATH)
+    o al arranque del worker, de forma que el primer request real no pague
+    la conexión a la KB, la primera consulta FX ni el primer parseo con openpyxl.
+
+    Args:
+        exportar_kb: Exportar el snapshot / materializar los resúmenes si faltan o
+            vencieron. Solo el hook de arranque; desde /api/warmup se abren los
+            existentes y la exportación queda a cargo de los timers.
+
+    Returns:
+        Diccionario con el estado global y la duración de cada paso
+    """
+    global _ULTIMO_CALENTAMIENTO
+
+    with _LOCK_CALENTAMIENTO:
+        inicio_total = time.perf_counter()
+        pasos = []
+
+        def ejecutar(nombre: str, funcion, critico: bool):
+            inicio = time.perf_counter()
+            try:
+                detalle = funcion()
+                ok = not (isinstance(detalle, dict) and detalle.get('conectado') is False)
+            except Exception as e:
+                detalle = str(e)
+                ok = False
+            pasos.append({
+                'paso': nombre,
+                'ok': ok,
+                'critico': critico,
+                'duracion_ms': round((time.perf_counter() - inicio) * 1000, 1),
+                'detalle': detalle
+            })
+
+        if incluir_kb:
+            ejecutar('kb_conexion', calentar_kb, critico=False)
+            if SNAPSHOT_KB.habilitado:
+                ejecutar('kb_snapshot', lambda: SNAPSHOT_KB.preparar(exportar_kb), critico=False)
+            if RESUMENES_KB.habilitado:
+                ejecutar('kb_resumenes', lambda: RESUMENES_KB.preparar(exportar_kb), critico=False)
+        if incluir_fx:
+            ejecutar('fx_cotizaciones', lambda: CotizacionDolar().precargar(), critico=False)
+        for formato in LIBROS_CALENTAMIENTO:
+            ejecutar(f'parser_{formato}', lambda f=formato: _calentar_parser(f), critico=True)
+
+        if any(not p['ok'] and p['critico'] for p in pasos):
+            estado = 'error'
+        elif all(p['ok'] for p in pasos):
+            estado = 'ok'
+        else:
+            estado = 'parcial'
+
+        _ULTIMO_CALENTAMIENTO = {
+            'estado': estado,
+            'timestamp': datetime.now().isoformat(),
+            'duracion_total_ms': round((time.perf_counter() - inicio_total) * 1000, 1),
+            'pasos': pasos
+        }
+        logger.info(f"🔥 Calentamiento {estado} en {_ULTIMO_CALENTAMIENTO['duracion_total_ms']} ms")
+        return _ULTIMO_CALENTAMIENTO
+
+
+# ===========================================
+# PERFILADO OPCIONAL DE REQUESTS
+# ===========================================
+
+PERFILADO_DIR = os.getenv('PERFILADO_DIR', os.path.join(tempfile.gettempdir(), 'perfiles_analisis'))
+PERFILADO_MAX_POR_HORA = int(os.getenv('PERFILADO_MAX_POR_HORA', '10'))
+PERFILADO_TOP_N = int(os.getenv('PERFILADO_TOP_N', '30'))
+
+# cProfile no admite dos perfiles simultáneos en el mismo proceso (3.12+)
+_LOCK_PERFILADO = threading.Lock()
+_LOCK_VENTANA_PERFILADO = threading.Lock()
+_PERFILES_RECIENTES: deque = deque()
+
+
+def perfilado_solicitado(req: func.HttpRequest, parametros: Dict) -> bool:
+    """True si el request pide correr bajo el profiler"""
+    valor = req.headers.get('X-Perfilar') or req.params.get('perfilar') or parametros.get('perfilar')
+    return str(valor).strip().lower() in ('1', 'true', 'si', 'sí', 'yes')
+
+
+def autorizar_perfilado(req: func.HttpRequest) -> Optional[func.HttpResponse]:
+    """
+    Valida clave y límite de frecuencia del perfilado
+
+    Returns:
+        None si se autoriza, o el HttpResponse de rechazo (403/429)
+    """
+    clave_configurada = os.getenv('PERFILADO_CLAVE')
+    clave_request = req.headers.get('X-Perfil-Clave', '')
+    if not clave_configurada or not hmac.compare_digest(clave_configurada, clave_request):
+        logger.warning("🚫 Perfilado rechazado: clave inválida o PERFILADO_CLAVE no configurada")
+        return func.HttpResponse(
+            json.dumps({"error": "Perfilado no autorizado"}),
+            status_code=403,
+            mimetype="application/json"
+        )
+
+    ahora = time.time()
+    with _LOCK_VENTANA_PERFILADO:
+        while _PERFILES_RECIENTES and ahora - _PERFILES_RECIENTES[0] > 3600:
+            _PERFILES_RECIENTES.popleft()
+        if len(_PERFILES_RECIENTES) >= PERFILADO_MAX_POR_HORA:
+            return func.HttpResponse(
+                json.dumps({"error": f"Límite de perfilado alcanzado ({PERFILADO_MAX_POR_HORA}/hora)"}),
+                status_code=429,
+                headers={"Retry-After": str(int(3600 - (ahora - _PERFILES_RECIENTES[0])) + 1)},
+                mimetype="application/json"
+            )
+        _PERFILES_RECIENTES.append(ahora)
+
+    return None
+
+
+def resumir_perfil(perfil: cProfile.Profile, top_n: int, analisis_id: str) -> Dict[str, Any]:
+    """
+    Extrae las funciones más costosas por tiempo acumulado y guarda el .prof
+
+    Returns:
+        Diccionario con top de funciones y referencia al artefacto guardado
+    """
+    stats = pstats.Stats(perfil)
+    stats.sort_stats('cumulative')
+
+    top = []
+    for funcion in stats.fcn_list[:top_n]:
+        archivo, linea, nombre = funcion
+        _, llamadas, tiempo_propio, tiempo_acumulado, _ = stats.stats[funcion]
+        top.append({
+            'funcion': f"{os.path.basename(archivo)}:{linea}({nombre})",
+            'llamadas': llamadas,
+            'tiempo_propio_ms': round(tiempo_propio * 1000, 3),
+            'tiempo_acumulado_ms': round(tiempo_acumulado * 1000, 3)
+        })
+
+    artefacto = None
+    try:
+        os.makedirs(PERFILADO_DIR, exist_ok=True)
+        ruta = os.path.join(PERFILADO_DIR, f"{analisis_id}.prof")
+        stats.dump_stats(ruta)
+        artefacto = {'nombre': f"{analisis_id}.prof", 'ruta_descarga': f"/api/perfiles/{analisis_id}.prof"}
+    except Exception as e:
+        logger.warning(f"No se pudo guardar el perfil: {str(e)}")
+
+    return {
+        'profiler': 'cProfile',
+        'tiempo_total_ms': round(stats.total_tt * 1000, 3),
+        'top_funciones': top,
+        'artefacto': artefacto
+    }
+
+
+def ejecutar_perfilado(funcion, *args, **kwargs) -> Tuple[Any, Optional[cProfile.Profile]]:
+    """
+    Ejecuta funcion(*args, **kwargs) bajo cProfile
+
+    Si ya hay otro perfil en curso en el proceso, ejecuta sin perfilar.
+
+    Returns:
+        Tupla (resultado, perfil o None)
+    """
+    if not _LOCK_PERFILADO.acquire(blocking=False):
+        logger.warning("Perfil en curso en esta instancia - request ejecutado sin perfilar")
+        return funcion(*args, **kwargs), None
+
+    try:
+        perfil = cProfile.Profile()
+        perfil.enable()
+        try:
+            resultado = funcion(*args, **kwargs)
+        finally:
+            perfil.disable()
+        return resultado, perfil
+    finally:
+        _LOCK_PERFILADO.release()
+
+
+# ===========================================
+# REPORTE EXCEL
+# ===========================================
+# Tabla canónica de siniestros (vectorizada) para reporte_excel_data y, con
+# formato_salida='xlsx', el libro del reporte técnico escrito en la función
+# con openpyxl en modo write-only: las filas se vuelcan por bloques al XML de
+# cada hoja y el libro se arma en un archivo temporal (en memoria hasta
+# REPORTE_SPOOL_MAX_MB).
+
+FORMATOS_SALIDA = ('json', 'xlsx', 'ndjson')
+MIME_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+REPORTE_SPOOL_MAX_MB = int(os.getenv('REPORTE_SPOOL_MAX_MB', '32'))
+REPORTE_FILAS_BLOQUE = 50000
+# Columna de la tabla canónica -> encabezado de la hoja Siniestros
+COLUMNAS_REPORTE_SINIESTROS = {
+    'fecha_ocurrencia': 'Fecha ocurrencia',
+    'año': 'Año',
+    'poliza': 'Póliza',
+    'causa': 'Causa',
+    'peril_categoria': 'Peril',
+    'evento_id': 'Evento',
+    'pagado': 'Pagado',
+    'reservado': 'Reservado',
+    'incurrido': 'Incurrido',
+    'pagado_usd': 'Pagado USD',
+    'reservado_usd': 'Reservado USD',
+    'incurrido_usd': 'Incurrido USD',
+}
+
+
+def formato_salida_por_accept(accept: str) -> Optional[str]:
+    """Formato de salida pedido por el header Accept (None = el del body / default)"""
+    if MIME_XLSX in accept:
+        return 'xlsx'
+    if MIME_NDJSON in accept:
+        return 'ndjson'
+    return None
+
+
+def normalizar_formato_salida(valor: Any) -> str:
+    """parametros.formato_salida: 'json' (default), 'xlsx' o 'ndjson' (ValueError si no)"""
+    formato = 'json' if valor is None else str(valor).strip().lower()
+    if formato not in FORMATOS_SALIDA:
+        raise ValueError(f"formato_salida debe ser uno de {list(FORMATOS_SALIDA)}")
+    return formato
+
+
+def tabla_reporte_siniestros(df: pd.DataFrame, tasa_cambio: float) -> pd.DataFrame:
+    """Siniestros consolidados con las columnas del reporte, montos en moneda original y USD"""
+    n = len(df)
+    montos = {c: df[c].astype(float).fillna(0) if c in df.columns else pd.Series(0.0, index=df.index)
+              for c in ('monto_pagado', 'monto_reservado', 'monto_incurrido')}
+    causas = df['causa_siniestro'] if 'causa_siniestro' in df.columns else pd.Series('No especificada', index=df.index)
+    if 'peril_categoria' in df.columns:
+        perils = df['peril_categoria']
+    else:
+        texto = causas.fillna('').astype(str)
+        perils = texto.map({causa: clasificar_peril(causa)[0] for causa in texto.unique()})
+
+    return pd.DataFrame({
+        'fecha_ocurrencia': pd.to_datetime(df['fecha_siniestro'], errors='coerce') if 'fecha_siniestro' in df.columns
+                            else pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]'),
+        'año': df['año'] if 'año' in df.columns else pd.Series([None] * n, index=df.index),
+        'poliza': df['Num. Poliza'] if 'Num. Poliza' in df.columns else 'N/A',
+        'causa': causas,
+        'peril_categoria': perils,
+        'evento_id': df['evento_id'] if 'evento_id' in df.columns else pd.Series([None] * n, index=df.index),
+        'pagado': montos['monto_pagado'],
+        'reservado': montos['monto_reservado'],
+        'incurrido': montos['monto_incurrido'],
+        'pagado_usd': montos['monto_pagado'] * tasa_cambio,
+        'reservado_usd': montos['monto_reservado'] * tasa_cambio,
+        'incurrido_usd': montos['monto_incurrido'] * tasa_cambio,
+    }).reset_index(drop=True)
+
+
+def registros_reporte_excel(df: pd.DataFrame, tasa_cambio: float) -> List[Dict[str, Any]]:
+    """reporte_excel_data del response JSON (mismas claves que antes, sin iterar fila a fila)"""
+    tabla = tabla_reporte_siniestros(df, tasa_cambio)
+    fechas = tabla['fecha_ocurrencia']
+    registros = pd.DataFrame({
+        'fecha_ocurrencia': fechas.dt.strftime('%Y-%m-%dT%H:%M:%S').astype(object).where(fechas.notna(), None),
+        'causa': tabla['causa'],
+        'monto_pagado_cop': tabla['pagado'],
+        'monto_pagado_usd': tabla['pagado_usd'],
+        'reserva_cop': tabla['reservado'],
+        'incurrido_cop': tabla['incurrido'],
+        'poliza': tabla['poliza']
+    })
+    return registros.to_dict('records')
+
+
+def _valores_celda(bloque: pd.DataFrame) -> Iterator[List[Any]]:
+    """Filas de un bloque con NaN / NaT como celdas vacías"""
+    bloque = bloque.astype(object).where(bloque.notna(), None)
+    return (list(fila) for fila in bloque.itertuples(index=False, name=None))
+
+
+def _hoja_registros(wb, titulo: str, registros: List[Dict[str, Any]]) -> None:
+    ws = wb.create_sheet(title=titulo)
+    if not registros:
+        return
+    ws.append(list(registros[0]))
+    for registro in registros:
+        ws.append([v if not isinstance(v, (dict, list)) else json.dumps(v, cls=NumpyEncoder, ensure_ascii=False)
+                   for v in registro.values()])
+
+
+def escribir_reporte_xlsx(analizador: AnalizadorTecnico, json_pricing: Dict[str, Any]) -> bytes:
+    """
+    Libro del reporte técnico: Resumen, Siniestros, Por año y Por peril
+
+    Args:
+        analizador: Analizador ya procesado (siniestros consolidados y tasa de cambio)
+        json_pricing: Salida de generar_json_pricing (resumen y agregados en USD)
+
+    Returns:
+        Contenido del .xlsx
+    """
+    from openpyxl import Workbook
+
+    analisis = json_pricing.get('analisis', {})
+    wb = Workbook(write_only=True)
+
+    ws = wb.create_sheet(title='Resumen')
+    ws.append(['Asegurado', analizador.datos_consolidados.get('asegurado_nombre')])
+    ws.append(['Moneda origen', analizador.moneda_local])
+    ws.append(['Tasa a USD', analizador.tasa_cambio])
+    for clave, valor in analisis.get('resumen_global', {}).items():
+        if isinstance(valor, dict):
+            for subclave, subvalor in valor.items():
+                ws.append([f'{clave}.{subclave}', subvalor])
+        elif not isinstance(valor, list):
+            ws.append([clave, valor])
+
+    ws = wb.create_sheet(title='Siniestros')
+    ws.append(list(COLUMNAS_REPORTE_SINIESTROS.values()))
+    df = analizador.datos_consolidados['siniestralidad']
+    if df is not None and not df.empty:
+        tabla = tabla_reporte_siniestros(df, analizador.tasa_cambio or 1.0)[list(COLUMNAS_REPORTE_SINIESTROS)]
+        for inicio in range(0, len(tabla), REPORTE_FILAS_BLOQUE):
+            for fila in _valores_celda(tabla.iloc[inicio:inicio + REPORTE_FILAS_BLOQUE]):
+                ws.append(fila)
+
+    _hoja_registros(wb, 'Por año', analisis.get('por_anio') or [])
+    _hoja_registros(wb, 'Por peril', analisis.get('por_peril') or [])
+
+    with tempfile.SpooledTemporaryFile(max_size=REPORTE_SPOOL_MAX_MB * 1024 * 1024) as spool:
+        wb.save(spool)
+        spool.seek(0)
+        return spool.read()
+
+
+# ===========================================
+# SALIDA NDJSON
+# ===========================================
+# Solo por compatibilidad con clientes que consumen líneas, no es una mejora de
+# rendimiento: func.HttpResponse necesita el cuerpo entero, así que el handler
+# junta las líneas después del análisis completo y el primer byte y el pico de
+# memoria son los de la salida JSON. Con formato_salida='ndjson' la primera línea
+# es el response sin siniestros (json_pricing.siniestros y reporte_excel_data
+# vacíos) y cada línea siguiente un registro de json_pricing.siniestros.
+
+MIME_NDJSON = 'application/x-ndjson'
+
+
+def lineas_ndjson(encabezado: Dict[str, Any], registros: Iterator[Dict[str, Any]]) -> Iterator[bytes]:
+    """Encabezado y registros como líneas JSON en UTF-8"""
+    yield json.dumps(encabezado, cls=NumpyEncoder).encode() + b'\n'
+    for registro in registros:
+        yield json.dumps(registro, cls=NumpyEncoder).encode() + b'\n'
+
+
+# ===========================================
+# RESULTADOS EN MEMORIA Y PAGINACIÓN
+# ===========================================
+# Cada análisis deja sus siniestros (columnas de json_pricing.siniestros, ya en
+# USD) y los agregados por peril en un almacén LRU con TTL, por analisis_id.
+# GET /api/analisis/{analisis_id}/siniestros pagina con cursor, filtros y orden
+# sobre esa tabla: los órdenes se calculan una vez por columna y se reusan, los
+# filtros son máscaras booleanas. No se vuelve a correr el análisis.
+
+RESULTADOS_HABILITADO = _env_bool('RESULTADOS_HABILITADO', default=True)
+RESULTADOS_TTL_SEGUNDOS = int(os.getenv('RESULTADOS_TTL_SEGUNDOS', '1800'))
+RESULTADOS_MAX_ENTRADAS = int(os.getenv('RESULTADOS_MAX_ENTRADAS', '32'))
+RESULTADOS_MAX_FILAS = int(os.getenv('RESULTADOS_MAX_FILAS', '2000000'))
+PAGINA_LIMITE_DEFAULT = 100
+PAGINA_LIMITE_MAX = 1000
+# Columnas por las que se puede ordenar (prefijo '-' = descendente)
+COLUMNAS_ORDEN_SINIESTROS = ('fecha_siniestro', 'incurrido_usd', 'pagado_usd', 'reservado_usd', 'claim_id', 'evento_id')
+FILTROS_SINIESTROS = ('peril', 'estado', 'catastrofico', 'anio', 'evento_id', 'min_incurrido_usd')
+
+
+def tabla_siniestros_pricing(df: pd.DataFrame, tasa_cambio: float) -> pd.DataFrame:
+    """
+    Columnas de json_pricing.siniestros en una tabla (vectorizada), con el
+    mismo claim_id, estado, peril y marca catastrófica que iterar_siniestros_pricing
+    """
+    tabla = tabla_reporte_siniestros(df, tasa_cambio)
+    fechas = tabla['fecha_ocurrencia']
+    causas = tabla['causa'].fillna('').astype(str)
+    subcategorias = {causa: clasificar_peril(causa)[1] for causa in causas.unique()}
+    digests = pd.Series([hashlib.md5(str(idx).encode()).hexdigest()[:8].upper() for idx in df.index])
+    umbral_catastrofico = df['monto_incurrido'].quantile(0.95)
+
+    return pd.DataFrame({
+        'claim_id': 'CLAIM-ARM-' + fechas.dt.strftime('%d%m%Y').fillna('XXXXXXXX') + '-' + digests,
+        'fecha_siniestro': fechas.dt.strftime('%Y-%m-%d').astype(object).where(fechas.notna(), None),
+        'año': pd.to_numeric(tabla['año'], errors='coerce').astype('Int64'),
+        'estado': np.where((tabla['pagado'] > 0) & (tabla['reservado'] == 0), 'cerrado', 'abierto'),
+        'peril_categoria': tabla['peril_categoria'],
+        'peril_subcategoria': causas.map(subcategorias),
+        'descripcion': tabla['causa'],
+        'es_catastrofico': marcar_catastroficos(df, umbral_catastrofico).to_numpy().astype(int),
+        'evento_id': pd.to_numeric(tabla['evento_id'], errors='coerce').astype('Int64'),
+        'pagado_usd': tabla['pagado_usd'],
+        'reservado_usd': tabla['reservado_usd'],
+        'incurrido_usd': tabla['incurrido_usd'],
+    })
+
+
+class ResultadoAnalisis:
+    """Siniestros y agregados de un análisis, con los órdenes por columna calculados a demanda"""
+
+    def __init__(self, analisis_id: str, asegurado: str, siniestros: pd.DataFrame,
+                 por_peril: List[Dict[str, Any]]):
+        self.analisis_id = analisis_id
+        self.asegurado = asegurado
+        self.siniestros = siniestros.reset_index(drop=True)
+        self.por_peril = por_peril
+        self.creado = time.time()
+        self._ordenes: Dict[Tuple[str, bool], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def filas(self) -> int:
+        return len(self.siniestros)
+
+    def orden(self, columna: str, descendente: bool) -> np.ndarray:
+        """Posiciones de las filas ordenadas por la columna (nulos al final, orden estable)"""
+        clave = (columna, descendente)
+        with self._lock:
+            if clave not in self._ordenes:
+                self._ordenes[clave] = self.siniestros[columna].sort_values(
+                    ascending=not descendente, kind='stable', na_position='last').index.to_numpy()
+            return self._ordenes[clave]
+
+
+class AlmacenResultados:
+    """
+    LRU en memoria por analisis_id, acotado por entradas, filas totales y TTL
+
+    Guarda objetos con analisis_id, creado (desde cuándo corre el TTL) y filas:
+    ResultadoAnalisis y SesionAnalisis.
+    """
+
+    def __init__(self, ttl_segundos: int, max_entradas: int, max_filas: int):
+        self.ttl_segundos = ttl_segundos
+        self.max_entradas = max_entradas
+        self.max_filas = max_filas
+        self._entradas: 'OrderedDict[str, ResultadoAnalisis]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+    def guardar(self, resultado: ResultadoAnalisis):
+        with self._lock:
+            self._entradas[resultado.analisis_id] = resultado
+            self._desalojar()
+
+    def obtener(self, analisis_id: str) -> Optional[ResultadoAnalisis]:
+        """Resultado vigente (None si nunca estuvo en esta instancia o ya venció)"""
+        with self._lock:
+            self._desalojar()
+            resultado = self._entradas.get(analisis_id)
+            if resultado is not None:
+                self._entradas.move_to_end(analisis_id)
+            return resultado
+
+    def _desalojar(self):
+        """Elimina los vencidos y después los menos usados hasta quedar bajo los límites"""
+        limite = time.time() - self.ttl_segundos
+        for analisis_id in [k for k, r in self._entradas.items() if r.creado < limite]:
+            del self._entradas[analisis_id]
+        filas = sum(r.filas for r in self._entradas.values())
+        while self._entradas and (len(self._entradas) > self.max_entradas or filas > self.max_filas):
+            _, resultado = self._entradas.popitem(last=False)
+            filas -= resultado.filas
+
+
+ALMACEN_RESULTADOS = AlmacenResultados(RESULTADOS_TTL_SEGUNDOS, RESULTADOS_MAX_ENTRADAS, RESULTADOS_MAX_FILAS)
+
+
+def _codificar_cursor(posicion: int, consulta: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'p': posicion, 'q': consulta}).encode()).decode().rstrip('=')
+
+
+def _decodificar_cursor(cursor: str, consulta: str) -> int:
+    """Posición del cursor; ValueError si está mal formado o es de otra consulta"""
+    try:
+        datos = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        posicion = int(datos['p'])
+    except Exception:
+        raise ValueError("cursor inválido")
+    if datos.get('q') != consulta or posicion < 0:
+        raise ValueError("El cursor corresponde a otra consulta (filtros u orden distintos)")
+    return posicion
+
+
+def paginar_siniestros(resultado: ResultadoAnalisis, params: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Página de siniestros de un análisis guardado
+
+    Args:
+        resultado: Entrada del almacén
+        params: Query string (limite, cursor, orden y los FILTROS_SINIESTROS)
+
+    Returns:
+        Diccionario con el total filtrado, los items y siguiente_cursor (None en la última página)
+
+    Raises:
+        ValueError: Parámetro mal formado (el endpoint responde 400)
+    """
+    tabla = resultado.siniestros
+    limite = params.get('limite') or str(PAGINA_LIMITE_DEFAULT)
+    if not limite.isdigit() or not 1 <= int(limite) <= PAGINA_LIMITE_MAX:
+        raise ValueError(f"limite debe estar entre 1 y {PAGINA_LIMITE_MAX}")
+
+    orden = params.get('orden') or 'fecha_siniestro'
+    columna = orden.lstrip('-')
+    if columna not in COLUMNAS_ORDEN_SINIESTROS:
+        raise ValueError(f"orden debe ser una de {list(COLUMNAS_ORDEN_SINIESTROS)} (prefijo '-' = descendente)")
+
+    filtros = {clave: params[clave].strip() for clave in FILTROS_SINIESTROS if params.get(clave)}
+    mascara = np.ones(len(tabla), dtype=bool)
+    if 'peril' in filtros:
+        mascara &= (tabla['peril_categoria'].str.lower() == filtros['peril'].lower()).to_numpy()
+    if 'estado' in filtros:
+        mascara &= (tabla['estado'] == filtros['estado'].lower()).to_numpy()
+    if 'catastrofico' in filtros:
+        marca = int(filtros['catastrofico'].lower() in ('1', 'true', 'si', 'sí', 'yes'))
+        mascara &= tabla['es_catastrofico'].to_numpy() == marca
+    if 'anio' in filtros:
+        mascara &= (tabla['año'] == int(filtros['anio'])).fillna(False).to_numpy(dtype=bool)
+    if 'evento_id' in filtros:
+        mascara &= (tabla['evento_id'] == int(filtros['evento_id'])).fillna(False).to_numpy(dtype=bool)
+    if 'min_incurrido_usd' in filtros:
+        mascara &= tabla['incurrido_usd'].to_numpy() >= float(filtros['min_incurrido_usd'])
+
+    consulta = hashlib.sha1(json.dumps([orden, filtros], sort_keys=True).encode()).hexdigest()[:12]
+    desde = _decodificar_cursor(params['cursor'], consulta) if params.get('cursor') else 0
+
+    posiciones = resultado.orden(columna, orden.startswith('-'))
+    posiciones = posiciones[mascara[posiciones]]
+    pagina = tabla.iloc[posiciones[desde:desde + int(limite)]]
+    hasta = desde + len(pagina)
+
+    return {
+        'analisis_id': resultado.analisis_id,
+        'asegurado': resultado.asegurado,
+        'total': int(len(posiciones)),
+        'orden': orden,
+        'filtros': filtros,
+        'items': pagina.astype(object).where(pagina.notna(), None).to_dict('records'),
+        'siguiente_cursor': _codificar_cursor(hasta, consulta) if hasta < len(posiciones) else None
+    }
+
+
+# ===========================================
+# SESIONES DE ANÁLISIS INCREMENTAL
+# ===========================================
+# Con parametros.sesion = true el analizador queda guardado (siniestros
+# normalizados por archivo, TIV e histórico KB) bajo el analisis_id. Un request
+# con parametros.sesion_id agrega o reemplaza archivos: solo se parsean esos,
+# la KB no se vuelve a consultar, el TIV se reusa si no viene uno nuevo y los
+# agregados se recalculan sobre la tabla ya normalizada.
+
+SESIONES_TTL_SEGUNDOS = int(os.getenv('SESIONES_TTL_SEGUNDOS', '3600'))
+SESIONES_MAX_ENTRADAS = int(os.getenv('SESIONES_MAX_ENTRADAS', '8'))
+SESIONES_MAX_FILAS = int(os.getenv('SESIONES_MAX_FILAS', '2000000'))
+
+
+class SesionAnalisis:
+    """Analizador de una sesión; un lock serializa los requests sobre la misma sesión"""
+
+    def __init__(self, sesion_id: str, analizador: AnalizadorTecnico):
+        self.analisis_id = sesion_id
+        self.analizador = analizador
+        # Última actualización: el TTL corre desde el último request de la sesión
+        self.creado = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def filas(self) -> int:
+        analizador = self.analizador
+        tiv = analizador.datos_consolidados.get('tiv')
+        return (sum(len(df) for df in analizador.siniestros_por_archivo.values())
+                + (len(analizador.historico_kb) if analizador.historico_kb is not None else 0)
+                + (len(tiv) if tiv is not None else 0))
+
+
+ALMACEN_SESIONES = AlmacenResultados(SESIONES_TTL_SEGUNDOS, SESIONES_MAX_ENTRADAS, SESIONES_MAX_FILAS)
+
+
+def normalizar_archivos_a_quitar(valor: Any) -> List[str]:
+    """parametros.quitar_archivos: nombres de loss runs a sacar de la sesión (ValueError si no es lista)"""
+    if valor is None:
+        return []
+    if not isinstance(valor, list) or not all(isinstance(nombre, str) for nombre in valor):
+        raise ValueError("quitar_archivos debe ser una lista de nombres de archivo")
+    return valor
+
+
+# ===========================================
+# PIPELINE DE ANÁLISIS
+# ===========================================
+
+def ejecutar_analisis(asegurado_nombre: str, tiv_bytes: bytes, tiv_filename: str,
+                      siniestros_files: List[tuple], slip_bytes: Optional[bytes] = None,
+                      slip_filename: Optional[str] = None,
+                      parametros: Optional[Dict[str, Any]] = None,
+                      sesion: Optional[SesionAnalisis] = None) -> Dict[str, Any]:
+    """
+    Ejecuta el pipeline completo (PASO 1-6) y arma el response del endpoint
+
+    Args:
+        asegurado_nombre: Nombre del asegurado (se busca en la KB)
+        tiv_bytes: Contenido del archivo TIV (None en una sesión = el TIV ya procesado)
+        tiv_filename: Nombre del archivo TIV
+        siniestros_files: Lista de (nombre, contenido) de siniestralidad
+        slip_bytes: Contenido del slip (opcional)
+        slip_filename: Nombre del slip (opcional)
+        parametros: Parámetros del request (tiv_streaming, tiv_ubicaciones, horas_clausula_evento,
+            tasa_propuesta_por_mil, grilla_pricing, bootstrap, formato_salida, sesion,
+            quitar_archivos, historico_kb; presupuesto_segundos lo aplica el handler)
+        sesion: Sesión retomada (parametros.sesion_id); el caller tiene su lock
+
+    Returns:
+        Diccionario con el response_data del análisis (con formato_salida='xlsx', el
+        libro en 'reporte_xlsx'; con 'ndjson', el generador de siniestros en
+        'registros_ndjson'; en ambos casos reporte_excel_data vacío)
+    """
+    parametros = parametros or {}
+
+    # Inicializar analizador con nombre asegurado, o retomar el de la sesión
+    if sesion is not None:
+        analizador = sesion.analizador
+        asegurado_nombre = analizador.datos_consolidados['asegurado_nombre']
+        analizador.preparar_reanalisis(normalizar_archivos_a_quitar(parametros.get('quitar_archivos')))
+        logger.info(f"♻️ Sesión {sesion.analisis_id}: {len(analizador.siniestros_por_archivo)} archivos ya "
+                    f"normalizados, {len(siniestros_files)} nuevos o reemplazados")
+    else:
+        analizador = AnalizadorTecnico(asegurado_nombre)
+    analizador.tiv_streaming = parametros.get('tiv_streaming')
+    analizador.tiv_conservar_ubicaciones = bool(parametros.get('tiv_ubicaciones', False))
+    analizador.horas_clausula_evento = {peril: float(horas) for peril, horas
+                                        in (parametros.get('horas_clausula_evento') or {}).items()}
+    analizador.tasa_slip_por_mil = float(parametros.get('tasa_propuesta_por_mil', TASA_SLIP_DEFAULT_POR_MIL))
+    if parametros.get('grilla_pricing') is not None:
+        analizador.grilla_pricing = normalizar_grilla_pricing(
+            {'tasas_por_mil': [analizador.tasa_slip_por_mil], **parametros['grilla_pricing']})
+    analizador.bootstrap = normalizar_bootstrap(parametros.get('bootstrap'))
+
+    # PASO 1: Intentar cargar histórico desde Knowledge Base, en el pool de I/O
+    # mientras se procesa el TIV (la KB y el TIV escriben claves distintas)
+    # El resumen KB solo reemplaza al detalle sin loss runs ni sesión: los archivos (ahora o en
+    # un request posterior de la sesión) se combinan y deduplican contra el detalle de la KB
+    solo_resumen = (normalizar_historico_kb(parametros.get('historico_kb')) == 'resumen'
+                    and not siniestros_files and not parametros.get('sesion'))
+
+    def cargar_historico_kb() -> bool:
+        with medir_etapa('paso_1_historico_kb'):
+            return analizador.cargar_historico_desde_kb(años_historico=5, solo_resumen=solo_resumen)
+
+    if sesion is None:
+        futuro_kb = enviar_io(cargar_historico_kb)
+    else:
+        # El histórico KB de la sesión ya está cargado
+        futuro_kb = Future()
+        futuro_kb.set_result(analizador.datos_consolidados['tiene_historico_kb'])
+    # Cotización de la moneda probable (la misma detección que generar_json_pricing)
+    moneda_probable = detectar_moneda_por_formato(
+        asegurado_nombre, [nombre for nombre, _ in siniestros_files] + analizador.datos_consolidados['archivos_procesados'])
+    futuro_fx = enviar_io(analizador.api_cotizacion.precargar_moneda, moneda_probable)
+
+    # PASO 2: Procesar archivos
+    try:
+        if tiv_bytes is not None:
+            with medir_etapa('paso_2_tiv', archivo=tiv_filename):
+                analizador.procesar_tiv(tiv_bytes, tiv_filename)
+    finally:
+        historico_kb_cargado = futuro_kb.result()
+    if tiv_bytes is not None:
+        METRICAS.archivos.inc(rol='tiv', formato=analizador.datos_consolidados.get('formato_tiv') or 'desconocido')
+
+    # PASO 3: Consolidar siniestralidad (combina archivos + KB si existe; en una sesión
+    # solo se parsean los archivos nuevos)
+    if siniestros_files or sesion is not None:
+        with medir_etapa('paso_3_siniestralidad', archivos=len(siniestros_files)):
+            analizador.consolidar_siniestralidad(siniestros_files)
+
+    # PASO 4: Generar análisis completo
+    with medir_etapa('paso_4_analisis_completo'):
+        analisis_completo = analizador.generar_analisis_completo()
+
+    # PASO 5: Generar JSON pricing formato Río Magdalena
+    formato_salida = normalizar_formato_salida(parametros.get('formato_salida'))
+    futuro_fx.result()
+    with medir_etapa('paso_5_json_pricing'):
+        json_pricing = generar_json_pricing(analizador, incluir_siniestros=formato_salida != 'ndjson')
+
+    # PASO 6: Preparar datos para el reporte Excel (o el libro .xlsx si se pidió; con NDJSON los
+    # siniestros salen una sola vez, como líneas)
+    reporte_excel_data = []
+    reporte_xlsx = None
+    df_sini = analizador.datos_consolidados['siniestralidad']
+    with medir_etapa('paso_6_reporte_excel', formato=formato_salida):
+        if formato_salida == 'xlsx':
+            reporte_xlsx = escribir_reporte_xlsx(analizador, json_pricing)
+        elif formato_salida == 'json' and df_sini is not None and not df_sini.empty:
+            reporte_excel_data = registros_reporte_excel(df_sini, analizador.tasa_cambio)
+
+    # Spans de instrumentación en la trazabilidad (solo si el request lo pidió)
+    instrumentacion = _INSTRUMENTACION_ACTUAL.get()
+    if instrumentacion is not None and instrumentacion.incluir_en_respuesta:
+        json_pricing['trazabilidad']['instrumentacion'] = instrumentacion.resumen()
+
+    # Generar UUID
+    import uuid
+    analisis_id = str(uuid.uuid4())
+
+    # Extraer métricas para respuesta
+    burning_cost_data = analisis_completo.get('burning_cost', {})
+    burning_cost_pct = burning_cost_data.get('burning_cost_pct', 0)
+    semaforo = burning_cost_data.get('semaforo', 'N/A')
+
+    # Siniestros en el almacén de resultados para paginarlos sin re-analizar
+    paginacion = None
+    if RESULTADOS_HABILITADO and df_sini is not None and not df_sini.empty:
+        with medir_etapa('resultado_paginable'):
+            ALMACEN_RESULTADOS.guardar(ResultadoAnalisis(
+                analisis_id, asegurado_nombre, tabla_siniestros_pricing(df_sini, analizador.tasa_cambio),
+                json_pricing['analisis'].get('por_peril', [])))
+        paginacion = {
+            "siniestros": f"/api/analisis/{analisis_id}/siniestros",
+            "perils": f"/api/analisis/{analisis_id}/perils",
+            "expira_en_segundos": RESULTADOS_TTL_SEGUNDOS
+        }
+
+    # Sesión: el analizador queda guardado para agregar archivos sin reprocesar
+    info_sesion = None
+    if sesion is not None or parametros.get('sesion'):
+        sesion = sesion or SesionAnalisis(analisis_id, analizador)
+        sesion.creado = time.time()
+        ALMACEN_SESIONES.guardar(sesion)
+        info_sesion = {
+            "sesion_id": sesion.analisis_id,
+            "archivos_siniestralidad": list(analizador.siniestros_por_archivo),
+            "archivos_procesados_en_request": [nombre for nombre, _ in siniestros_files],
+            "tiv_reprocesado": tiv_bytes is not None,
+            "expira_en_segundos": SESIONES_TTL_SEGUNDOS
+        }
+
+    response_data = {
+        "status": "success",
+        "version": f"{VERSION}-con-kb",
+        "analisis_id": analisis_id,
+        "tipo_cliente": analisis_completo['metadata']['tipo_cliente'],
+        "asegurado": asegurado_nombre,
+        "tiene_historico_kb": historico_kb_cargado,
+        "insured_key": analizador.datos_consolidados.get('insured_key'),
+        "tiv_total": analizador.datos_consolidados['tiv_total'],
+        "tiv_estadisticas": analizador.datos_consolidados['tiv_estadisticas'],
+        "burning_cost": burning_cost_data.get('burning_cost_por_mil', 0) / 1000,
+        "burning_cost_pct": burning_cost_pct,
+        "semaforo_burning_cost": semaforo,
+        "siniestros_procesados": len(df_sini) if df_sini is not None else 0,
+        "analisis_completo": analisis_completo,
+        "json_pricing": json_pricing,
+        "reporte_excel_data": reporte_excel_data,
+        "paginacion": paginacion,
+        "sesion": info_sesion,
+        "slip_info": {
+            "filename": slip_filename,
+            "recibido": slip_bytes is not None
+        },
+        "mensaje": f"Análisis técnico v{VERSION} completado exitosamente"
+    }
+    if reporte_xlsx is not None:
+        response_data['reporte_xlsx'] = reporte_xlsx
+    if formato_salida == 'ndjson':
+        response_data['registros_ndjson'] = iterar_siniestros_pricing(df_sini, analizador.moneda_local,
+                                                                      analizador.tasa_cambio)
+
+    logger.info(f"✅ Análisis completado: {asegurado_nombre} - BC: {burning_cost_pct:.4f}% - Semáforo: {semaforo}")
+
+    return response_data
+
+
+
+
+# ===========================================
+# EJECUCIÓN CONCURRENTE Y CONTROL DE CARGA
+# ===========================================
+# analisis_tecnico es async: el pipeline (bloqueante) corre en un pool acotado
+# de hilos y el event loop del worker sigue atendiendo otros requests. Dentro
+# de un análisis, la KB y la cotización se consultan en un pool de I/O mientras
+# se procesa el TIV, y el parseo de loss runs puede ir a un pool de procesos
+# para que los análisis concurrentes no compitan por el GIL.
+
+ANALISIS_CONCURRENTES_MAX = int(os.getenv('ANALISIS_CONCURRENTES_MAX', '4'))
+ANALISIS_EN_ESPERA_MAX = int(os.getenv('ANALISIS_EN_ESPERA_MAX', '8'))
+ANALISIS_RETRY_AFTER_SEGUNDOS = int(os.getenv('ANALISIS_RETRY_AFTER_SEGUNDOS', '30'))
+HILOS_IO_MAX = int(os.getenv('HILOS_IO_MAX', '8'))
+# 0 = los loss runs se parsean en el hilo del análisis
+PROCESOS_PARSEO = int(os.getenv('PROCESOS_PARSEO', '0'))
+
+POOL_ANALISIS = ThreadPoolExecutor(max_workers=ANALISIS_CONCURRENTES_MAX, thread_name_prefix='analisis')
+POOL_IO = ThreadPoolExecutor(max_workers=HILOS_IO_MAX, thread_name_prefix='io')
+_POOL_PARSEO: Optional[ProcessPoolExecutor] = None
+_LOCK_POOL_PARSEO = threading.Lock()
+
+
+class ControlCarga:
+    """
+    Backpressure de analisis_tecnico: hasta `concurrentes` análisis en ejecución
+    y `en_espera` esperando un hilo; por encima de eso el request recibe 503
+    """
+
+    def __init__(self, concurrentes: int, en_espera: int):
+        self.limite = concurrentes + en_espera
+        self.en_curso = 0
+        self._lock = threading.Lock()
+
+    def admitir(self) -> bool:
+        with self._lock:
+            if self.en_curso >= self.limite:
+                return False
+            self.en_curso += 1
+            return True
+
+    def liberar(self) -> None:
+        with self._lock:
+            self.en_curso -= 1
+
+
+CONTROL_CARGA = ControlCarga(ANALISIS_CONCURRENTES_MAX, ANALISIS_EN_ESPERA_MAX)
+
+
+def enviar_io(funcion, *args, **kwargs) -> Future:
+    """Ejecuta funcion en POOL_IO con una copia del contexto (instrumentación del request)"""
+    return POOL_IO.submit(contextvars.copy_context().run, funcion, *args, **kwargs)
+
+
+def pool_parseo() -> Optional[ProcessPoolExecutor]:
+    """Pool de procesos para parsear loss runs, creado en el primer uso (None con PROCESOS_PARSEO=0)"""
+    global _POOL_PARSEO
+    if PROCESOS_PARSEO <= 0:
+        return None
+    with _LOCK_POOL_PARSEO:
+        if _POOL_PARSEO is None:
+            # spawn: el worker de Functions tiene hilos vivos, fork no es seguro
+            _POOL_PARSEO = ProcessPoolExecutor(max_workers=PROCESOS_PARSEO,
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return _POOL_PARSEO
+
+
+def parsear_siniestros(filename: str, archivo: bytes) -> Optional[pd.DataFrame]:
+    """_parsear_archivo_siniestros en el pool de procesos si está habilitado, si no en el hilo actual"""
+    global _POOL_PARSEO
+    pool = pool_parseo()
+    if pool is not None:
+        try:
+            return pool.submit(_parsear_archivo_siniestros, filename, archivo).result()
+        except BrokenProcessPool as e:
+            logger.warning(f"⚠️ Pool de parseo caído, se recrea en el próximo archivo: {e}")
+            with _LOCK_POOL_PARSEO:
+                if _POOL_PARSEO is pool:
+                    _POOL_PARSEO = None
+            pool.shutdown(wait=False)
+    return _parsear_archivo_siniestros(filename, archivo)
+
+
 # ===========================================
 # AZURE FUNCTION HTTP TRIGGER
 # ===========================================
@@ -1439,15 +6262,105 @@ def health(req: func.HttpRequest) -> func.HttpResponse:
     return func.HttpResponse(json.dumps({"status": "ok"}, cls=NumpyEncoder), status_code=200, mimetype="application/json")
 
 
+@app.route(route="warmup", methods=["GET", "POST"])
+def warmup(req: func.HttpRequest) -> func.HttpResponse:
+    """Precalienta la instancia (llamado desde el swap de slots)
+
+    Query params opcionales: kb=0 / fx=0 para omitir esos pasos.
+    Retorna 503 si algún parser falla, para que el swap no se complete.
+    """
+    incluir_kb = req.params.get('kb', '1') != '0'
+    incluir_fx = req.params.get('fx', '1') != '0'
+    resultado = calentar_instancia(incluir_kb=incluir_kb, incluir_fx=incluir_fx)
+    return func.HttpResponse(
+        json.dumps(resultado, cls=NumpyEncoder),
+        status_code=503 if resultado['estado'] == 'error' else 200,
+        mimetype="application/json"
+    )
+
+
+@app.route(route="metrics", methods=["GET"])
+def metrics(req: func.HttpRequest) -> func.HttpResponse:
+    """Métricas del proceso en formato de exposición Prometheus"""
+    return func.HttpResponse(
+        METRICAS.exponer(),
+        status_code=200,
+        mimetype="text/plain",
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+@app.timer_trigger(schedule=KB_SNAPSHOT_CRON, arg_name="timer", run_on_startup=False, use_monitor=True)
+def exportar_snapshot_kb_timer(timer: func.TimerRequest) -> None:
+    """Regenera el snapshot local de la KB según KB_SNAPSHOT_CRON"""
+    if not SNAPSHOT_KB.habilitado:
+        return
+    resultado = exportar_snapshot_kb(SNAPSHOT_KB.ruta)
+    if resultado.get('exportado'):
+        logger.info(f"📦 Snapshot KB regenerado: {resultado['siniestros']} siniestros")
+    else:
+        logger.error("❌ No se pudo regenerar el snapshot KB (sin conexión)")
+
+
+@app.timer_trigger(schedule=KB_RESUMENES_CRON, arg_name="timer", run_on_startup=False, use_monitor=True)
+def materializar_resumenes_kb_timer(timer: func.TimerRequest) -> None:
+    """Actualiza los resúmenes por asegurado según KB_RESUMENES_CRON"""
+    if not RESUMENES_KB.habilitado:
+        return
+    try:
+        resultado = materializar_resumenes_kb(RESUMENES_KB.ruta)
+    except Exception as e:
+        # El store anterior sigue publicado; la próxima corrida reintenta
+        BREAKER_KB.registrar_fallo()
+        logger.error(f"❌ Error actualizando los resúmenes KB: {type(e).__name__}: {e}")
+        return
+    if resultado.get('materializado'):
+        logger.info(f"📦 Resúmenes KB actualizados ({resultado['refresco']}): {resultado['asegurados']} asegurados")
+    else:
+        logger.error("❌ No se pudieron actualizar los resúmenes KB (sin conexión)")
+
+
 @app.route(route="analisis-tecnico", methods=["POST"])
-def analisis_tecnico(req: func.HttpRequest) -> func.HttpResponse:
-    """Endpoint principal de análisis técnico v3.0 con Knowledge Base
+async def analisis_tecnico(req: func.HttpRequest) -> func.HttpResponse:
+    """Endpoint principal de análisis técnico v3.3 con Knowledge Base
 
     Acepta dos formatos:
     1. Multipart form-data (archivos directos)
     2. JSON con contenido_base64 (para n8n)
+
+    El análisis corre en POOL_ANALISIS; con la cola llena retorna 503 y Retry-After.
+    Cada request tiene ANALISIS_PRESUPUESTO_SEGUNDOS (o parametros.presupuesto_segundos).
     """
-    logger.info('🚀 Análisis técnico v3.0 iniciado')
+    inicio = time.perf_counter()
+    etiquetas = {'formato_tiv': 'desconocido', 'formato_siniestros': 'ninguno'}
+    if not CONTROL_CARGA.admitir():
+        logger.warning(f"⚠️ Análisis rechazado: {CONTROL_CARGA.en_curso} en curso (límite {CONTROL_CARGA.limite})")
+        respuesta = func.HttpResponse(
+            json.dumps({"error": "Servicio ocupado: demasiados análisis en curso, reintentar más tarde"}),
+            status_code=503,
+            mimetype="application/json",
+            headers={"Retry-After": str(ANALISIS_RETRY_AFTER_SEGUNDOS)}
+        )
+    else:
+        # El presupuesto corre desde la llegada del request, incluida la espera por un hilo
+        token = _PRESUPUESTO_ACTUAL.set(PresupuestoRequest(inicio=inicio))
+        try:
+            respuesta = await asyncio.get_running_loop().run_in_executor(
+                POOL_ANALISIS, contextvars.copy_context().run, _atender_analisis_tecnico, req, etiquetas)
+        finally:
+            _PRESUPUESTO_ACTUAL.reset(token)
+            CONTROL_CARGA.liberar()
+
+    METRICAS.requests.inc(codigo=respuesta.status_code)
+    if respuesta.status_code == 200:
+        METRICAS.duracion_request.observe(time.perf_counter() - inicio, **etiquetas)
+        METRICAS.bytes_respuesta.observe(len(respuesta.get_body()), formato_tiv=etiquetas['formato_tiv'])
+    return respuesta
+
+
+def _atender_analisis_tecnico(req: func.HttpRequest, etiquetas: Dict[str, str]) -> func.HttpResponse:
+    """Cuerpo de analisis_tecnico; completa 'etiquetas' con los formatos detectados"""
+    logger.info(f'🚀 Análisis técnico v{VERSION} iniciado')
 
     try:
         content_type = req.headers.get('Content-Type', '')
@@ -1490,7 +6403,7 @@ def analisis_tecnico(req: func.HttpRequest) -> func.HttpResponse:
                     slip_bytes = contenido_bytes
                     slip_filename = nombre
 
-            if not tiv_bytes:
+            if not tiv_bytes and not parametros.get('sesion_id'):
                 return func.HttpResponse(
                     json.dumps({"error": "No se proporcionó archivo TIV"}),
                     status_code=400,
@@ -1512,86 +6425,95 @@ def analisis_tecnico(req: func.HttpRequest) -> func.HttpResponse:
 
             # Obtener nombre asegurado (opcional)
             asegurado_nombre = req.params.get('asegurado') or req.form.get('asegurado') or 'Desconocido'
+            parametros = json.loads(req.form.get('parametros') or '{}')
 
-            if not tiv_file:
+            if not tiv_file and not parametros.get('sesion_id'):
                 return func.HttpResponse(
                     json.dumps({"error": "No se proporcionó archivo TIV"}),
                     status_code=400,
                     mimetype="application/json"
                 )
 
-            tiv_bytes = tiv_file.read()
-            tiv_filename = tiv_file.filename
+            tiv_bytes = tiv_file.read() if tiv_file else None
+            tiv_filename = tiv_file.filename if tiv_file else None
             slip_bytes = slip_file.read() if slip_file else None
             slip_filename = slip_file.filename if slip_file else None
 
-        # Inicializar analizador con nombre asegurado
-        analizador = AnalizadorTecnico(asegurado_nombre)
-
-        # PASO 1: Intentar cargar histórico desde Knowledge Base
-        historico_kb_cargado = analizador.cargar_historico_desde_kb(años_historico=5)
-
-        # PASO 2: Procesar archivos
-        analizador.procesar_tiv(tiv_bytes, tiv_filename)
-
-        # PASO 3: Consolidar siniestralidad (combina archivos + KB si existe)
-        if siniestros_files:
-            analizador.consolidar_siniestralidad(siniestros_files)
-
-        # PASO 4: Generar análisis completo
-        analisis_completo = analizador.generar_analisis_completo()
-
-        # PASO 5: Generar JSON pricing formato Río Magdalena
-        json_pricing = generar_json_pricing(analizador)
-
-        # PASO 6: Preparar datos para el reporte Excel
-        reporte_excel_data = []
-        df_sini = analizador.datos_consolidados['siniestralidad']
-        if df_sini is not None and not df_sini.empty:
-            for _, row in df_sini.iterrows():
-                reporte_excel_data.append({
-                    "fecha_ocurrencia": row.get('fecha_siniestro').isoformat() if pd.notna(row.get('fecha_siniestro')) else None,
-                    "causa": row.get('causa_siniestro', 'No especificada'),
-                    "monto_pagado_cop": float(row.get('monto_pagado', 0)),
-                    "monto_pagado_usd": float(row.get('monto_pagado', 0)) * 0.00025,
-                    "reserva_cop": float(row.get('monto_reservado', 0)),
-                    "incurrido_cop": float(row.get('monto_incurrido', 0)),
-                    "poliza": row.get('Num. Poliza', 'N/A') if 'Num. Poliza' in df_sini.columns else 'N/A'
-                })
-
-        # Generar UUID
-        import uuid
-        analisis_id = str(uuid.uuid4())
-
-        # Extraer métricas para respuesta
-        burning_cost_data = analisis_completo.get('burning_cost', {})
-        burning_cost_pct = burning_cost_data.get('burning_cost_pct', 0)
-        semaforo = burning_cost_data.get('semaforo', 'N/A')
-
-        response_data = {
-            "status": "success",
-            "version": "3.0-con-kb",
-            "analisis_id": analisis_id,
-            "tipo_cliente": analisis_completo['metadata']['tipo_cliente'],
-            "asegurado": asegurado_nombre,
-            "tiene_historico_kb": historico_kb_cargado,
-            "insured_key": analizador.datos_consolidados.get('insured_key'),
-            "tiv_total": analizador.datos_consolidados['tiv_total'],
-            "burning_cost": burning_cost_data.get('burning_cost_por_mil', 0) / 1000,
-            "burning_cost_pct": burning_cost_pct,
-            "semaforo_burning_cost": semaforo,
-            "siniestros_procesados": len(df_sini) if df_sini is not None else 0,
-            "analisis_completo": analisis_completo,
-            "json_pricing": json_pricing,
-            "reporte_excel_data": reporte_excel_data,
-            "slip_info": {
-                "filename": slip_filename,
-                "recibido": slip_bytes is not None
-            },
-            "mensaje": "Análisis técnico v3.0 completado exitosamente"
-        }
-
-        logger.info(f"✅ Análisis completado: {asegurado_nombre} - BC: {burning_cost_pct:.4f}% - Semáforo: {semaforo}")
+        # Grilla de pricing, bootstrap, formato de salida, presupuesto, archivos a quitar o modo del
+        # histórico KB mal formados: error del cliente, antes de procesar archivos
+        try:
+            if parametros.get('grilla_pricing') is not None:
+                normalizar_grilla_pricing(parametros['grilla_pricing'])
+            normalizar_bootstrap(parametros.get('bootstrap'))
+            if parametros.get('formato_salida') is None:
+                parametros['formato_salida'] = formato_salida_por_accept(req.headers.get('Accept', ''))
+            normalizar_formato_salida(parametros.get('formato_salida'))
+            normalizar_archivos_a_quitar(parametros.get('quitar_archivos'))
+            normalizar_historico_kb(parametros.get('historico_kb'))
+            presupuesto = _PRESUPUESTO_ACTUAL.get()
+            if presupuesto is not None and parametros.get('presupuesto_segundos') is not None:
+                presupuesto.segundos = normalizar_presupuesto(parametros['presupuesto_segundos'])
+        except ValueError as e:
+            return func.HttpResponse(json.dumps({"error": str(e)}), status_code=400, mimetype="application/json")
+
+        # Sesión de análisis incremental a retomar
+        sesion = None
+        if parametros.get('sesion_id'):
+            sesion = ALMACEN_SESIONES.obtener(str(parametros['sesion_id']))
+            if sesion is None:
+                return func.HttpResponse(
+                    json.dumps({"error": "Sesión no encontrada en esta instancia o vencida; volver a enviar todos los archivos"}),
+                    status_code=404, mimetype="application/json")
+
+        # Perfilado opcional (requiere clave y respeta el límite por hora)
+        perfilar = perfilado_solicitado(req, parametros)
+        if perfilar:
+            rechazo = autorizar_perfilado(req)
+            if rechazo is not None:
+                return rechazo
+
+        # Instrumentación opcional por etapa
+        instrumentacion = configurar_instrumentacion(req, parametros)
+        with (instrumentacion.activa() if instrumentacion else nullcontext()), \
+                (sesion.lock if sesion is not None else nullcontext()):
+            argumentos = (asegurado_nombre, tiv_bytes, tiv_filename, siniestros_files)
+            opciones = {'slip_bytes': slip_bytes, 'slip_filename': slip_filename, 'parametros': parametros,
+                        'sesion': sesion}
+            if perfilar:
+                response_data, perfil = ejecutar_perfilado(ejecutar_analisis, *argumentos, **opciones)
+                top_n = int(parametros.get('perfil_top_n', PERFILADO_TOP_N))
+                response_data['perfil'] = resumir_perfil(perfil, top_n, response_data['analisis_id']) \
+                    if perfil is not None else {'estado': 'omitido', 'motivo': 'Otro perfil en curso'}
+            else:
+                response_data = ejecutar_analisis(*argumentos, **opciones)
+
+        formatos = response_data['json_pricing']['trazabilidad']['formatos_detectados']
+        etiquetas['formato_tiv'] = formatos['tiv'] or 'desconocido'
+        etiquetas['formato_siniestros'] = '+'.join(sorted({f or 'desconocido' for f in formatos['siniestralidad']})) or 'ninguno'
+
+        # Libro del reporte técnico como respuesta binaria
+        reporte_xlsx = response_data.pop('reporte_xlsx', None)
+        if reporte_xlsx is not None:
+            return func.HttpResponse(
+                reporte_xlsx,
+                status_code=200,
+                mimetype=MIME_XLSX,
+                headers={
+                    "Content-Disposition": f'attachment; filename="reporte_tecnico_{response_data["analisis_id"]}.xlsx"',
+                    "X-Analisis-Id": response_data['analisis_id'],
+                    "X-Semaforo-Burning-Cost": str(response_data['semaforo_burning_cost'])
+                }
+            )
+
+        # Encabezado + un siniestro por línea, en buffer (compatibilidad, ver SALIDA NDJSON)
+        registros_ndjson = response_data.pop('registros_ndjson', None)
+        if registros_ndjson is not None:
+            return func.HttpResponse(
+                b''.join(lineas_ndjson(response_data, registros_ndjson)),
+                status_code=200,
+                mimetype=MIME_NDJSON,
+                headers={"X-Analisis-Id": response_data['analisis_id']}
+            )
 
         return func.HttpResponse(
             json.dumps(response_data, cls=NumpyEncoder),
@@ -1606,3 +6528,58 @@ def analisis_tecnico(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
             mimetype="application/json"
         )
+
+
+@app.route(route="analisis/{analisis_id}/{vista}", methods=["GET"])
+def consultar_resultado(req: func.HttpRequest) -> func.HttpResponse:
+    """Página de siniestros (vista 'siniestros') o agregados por peril (vista 'perils') de un análisis guardado"""
+    analisis_id = req.route_params.get('analisis_id', '')
+    vista = req.route_params.get('vista', '')
+    if vista not in ('siniestros', 'perils'):
+        return func.HttpResponse(json.dumps({"error": "Vista inválida (siniestros o perils)"}), status_code=400, mimetype="application/json")
+
+    resultado = ALMACEN_RESULTADOS.obtener(analisis_id)
+    if resultado is None:
+        return func.HttpResponse(
+            json.dumps({"error": "Análisis no encontrado en esta instancia o vencido; volver a ejecutar analisis-tecnico"}),
+            status_code=404, mimetype="application/json")
+
+    if vista == 'perils':
+        cuerpo = {'analisis_id': analisis_id, 'asegurado': resultado.asegurado, 'por_peril': resultado.por_peril}
+    else:
+        try:
+            cuerpo = paginar_siniestros(resultado, dict(req.params))
+        except ValueError as e:
+            return func.HttpResponse(json.dumps({"error": str(e)}), status_code=400, mimetype="application/json")
+
+    return func.HttpResponse(json.dumps(cuerpo, cls=NumpyEncoder), status_code=200, mimetype="application/json")
+
+
+@app.route(route="perfiles/{nombre}", methods=["GET"])
+def descargar_perfil(req: func.HttpRequest) -> func.HttpResponse:
+    """Descarga un artefacto .prof guardado por el perfilado (requiere X-Perfil-Clave)"""
+    clave_configurada = os.getenv('PERFILADO_CLAVE')
+    if not clave_configurada or not hmac.compare_digest(clave_configurada, req.headers.get('X-Perfil-Clave', '')):
+        return func.HttpResponse(json.dumps({"error": "No autorizado"}), status_code=403, mimetype="application/json")
+
+    nombre = req.route_params.get('nombre', '')
+    if not re.fullmatch(r'[0-9a-f\-]{36}\.prof', nombre):
+        return func.HttpResponse(json.dumps({"error": "Nombre de perfil inválido"}), status_code=400, mimetype="application/json")
+
+    ruta = os.path.join(PERFILADO_DIR, nombre)
+    if not os.path.exists(ruta):
+        return func.HttpResponse(json.dumps({"error": "Perfil no encontrado en esta instancia"}), status_code=404, mimetype="application/json")
+
+    with open(ruta, 'rb') as f:
+        return func.HttpResponse(
+            f.read(),
+            status_code=200,
+            mimetype="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{nombre}"'}
+        )
+
+
+# Hook de arranque: precalentar en segundo plano al cargar el worker (no en los procesos de parseo)
+if _env_bool('CALENTAMIENTO_AL_INICIAR') and multiprocessing.parent_process() is None:
+    threading.Thread(target=calentar_instancia, kwargs={'exportar_kb': True}, name='calentamiento',
+                     daemon=True).start()